@@ -35,9 +35,15 @@ G{packagetree}
 
 import ldap
 
-from repoze.who.plugins.ldap.plugins import LDAPBaseAuthenticatorPlugin, \
-                                            LDAPAuthenticatorPlugin, \
-                                            LDAPAttributesPlugin, \
-                                            LDAPSearchAuthenticatorPlugin
-
-__all__ = ['LDAPAuthenticatorPlugin', 'LDAPSearchAuthenticatorPlugin', 'LDAPAttributesPlugin']
+from repoze.who.plugins.shibboleth.plugins import \
+        ShibbolethBaseAuthenticatorPlugin, ShibbolethAuthenticatorPlugin, \
+        ShibbolethAttributesPlugin, ShibbolethSearchAuthenticatorPlugin, \
+        ShibbolethGroupsPlugin
+from repoze.who.plugins.shibboleth.pool import LDAPConnectionPool, \
+        LDAPServerGroup
+from repoze.who.plugins.shibboleth.sp import ShibbolethSPPlugin
+
+__all__ = ['ShibbolethAuthenticatorPlugin',
+           'ShibbolethSearchAuthenticatorPlugin', 'ShibbolethAttributesPlugin',
+           'ShibbolethGroupsPlugin', 'ShibbolethSPPlugin',
+           'LDAPConnectionPool', 'LDAPServerGroup']
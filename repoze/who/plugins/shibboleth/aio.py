@@ -0,0 +1,541 @@
+# -*- coding: utf-8 -*-
+#
+# repoze.who.plugins.shibboleth, Shibboleth authentication for WSGI applications.
+# Copyright (C) 2010 by Ralph Bean <http://threebean.wordpress.com/>
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+"""
+Asynchronous variants of the Shibboleth plugins.
+
+The variants behave like the blocking plugins they derive from, but also
+provide coroutine versions of C{authenticate} and C{add_metadata}, built on
+the message-id based asynchronous API of python-ldap. These coroutines are
+generators (see PEP 342) run by an L{LDAPEventLoop}, which polls for the
+results of the outstanding operations of all of them on a single thread.
+
+A coroutine may yield:
+ - A L{Wait} for an LDAP operation; the C{(type, data)} tuple returned by
+   C{result()} is sent back into the coroutine, or the C{ldap.LDAPError} it
+   raised is thrown into it.
+ - Another coroutine, whose return value is sent back into the caller, or
+   whose exception is thrown into it.
+ - C{None}, to let the other coroutines run for a while.
+
+A coroutine returns a value by raising L{Return}.
+
+"""
+
+__all__ = ['LDAPEventLoop', 'Task', 'Wait', 'Return',
+           'AsyncShibbolethAuthenticatorPlugin',
+           'AsyncShibbolethSearchAuthenticatorPlugin',
+           'AsyncShibbolethAttributesPlugin']
+
+import select
+import time
+import types
+
+import ldap
+
+from repoze.who.plugins.shibboleth.plugins import \
+        ShibbolethAuthenticatorPlugin, ShibbolethSearchAuthenticatorPlugin, \
+        ShibbolethAttributesPlugin, AttributesUnavailable, entries_only
+from repoze.who.plugins.shibboleth.pool import PoolTimeout, is_pool, \
+        is_bound, mark_bound, forget_bind
+from repoze.who.plugins.shibboleth.breaker import CircuitOpen
+from repoze.who.plugins.shibboleth.metrics import timed, timed_call
+
+
+#{ Coroutines
+
+
+class Return(Exception):
+    """Raised by a coroutine to return C{value}."""
+
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+class Wait(object):
+    """Yielded by a coroutine to wait for the result of an LDAP operation."""
+
+    def __init__(self, conn, msgid, timeout=None):
+        """
+        @param timeout: How many seconds to wait for the result before the
+            operation is abandoned and C{ldap.TIMEOUT} thrown into the
+            coroutine, or C{None} to wait forever.
+        @type timeout: C{float}
+
+        """
+        self.conn = conn
+        self.msgid = msgid
+        if timeout is None or timeout == '':
+            self.deadline = None
+        else:
+            self.deadline = time.time() + float(timeout)
+
+    def expired(self):
+        """Tell whether the result came too late already."""
+        return self.deadline is not None and time.time() >= self.deadline
+
+
+class Task(object):
+    """A coroutine being run by an L{LDAPEventLoop}."""
+
+    def __init__(self, coroutine):
+        # The coroutine and the ones it's waiting for, innermost last:
+        self._stack = [coroutine]
+        self.waiting = None
+        self.started = False
+        self.done = False
+        self._value = None
+        self._error = None
+
+    def step(self, value=None, error=None):
+        """
+        Resume the coroutine with C{value}, or by throwing C{error} into it,
+        until it waits for something else or it's done.
+
+        """
+        self.started = True
+        self.waiting = None
+        while True:
+            coroutine = self._stack[-1]
+            try:
+                if error is not None:
+                    thrown, error = error, None
+                    yielded = coroutine.throw(thrown)
+                else:
+                    yielded = coroutine.send(value)
+            except Return, ret:
+                value = ret.value
+            except StopIteration:
+                value = None
+            except Exception, exc:
+                value = None
+                error = exc
+            else:
+                if isinstance(yielded, types.GeneratorType):
+                    self._stack.append(yielded)
+                    value = None
+                    continue
+                self.waiting = yielded
+                return
+            # The innermost coroutine is over:
+            self._stack.pop()
+            if not self._stack:
+                self.done = True
+                self._value = value
+                self._error = error
+                return
+
+    def result(self):
+        """
+        Return the value returned by the coroutine.
+
+        @raise Exception: Whatever the coroutine raised.
+        @raise ValueError: If the coroutine isn't done yet.
+
+        """
+        if not self.done:
+            raise ValueError('The coroutine is not done yet')
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+class LDAPEventLoop(object):
+    """Runs coroutines, multiplexing their LDAP operations on one thread."""
+
+    def __init__(self, poll_interval=0.005):
+        """
+        @param poll_interval: How many seconds to wait at most between two
+            polls for results, when there's nothing else to do.
+        @type poll_interval: C{float}
+
+        """
+        self.poll_interval = float(poll_interval)
+        self._tasks = []
+
+    def spawn(self, coroutine):
+        """
+        Schedule C{coroutine} to run when the loop runs.
+
+        @rtype: L{Task}
+
+        """
+        task = Task(coroutine)
+        self._tasks.append(task)
+        return task
+
+    def run(self):
+        """Run until all the spawned coroutines are done."""
+        while self._tasks:
+            if not self._run_once():
+                self._idle()
+
+    def run_until_complete(self, coroutine):
+        """
+        Run until all the spawned coroutines are done, including
+        C{coroutine}, and return what the latter returned.
+
+        """
+        task = self.spawn(coroutine)
+        self.run()
+        return task.result()
+
+    def _run_once(self):
+        """
+        Resume every coroutine which can go on.
+
+        @return: Whether any coroutine made progress, as opposed to merely
+            yielding C{None} again.
+
+        """
+        progressed = False
+        for task in list(self._tasks):
+            wait = task.waiting
+            if wait is None:
+                progressed = progressed or not task.started
+                task.step()
+            else:
+                try:
+                    result = wait.conn.result(wait.msgid, 1, 0)
+                except ldap.LDAPError, exc:
+                    task.step(error=exc)
+                else:
+                    if result is None or result[0] is None:
+                        if not wait.expired():
+                            continue
+                        try:
+                            wait.conn.abandon(wait.msgid)
+                        except ldap.LDAPError:
+                            pass
+                        task.step(error=ldap.TIMEOUT('No result for message '
+                                                     '%s' % wait.msgid))
+                    else:
+                        task.step(result)
+                progressed = True
+            if task.done:
+                self._tasks.remove(task)
+        return progressed
+
+    def _idle(self):
+        """Wait until some result may be available."""
+        filenos = []
+        for task in self._tasks:
+            if task.waiting is not None:
+                try:
+                    filenos.append(task.waiting.conn.fileno())
+                except (AttributeError, ldap.LDAPError):
+                    pass
+        if filenos:
+            try:
+                select.select(filenos, [], [], self.poll_interval)
+                return
+            except (select.error, TypeError, ValueError):
+                pass
+        time.sleep(self.poll_interval)
+
+
+#{ LDAP operations
+
+
+# The attribute marking the single connections checked out by a coroutine:
+_IN_USE = '_repoze_who_async_in_use'
+
+
+def acquire(ldap_connection, breaker=None):
+    """
+    Coroutine checking a connection out of C{ldap_connection} without
+    blocking the loop.
+
+    The pool timeout is honored, but opening a new connection does block.
+    A single connection is handed to one coroutine at a time, until it's
+    released: A bind must not be sent while other operations are
+    outstanding on the same connection, and the others would see the wrong
+    bind state.
+
+    @param breaker: The circuit breaker to which the outcome of the
+        operations will be reported by L{release}, if any.
+    @raise PoolTimeout: If no connection was available within the timeout.
+    @raise CircuitOpen: If the C{breaker} doesn't let us contact the
+        directory now.
+
+    """
+    if breaker is not None and not breaker.allow():
+        raise CircuitOpen('The directory failed too often lately')
+    if not is_pool(ldap_connection):
+        while getattr(ldap_connection, _IN_USE, False):
+            yield None
+        setattr(ldap_connection, _IN_USE, True)
+        raise Return(ldap_connection)
+    started_at = time.time()
+    while True:
+        try:
+            conn = ldap_connection.get(block=False)
+        except PoolTimeout:
+            if (ldap_connection.timeout is not None and
+                time.time() - started_at >= ldap_connection.timeout):
+                error = PoolTimeout('No LDAP connection available after %s '
+                                    'seconds' % ldap_connection.timeout)
+                if breaker is not None:
+                    breaker.failure()
+                raise error
+            yield None
+        except Exception, exc:
+            if breaker is not None:
+                breaker.record(exc)
+            raise
+        else:
+            raise Return(conn)
+
+
+def release(ldap_connection, conn, error=None, breaker=None):
+    """
+    Return C{conn}, obtained with L{acquire}, to C{ldap_connection}.
+
+    @param error: The C{ldap.LDAPError} the operations ended with, if any.
+    @param breaker: The circuit breaker given to L{acquire}, if any.
+
+    """
+    discard = isinstance(error, (ldap.SERVER_DOWN, ldap.TIMEOUT))
+    if is_pool(ldap_connection):
+        ldap_connection.put(conn, discard)
+    else:
+        if isinstance(error, ldap.SERVER_DOWN):
+            forget_bind(conn)
+        setattr(conn, _IN_USE, False)
+    if breaker is not None:
+        breaker.record(error)
+
+
+def ensure_bound_async(conn, who, cred, timeout=None):
+    """Coroutine version of L{repoze.who.plugins.shibboleth.pool.ensure_bound}."""
+    if is_bound(conn, who, cred):
+        raise Return()
+    forget_bind(conn)
+    yield Wait(conn, conn.simple_bind(who, cred), timeout)
+    mark_bound(conn, who, cred)
+
+
+def bind_user_async(conn, who, cred, timeout=None):
+    """Coroutine version of L{repoze.who.plugins.shibboleth.pool.bind_user}."""
+    forget_bind(conn)
+    yield Wait(conn, conn.simple_bind(who, cred), timeout)
+    mark_bound(conn, who, None)
+
+
+def bind_service_async(conn, who, cred, timeout=None, metrics=None):
+    """
+    Coroutine version of
+    L{repoze.who.plugins.shibboleth.plugins.bind_service}.
+
+    """
+    if is_bound(conn, who, cred):
+        raise Return()
+    with timed(metrics, 'service_bind', conn):
+        yield ensure_bound_async(conn, who, cred, timeout)
+
+
+#{ Authenticators
+
+
+class AsyncAuthenticatorMixin(object):
+    """
+    Provides the coroutine version of C{authenticate}; the class using it
+    must implement the C{_async_get_dn} coroutine.
+
+    """
+
+    def async_authenticate(self, environ, identity):
+        """
+        Coroutine returning the naming identifier of the user to be
+        authenticated, like C{authenticate}.
+
+        """
+        with timed_call(self.metrics, 'authenticate'):
+            userid = yield self._async_authenticate(environ, identity)
+        raise Return(userid)
+
+    def _async_authenticate(self, environ, identity):
+        try:
+            dn = yield self._async_get_dn(environ, identity)
+            password = identity['password']
+        except (KeyError, TypeError, ValueError):
+            raise Return(None)
+
+        known = self._known_credentials(environ, dn, password)
+        if known is not None:
+            raise Return(known and self._authenticated(identity, dn) or None)
+
+        try:
+            conn = yield acquire(self.bind_connection, self.circuit_breaker)
+        except ldap.LDAPError:
+            raise Return(None)
+        error = None
+        try:
+            try:
+                with timed(self.metrics, 'bind', conn):
+                    yield bind_user_async(conn, dn, password,
+                                          self.operation_timeout)
+            except ldap.LDAPError, error:
+                self._verified(environ, dn, password, error)
+                raise Return(None)
+        finally:
+            release(self.bind_connection, conn, error, self.circuit_breaker)
+
+        self._verified(environ, dn, password)
+        raise Return(self._authenticated(identity, dn))
+
+    def _async_bind_service(self, conn):
+        """Coroutine binding C{conn} as the service account, if any."""
+        if self.bind_dn:
+            yield bind_service_async(conn, self.bind_dn, self.bind_pass,
+                                     self.operation_timeout, self.metrics)
+
+
+class AsyncShibbolethAuthenticatorPlugin(AsyncAuthenticatorMixin,
+                                         ShibbolethAuthenticatorPlugin):
+    """L{ShibbolethAuthenticatorPlugin} with a coroutine C{authenticate}."""
+
+    def _async_get_dn(self, environ, identity):
+        """Coroutine version of C{_get_dn}."""
+        if self.bind_dn:
+            try:
+                conn = yield acquire(self.ldap_connection,
+                                     self.circuit_breaker)
+            except ldap.LDAPError:
+                raise ValueError("Couldn't bind with supplied credentials")
+            error = None
+            try:
+                try:
+                    yield self._async_bind_service(conn)
+                except ldap.LDAPError, error:
+                    raise ValueError("Couldn't bind with supplied "
+                                     "credentials")
+            finally:
+                release(self.ldap_connection, conn, error,
+                        self.circuit_breaker)
+        try:
+            raise Return(self.naming_pattern % (identity['login'],
+                                                self.base_dn))
+        except (KeyError, TypeError):
+            raise ValueError
+
+
+class AsyncShibbolethSearchAuthenticatorPlugin(
+        AsyncAuthenticatorMixin, ShibbolethSearchAuthenticatorPlugin):
+    """
+    L{ShibbolethSearchAuthenticatorPlugin} with a coroutine C{authenticate}.
+
+    """
+
+    def _async_get_dn(self, environ, identity):
+        """Coroutine version of C{_get_dn}."""
+        dn = self._cached_dn(environ, identity) or \
+             self._mirrored_dn(identity)
+        if dn is not None:
+            raise Return(dn)
+
+        srch = self._search_filter(identity)
+        try:
+            conn = yield acquire(self.ldap_connection, self.circuit_breaker)
+        except ldap.LDAPError, msg:
+            raise ValueError('Cannot search for %s: %s' % (srch, msg))
+        error = None
+        try:
+            try:
+                yield self._async_bind_service(conn)
+                msgid = conn.search_ext(self.base_dn, self.search_scope, srch,
+                                        attrlist=self.fetch_attributes or
+                                                 ['1.1'],
+                                        sizelimit=2)
+                try:
+                    with timed(self.metrics, 'search', conn):
+                        rtype, results = yield Wait(conn, msgid,
+                                                    self.operation_timeout)
+                except ldap.SIZELIMIT_EXCEEDED:
+                    entries = [None, None]
+                else:
+                    entries = entries_only(results)
+            except ldap.LDAPError, error:
+                raise ValueError('Cannot search for %s: %s' % (srch, error))
+        finally:
+            release(self.ldap_connection, conn, error, self.circuit_breaker)
+        raise Return(self._pick_dn(environ, identity, srch, entries))
+
+
+#{ Metadata providers
+
+
+class AsyncShibbolethAttributesPlugin(ShibbolethAttributesPlugin):
+    """L{ShibbolethAttributesPlugin} with a coroutine C{add_metadata}."""
+
+    def async_add_metadata(self, environ, identity):
+        """Coroutine adding metadata to the identity, like C{add_metadata}."""
+        with timed_call(self.metrics, 'add_metadata'):
+            yield self._async_add_metadata(environ, identity)
+
+    def _async_add_metadata(self, environ, identity):
+        if self.lazy_key:
+            # The attributes are fetched synchronously when they are used.
+            self._add_lazy_metadata(environ, identity)
+            raise Return()
+        dn = self._user_dn(identity)
+        released = self._released(environ, identity)
+        if self._all_released(released):
+            self._update_identity(identity, released)
+            raise Return()
+        attributes = self._snapshot(identity, dn)
+        if attributes is None:
+            attributes = self._known_attributes(environ, dn)
+            if attributes is None:
+                try:
+                    attributes = yield self._async_search(environ, identity,
+                                                          dn)
+                except CircuitOpen:
+                    self._update_identity(identity, released)
+                    raise Return()
+                self._found_attributes(environ, dn, attributes)
+            self._take_snapshot(identity, dn, attributes)
+        self._update_identity(identity,
+                              self._with_released(attributes, released))
+
+    def _async_search(self, environ, identity, dn):
+        """Coroutine version of C{_search}."""
+        try:
+            conn = yield acquire(self.ldap_connection, self.circuit_breaker)
+        except CircuitOpen:
+            raise
+        except ldap.LDAPError, msg:
+            environ['repoze.who.logger'].warn('Cannot add metadata: %s' % msg)
+            raise AttributesUnavailable(identity)
+        error = None
+        try:
+            try:
+                if self.bind_dn:
+                    yield bind_service_async(conn, self.bind_dn,
+                                             self.bind_pass,
+                                             self.operation_timeout,
+                                             self.metrics)
+                msgid = conn.search_ext(dn, ldap.SCOPE_BASE, self.filterstr,
+                                        attrlist=self.attributes)
+                with timed(self.metrics, 'search', conn):
+                    rtype, results = yield Wait(conn, msgid,
+                                                self.operation_timeout)
+            except ldap.LDAPError, error:
+                environ['repoze.who.logger'].warn('Cannot add metadata: %s' %
+                                                  error)
+                raise AttributesUnavailable(identity)
+        finally:
+            release(self.ldap_connection, conn, error, self.circuit_breaker)
+        raise Return(results[0][1])
+
+
+#}
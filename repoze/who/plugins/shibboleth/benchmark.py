@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+#
+# repoze.who.plugins.shibboleth, Shibboleth authentication for WSGI applications.
+# Copyright (C) 2010 by Ralph Bean <http://threebean.wordpress.com/>
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+"""
+Throughput and latency benchmarks of the plugins.
+
+The plugins are run by several threads against the fake directory of the
+test suite, made slower by L{LatencyConnection}, and the number of calls per
+second and their percentiles are reported. Run it as::
+
+    python -m repoze.who.plugins.shibboleth.benchmark --threads 1,4,16
+
+and see C{--help} for the options. It needs the test dependencies
+(C{dataflake.ldapconnection}), which are only imported when the fake
+directory is used, so that this module can be imported without them.
+
+"""
+
+__all__ = ['LatencyConnection', 'populate', 'benchmark', 'Result', 'main']
+
+import base64
+import hashlib
+import random
+import sys
+import threading
+import time
+
+from functools import partial
+from optparse import OptionParser
+
+import ldap
+from ldap import modlist
+
+from repoze.who.plugins.shibboleth.plugins import \
+        ShibbolethAuthenticatorPlugin, ShibbolethSearchAuthenticatorPlugin, \
+        ShibbolethAttributesPlugin
+from repoze.who.plugins.shibboleth.pool import LDAPConnectionPool
+
+
+BASE_DN = 'ou=people,dc=example,dc=org'
+
+
+#{ Fake directory
+
+
+def _fakeldap():
+    """Return the fake directory of C{dataflake.ldapconnection}."""
+    try:
+        from dataflake.ldapconnection.tests import fakeldap
+    except ImportError:
+        raise ImportError('The benchmarks need the test dependencies: '
+                          'easy_install dataflake.ldapconnection')
+    return fakeldap
+
+
+class LatencyConnection(object):
+    """
+    Connection to the fake directory whose operations take some time, like
+    those sent to a real server.
+
+    Like the connections of python-ldap, it performs one operation at a
+    time: The threads sharing it wait for their turn.
+
+    """
+
+    def __init__(self, bind_latency=0.002, search_latency=0.002, jitter=0.2,
+                 *args, **kwargs):
+        """
+        @param bind_latency: How many seconds each bind takes on average.
+        @type bind_latency: C{float}
+        @param search_latency: How many seconds each search takes on
+            average.
+        @type search_latency: C{float}
+        @param jitter: The fraction of the latency by which each operation
+            is randomly made shorter or longer.
+        @type jitter: C{float}
+
+        The other arguments are those of the fake connection.
+
+        """
+        # The fake checks the passwords with a search of its own, which
+        # must not be delayed (nor locked) again; so it's wrapped rather
+        # than subclassed:
+        self._conn = _fakeldap().FakeLDAPConnection(*args, **kwargs)
+        self.bind_latency = bind_latency
+        self.search_latency = search_latency
+        self.jitter = jitter
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name == '_conn':
+            raise AttributeError(name)
+        return getattr(self._conn, name)
+
+    def _wait(self, latency):
+        if latency:
+            time.sleep(latency * (1 + random.uniform(-self.jitter,
+                                                     self.jitter)))
+
+    def simple_bind_s(self, who, cred):
+        self._lock.acquire()
+        try:
+            self._wait(self.bind_latency)
+            return self._conn.simple_bind_s(who, cred)
+        finally:
+            self._lock.release()
+
+    def search_s(self, *args, **kwargs):
+        self._lock.acquire()
+        try:
+            self._wait(self.search_latency)
+            return self._conn.search_s(*args, **kwargs)
+        finally:
+            self._lock.release()
+
+    def search_ext_s(self, base, scope, filterstr='(objectClass=*)',
+                     attrlist=None, attrsonly=0, serverctrls=None,
+                     clientctrls=None, timeout=-1, sizelimit=0):
+        results = self.search_s(base, scope, filterstr, attrlist)
+        if sizelimit and len(results) > sizelimit:
+            raise ldap.SIZELIMIT_EXCEEDED()
+        return results
+
+    def unbind_s(self):
+        pass
+
+
+def populate(users=100):
+    """
+    Add C{users} entries to the fake directory, below L{BASE_DN}.
+
+    The login of the Nth user is C{userN} and their password C{secretN}.
+
+    """
+    fakeldap = _fakeldap()
+    conn = fakeldap.FakeLDAPConnection()
+    conn.simple_bind_s('Manager', 'some password')
+    fakeldap.addTreeItems(BASE_DN)
+    for number in range(users):
+        login = 'user%d' % number
+        password = '{SHA}%s' % base64.encodestring(
+            hashlib.sha1('secret%d' % number).digest()).strip()
+        entry = {'uid': login,
+                 'cn': ['User %d' % number],
+                 'mail': ['%s@example.org' % login],
+                 'userPassword': [password]}
+        try:
+            conn.add_s('uid=%s,%s' % (login, BASE_DN),
+                       modlist.addModlist(entry))
+        except ldap.ALREADY_EXISTS:
+            pass
+
+
+#{ Scenarios
+
+
+#: The plugins to benchmark, with the method called on them.
+PLUGINS = {
+    'pattern': (ShibbolethAuthenticatorPlugin, 'authenticate'),
+    'search': (ShibbolethSearchAuthenticatorPlugin, 'authenticate'),
+    'attributes': (ShibbolethAttributesPlugin, 'add_metadata'),
+    }
+
+#: The ways to set them up: whether to use a pool and whether to cache.
+CONFIGS = ('shared', 'pooled', 'cached')
+
+
+def make_plugin(plugin, config, factory, pool_size=8):
+    """
+    Return the plugin called C{plugin} in L{PLUGINS}, set up as C{config}.
+
+    @param factory: The callable returning new connections.
+
+    """
+    if config == 'shared':
+        connection = factory()
+    else:
+        connection = LDAPConnectionPool(factory, max_size=pool_size)
+    options = {}
+    plugin_class = PLUGINS[plugin][0]
+    if plugin_class is ShibbolethAttributesPlugin:
+        if config == 'cached':
+            options['cache_ttl'] = 300
+        return plugin_class(connection, 'cn,mail', **options)
+    if config == 'cached':
+        options['credentials_cache_ttl'] = 300
+        if plugin_class is ShibbolethSearchAuthenticatorPlugin:
+            options['dn_cache_ttl'] = 300
+    return plugin_class(connection, BASE_DN, **options)
+
+
+def _request(plugin, number):
+    """Return the arguments of a call for the Nth user."""
+    login = 'user%d' % number
+    if isinstance(plugin, ShibbolethAttributesPlugin):
+        return ({}, {'repoze.who.userid': 'uid=%s,%s' % (login, BASE_DN)})
+    return ({}, {'login': login, 'password': 'secret%d' % number})
+
+
+class Result(object):
+    """The outcome of a benchmark."""
+
+    def __init__(self, latencies, errors, elapsed):
+        """
+        @param latencies: How many seconds each call took.
+        @type latencies: C{list}
+        @param errors: How many calls failed.
+        @type errors: C{int}
+        @param elapsed: How many seconds the whole benchmark took.
+        @type elapsed: C{float}
+
+        """
+        self.latencies = sorted(latencies)
+        self.errors = errors
+        self.elapsed = elapsed
+
+    @property
+    def throughput(self):
+        """The number of calls per second."""
+        if not self.elapsed:
+            return None
+        return len(self.latencies) / self.elapsed
+
+    def percentile(self, percent):
+        """Return the C{percent}th percentile of the latencies, in seconds."""
+        if not self.latencies:
+            return None
+        rank = int(round(percent / 100.0 * len(self.latencies))) - 1
+        return self.latencies[min(max(rank, 0), len(self.latencies) - 1)]
+
+
+def benchmark(plugin, threads=1, requests=100, users=100):
+    """
+    Call C{plugin} from C{threads} threads, C{requests} times each.
+
+    @param plugin: A plugin returned by L{make_plugin}.
+    @param users: How many of the users added by L{populate} to spread the
+        calls over.
+    @rtype: L{Result}
+
+    """
+    method = getattr(plugin, (isinstance(plugin, ShibbolethAttributesPlugin)
+                              and 'add_metadata' or 'authenticate'))
+    latencies = []
+    errors = []
+    start = threading.Event()
+
+    def run(seed):
+        chooser = random.Random(seed)
+        mine = []
+        failed = 0
+        start.wait()
+        for i in range(requests):
+            environ, identity = _request(plugin, chooser.randrange(users))
+            started_at = time.time()
+            try:
+                outcome = method(environ, identity)
+            except Exception:
+                failed += 1
+            else:
+                if outcome is None and 'login' in identity:
+                    failed += 1
+            mine.append(time.time() - started_at)
+        latencies.extend(mine)
+        errors.append(failed)
+
+    workers = [threading.Thread(target=run, args=(seed,))
+               for seed in range(threads)]
+    for worker in workers:
+        worker.start()
+    started_at = time.time()
+    start.set()
+    for worker in workers:
+        worker.join()
+    return Result(latencies, sum(errors), time.time() - started_at)
+
+
+#{ Command line
+
+
+def main(argv=None):
+    """Run the benchmarks selected on the command line and print a table."""
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--plugins', default=','.join(sorted(PLUGINS)),
+                      help='the plugins to run, among %s' %
+                           ', '.join(sorted(PLUGINS)))
+    parser.add_option('--configs', default=','.join(CONFIGS),
+                      help='the setups to run, among %s' % ', '.join(CONFIGS))
+    parser.add_option('--threads', default='1,4,16',
+                      help='the numbers of threads to run')
+    parser.add_option('--requests', type='int', default=200,
+                      help='the number of calls per thread')
+    parser.add_option('--users', type='int', default=100,
+                      help='the number of users in the directory')
+    parser.add_option('--pool-size', type='int', default=8,
+                      help='the size of the connection pools')
+    parser.add_option('--bind-latency', type='float', default=2,
+                      help='the latency of the binds, in milliseconds')
+    parser.add_option('--search-latency', type='float', default=2,
+                      help='the latency of the searches, in milliseconds')
+    parser.add_option('--jitter', type='float', default=0.2,
+                      help='the fraction of the latencies randomly added or '
+                           'removed')
+    options, args = parser.parse_args(argv)
+
+    populate(options.users)
+    factory = partial(LatencyConnection, options.bind_latency / 1000.0,
+                      options.search_latency / 1000.0, options.jitter)
+    print '%-10s %-7s %7s %9s %8s %8s %8s %6s' % (
+        'plugin', 'config', 'threads', 'calls/s', 'p50 ms', 'p95 ms',
+        'p99 ms', 'errors')
+    for name in options.plugins.split(','):
+        for config in options.configs.split(','):
+            for threads in options.threads.split(','):
+                plugin = make_plugin(name, config, factory, options.pool_size)
+                result = benchmark(plugin, int(threads), options.requests,
+                                   options.users)
+                print '%-10s %-7s %7s %9.1f %8.2f %8.2f %8.2f %6d' % (
+                    name, config, threads, result.throughput,
+                    result.percentile(50) * 1000,
+                    result.percentile(95) * 1000,
+                    result.percentile(99) * 1000, result.errors)
+                sys.stdout.flush()
+
+
+#}
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+#
+# repoze.who.plugins.shibboleth, Shibboleth authentication for WSGI applications.
+# Copyright (C) 2010 by Ralph Bean <http://threebean.wordpress.com/>
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+"""Failing fast while the directory server is unavailable."""
+
+__all__ = ['CircuitBreaker', 'CircuitOpen', 'make_breaker', 'is_failure']
+
+import threading
+import time
+
+from contextlib import contextmanager
+
+import ldap
+
+from repoze.who.plugins.shibboleth.pool import PoolTimeout
+
+
+#: The errors telling that the directory is unavailable, as opposed to the
+#: ones it answers with (e.g., invalid credentials).
+FAILURES = (ldap.SERVER_DOWN, ldap.TIMEOUT, ldap.TIMELIMIT_EXCEEDED,
+            ldap.CONNECT_ERROR, ldap.BUSY, ldap.UNAVAILABLE, PoolTimeout)
+
+
+class CircuitOpen(ldap.LDAPError):
+    """The directory is not contacted because it failed too often lately."""
+
+
+class CircuitBreaker(object):
+    """
+    Stops contacting the directory after too many consecutive failures.
+
+    The circuit is I{closed} while the directory works. After C{threshold}
+    consecutive failures it I{opens}: every operation is then refused right
+    away for C{reset_timeout} seconds. After that, the circuit is
+    I{half-open}: a single operation is let through as a probe, and the
+    circuit closes if it succeeds or opens again if it fails.
+
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        """
+        Create a closed circuit breaker.
+
+        @param threshold: How many consecutive failures open the circuit.
+        @type threshold: C{int}
+        @param reset_timeout: How many seconds the circuit stays open before
+            a probe is let through.
+        @type reset_timeout: C{float}
+        @raise ValueError: If the arguments are out of range.
+
+        """
+        self.threshold = int(threshold)
+        self.reset_timeout = float(reset_timeout)
+        if self.threshold < 1 or self.reset_timeout < 0:
+            raise ValueError('The circuit breaker needs threshold >= 1 and '
+                             'reset_timeout >= 0')
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        """The state of the circuit: L{CLOSED}, L{OPEN} or L{HALF_OPEN}."""
+        self._lock.acquire()
+        try:
+            if (self._state == self.OPEN and
+                time.time() >= self._opened_at + self.reset_timeout):
+                return self.HALF_OPEN
+            return self._state
+        finally:
+            self._lock.release()
+
+    def allow(self):
+        """
+        Tell whether the directory may be contacted now.
+
+        Once the circuit is half-open, C{True} is returned to a single
+        caller until its outcome is recorded; whoever is told so must call
+        L{success} or L{failure} afterwards.
+
+        @rtype: C{bool}
+
+        """
+        self._lock.acquire()
+        try:
+            if self._state == self.CLOSED:
+                return True
+            if (self._state == self.OPEN and
+                time.time() >= self._opened_at + self.reset_timeout):
+                self._state = self.HALF_OPEN
+            if self._state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+        finally:
+            self._lock.release()
+
+    def success(self):
+        """Record that the directory answered."""
+        self._lock.acquire()
+        try:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probing = False
+        finally:
+            self._lock.release()
+
+    def failure(self):
+        """Record that the directory could not be used."""
+        self._lock.acquire()
+        try:
+            self._failures += 1
+            if (self._state == self.HALF_OPEN or
+                self._failures >= self.threshold):
+                self._state = self.OPEN
+                self._opened_at = time.time()
+            self._probing = False
+        finally:
+            self._lock.release()
+
+    def record(self, error=None):
+        """
+        Record the outcome of an operation which ended with C{error}, or
+        which succeeded if it's C{None}.
+
+        """
+        if is_failure(error):
+            self.failure()
+        else:
+            self.success()
+
+    @contextmanager
+    def guard(self):
+        """
+        Record the outcome of the operation in a C{with} block.
+
+        @raise CircuitOpen: If the directory may not be contacted now.
+
+        """
+        if not self.allow():
+            raise CircuitOpen('The directory failed too often lately')
+        try:
+            yield
+        except Exception, exc:
+            self.record(exc)
+            raise
+        except:
+            self.success()
+            raise
+        else:
+            self.success()
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.state)
+
+
+def is_failure(error):
+    """Tell whether C{error} means that the directory is unavailable."""
+    return isinstance(error, FAILURES)
+
+
+def make_breaker(circuit_breaker=None, threshold=None, reset_timeout=30):
+    """
+    Return the circuit breaker to be used by a plugin, if any.
+
+    @param circuit_breaker: A circuit breaker to use as is, e.g. to share it
+        between the plugins using the same directory.
+    @param threshold: If no C{circuit_breaker} is given, create a
+        L{CircuitBreaker} with this C{threshold}; no circuit breaker is used
+        unless it's set.
+    @param reset_timeout: The C{reset_timeout} of the new circuit breaker.
+    @return: The circuit breaker, or C{None} if it's disabled.
+
+    """
+    if circuit_breaker is not None:
+        return circuit_breaker
+    if threshold is None or threshold == '':
+        return None
+    return CircuitBreaker(threshold, reset_timeout)
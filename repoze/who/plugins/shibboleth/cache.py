@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+#
+# repoze.who.plugins.shibboleth, Shibboleth authentication for WSGI applications.
+# Copyright (C) 2010 by Ralph Bean <http://threebean.wordpress.com/>
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+"""
+Caches for the results of directory lookups.
+
+The plugins accept any cache object with the C{get(key, default=None)},
+C{set(key, value, ttl=None)}, C{delete(key)} and C{clear()} methods of
+L{TTLCache}, which is kept in the memory of each process. L{SQLiteCache} is
+kept in a file instead, so that all the processes of a host share it.
+
+"""
+
+__all__ = ['TTLCache', 'SQLiteCache', 'CredentialsCache', 'make_cache',
+           'sizeof']
+
+import cPickle as pickle
+import hashlib
+import hmac
+import logging
+import os
+import random
+import sqlite3
+import stat
+import threading
+import time
+
+from collections import OrderedDict
+
+
+log = logging.getLogger(__name__)
+
+
+class TTLCache(object):
+    """
+    A bounded, thread-safe LRU cache whose entries expire after a while.
+
+    The cache can be bounded both in number of entries and in (approximate)
+    memory used by the values.
+
+    """
+
+    def __init__(self, max_size=1000, ttl=300, jitter=0.1, max_bytes=None):
+        """
+        Create an empty cache.
+
+        All the arguments may be given as strings, so that the cache can be
+        configured from an INI file.
+
+        @param max_size: How many entries to keep at most; the least
+            recently used ones are dropped first.
+        @type max_size: C{int}
+        @param ttl: How many seconds an entry is valid for.
+        @type ttl: C{float}
+        @param jitter: The fraction of C{ttl} by which the lifetime of each
+            entry is randomly shortened or lengthened, so that entries added
+            at the same time don't all expire at once.
+        @type jitter: C{float}
+        @param max_bytes: How many bytes of strings the cached values may
+            hold in total, as estimated by L{sizeof}, or C{None} for no
+            limit. Values bigger than that are not cached at all.
+        @type max_bytes: C{int}
+        @raise ValueError: If the arguments are out of range.
+
+        """
+        self.max_size = int(max_size)
+        self.ttl = float(ttl)
+        self.jitter = float(jitter)
+        if self.max_size < 1 or self.ttl < 0 or not 0 <= self.jitter < 1:
+            raise ValueError('The cache needs max_size >= 1, ttl >= 0 and '
+                             '0 <= jitter < 1')
+        if max_bytes is not None:
+            max_bytes = int(max_bytes)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # key -> (value, expires_at, size), least recently used first:
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def _lifetime(self, ttl):
+        if ttl is None:
+            ttl = self.ttl
+        if self.jitter:
+            ttl *= 1 + random.uniform(-self.jitter, self.jitter)
+        return ttl
+
+    def get(self, key, default=None):
+        """
+        Return the value cached for C{key}, or C{default} if there's none or
+        it expired.
+
+        """
+        self._lock.acquire()
+        try:
+            try:
+                entry = self._entries.pop(key)
+            except KeyError:
+                return default
+            if entry[1] <= time.time():
+                self._bytes -= entry[2]
+                return default
+            # Moving it back to the most recently used end:
+            self._entries[key] = entry
+            return entry[0]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, ttl=None):
+        """
+        Cache C{value} for C{key}.
+
+        @param ttl: How many seconds this entry is valid for, if it's not the
+            default of the cache.
+
+        """
+        expires_at = time.time() + self._lifetime(ttl)
+        if self.max_bytes is None:
+            size = 0
+        else:
+            size = sizeof(value)
+        self._lock.acquire()
+        try:
+            self._pop(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._entries[key] = (value, expires_at, size)
+            self._bytes += size
+            while (len(self._entries) > self.max_size or
+                   (self.max_bytes is not None and
+                    self._bytes > self.max_bytes)):
+                self._bytes -= self._entries.popitem(last=False)[1][2]
+        finally:
+            self._lock.release()
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def delete(self, key):
+        """Forget the value cached for C{key}, if any."""
+        self._lock.acquire()
+        try:
+            self._pop(key)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Forget all the cached values."""
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._bytes = 0
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return '<%s %d/%d>' % (self.__class__.__name__, len(self._entries),
+                               self.max_size)
+
+
+class SQLiteCache(object):
+    """
+    A cache kept in an SQLite database, shared by all the processes (e.g.,
+    the prefork workers of a server) which open the same file.
+
+    Several caches may be kept in the same file under different
+    C{namespace}s. When there are more than C{max_size} entries in a
+    namespace, the expired ones are dropped, then those closest to expiring.
+
+    @attention: The values are pickled, so the file must only be writable by
+        the user running the application; it's created with such
+        permissions, and refused if it's owned by another user or writable
+        by others.
+
+    """
+
+    def __init__(self, path, namespace='cache', max_size=10000, ttl=300,
+                 jitter=0.1, timeout=5):
+        """
+        Open the cache in the database at C{path}, creating it if needed.
+
+        All the arguments may be given as strings, so that the cache can be
+        configured from an INI file.
+
+        @param path: The path to the database file.
+        @type path: C{str}
+        @param namespace: The name of this cache among those in the file.
+        @type namespace: C{str}
+        @param max_size: How many entries to keep at most.
+        @type max_size: C{int}
+        @param ttl: See L{TTLCache.__init__}.
+        @param jitter: See L{TTLCache.__init__}.
+        @param timeout: How many seconds to wait for the other processes to
+            release the database when it's locked; the lookups and additions
+            are skipped after that.
+        @type timeout: C{float}
+        @raise ValueError: If the arguments are out of range, or the file is
+            not private to this user.
+
+        """
+        self.path = path
+        self.namespace = namespace
+        self.max_size = int(max_size)
+        self.ttl = float(ttl)
+        self.jitter = float(jitter)
+        self.timeout = float(timeout)
+        if self.max_size < 1 or self.ttl < 0 or not 0 <= self.jitter < 1:
+            raise ValueError('The cache needs max_size >= 1, ttl >= 0 and '
+                             '0 <= jitter < 1')
+        # The old entries are dropped every so many additions:
+        self.purge_interval = max(1, self.max_size // 10)
+        self._local = threading.local()
+        self._additions = 0
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            status = os.fstat(fd)
+        finally:
+            os.close(fd)
+        if (status.st_uid != os.getuid() or
+            status.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+            raise ValueError('The cache %s must be owned by this user and '
+                             'writable by no one else' % path)
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS entries (namespace TEXT, key BLOB, '
+            'value BLOB, expires_at REAL, PRIMARY KEY (namespace, key))')
+
+    def _connection(self):
+        """
+        Return the connection to the database of this thread.
+
+        SQLite connections can't be shared between threads, nor between
+        processes, so a new one is opened after a fork.
+
+        """
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None)
+            try:
+                conn.execute('PRAGMA journal_mode=WAL')
+            except sqlite3.DatabaseError:
+                # Some file systems don't support it; locking still works.
+                pass
+            self._local.conn = conn
+            self._local.pid = pid
+        return self._local.conn
+
+    def _key(self, key):
+        return sqlite3.Binary(pickle.dumps(key, 2))
+
+    def _lifetime(self, ttl):
+        if ttl is None:
+            ttl = self.ttl
+        if self.jitter:
+            ttl *= 1 + random.uniform(-self.jitter, self.jitter)
+        return ttl
+
+    def get(self, key, default=None):
+        """
+        Return the value cached for C{key}, or C{default} if there's none, it
+        expired or the database is locked.
+
+        """
+        try:
+            row = self._connection().execute(
+                'SELECT value, expires_at FROM entries WHERE namespace = ? '
+                'AND key = ?', (self.namespace, self._key(key))).fetchone()
+        except sqlite3.OperationalError:
+            return default
+        if row is None or row[1] <= time.time():
+            return default
+        return pickle.loads(str(row[0]))
+
+    def set(self, key, value, ttl=None):
+        """
+        Cache C{value} for C{key}, unless the database is locked.
+
+        @param ttl: See L{TTLCache.set}.
+
+        """
+        expires_at = time.time() + self._lifetime(ttl)
+        value = sqlite3.Binary(pickle.dumps(value, 2))
+        try:
+            self._connection().execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                (self.namespace, self._key(key), value, expires_at))
+            self._additions += 1
+            if not self._additions % self.purge_interval:
+                self.purge()
+        except sqlite3.OperationalError:
+            pass
+
+    def purge(self):
+        """Drop the expired entries, and the oldest ones beyond C{max_size}."""
+        conn = self._connection()
+        conn.execute('DELETE FROM entries WHERE namespace = ? AND '
+                     'expires_at <= ?', (self.namespace, time.time()))
+        conn.execute('DELETE FROM entries WHERE rowid IN (SELECT rowid FROM '
+                     'entries WHERE namespace = ? ORDER BY expires_at DESC '
+                     'LIMIT -1 OFFSET ?)', (self.namespace, self.max_size))
+
+    def delete(self, key):
+        """
+        Forget the value cached for C{key}, if any.
+
+        If the database is locked, the value is left to expire and the
+        failure is logged.
+
+        """
+        try:
+            self._connection().execute(
+                'DELETE FROM entries WHERE namespace = ? AND key = ?',
+                (self.namespace, self._key(key)))
+        except sqlite3.OperationalError, error:
+            log.warning('Cannot delete from the cache %r: %s', self, error)
+
+    def clear(self):
+        """
+        Forget all the values cached in this namespace; see L{delete} when
+        the database is locked.
+
+        """
+        try:
+            self._connection().execute(
+                'DELETE FROM entries WHERE namespace = ?', (self.namespace,))
+        except sqlite3.OperationalError, error:
+            log.warning('Cannot clear the cache %r: %s', self, error)
+
+    def __len__(self):
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM entries WHERE namespace = ? AND '
+            'expires_at > ?', (self.namespace, time.time())).fetchone()[0]
+
+    def __repr__(self):
+        return '<%s %s:%s>' % (self.__class__.__name__, self.path,
+                               self.namespace)
+
+
+class CredentialsCache(object):
+    """
+    Remembers recently verified passwords, so that they don't have to be
+    checked against the directory on every request.
+
+    Only a salted, deliberately slow hash of each password is kept. Every
+    successful check keeps the entry for C{ttl} more seconds, but never
+    longer than C{max_lifetime} seconds after the password was last verified
+    by the directory.
+
+    """
+
+    def __init__(self, ttl=60, max_lifetime=300, max_size=1000,
+                 iterations=10000, cache=None):
+        """
+        Create an empty credentials cache.
+
+        @param ttl: How many seconds an entry stays valid after its last use.
+        @type ttl: C{float}
+        @param max_lifetime: How many seconds an entry stays valid at most.
+        @type max_lifetime: C{float}
+        @param max_size: How many entries to keep at most.
+        @type max_size: C{int}
+        @param iterations: The number of PBKDF2 iterations of the hash.
+        @type iterations: C{int}
+        @param cache: The cache to store the entries in, instead of a new
+            L{TTLCache}.
+        @raise ValueError: If C{max_lifetime} is shorter than C{ttl}.
+
+        """
+        self.ttl = float(ttl)
+        self.max_lifetime = float(max_lifetime)
+        if self.max_lifetime < self.ttl:
+            raise ValueError('The max_lifetime of cached credentials cannot '
+                             'be shorter than their ttl')
+        self.iterations = int(iterations)
+        if cache is None:
+            cache = TTLCache(max_size=max_size, ttl=self.ttl, jitter=0)
+        self.cache = cache
+
+    def _hash(self, password, salt):
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
+        return hashlib.pbkdf2_hmac('sha256', password, salt, self.iterations)
+
+    def check(self, dn, password):
+        """
+        Tell whether C{password} was recently verified for C{dn}.
+
+        @rtype: C{bool}
+
+        """
+        key = ('credentials', dn)
+        entry = self.cache.get(key)
+        if entry is None:
+            return False
+        salt, digest, verified_at = entry
+        if not hmac.compare_digest(self._hash(password, salt), digest):
+            return False
+        remaining = verified_at + self.max_lifetime - time.time()
+        if remaining <= 0:
+            self.cache.delete(key)
+            return False
+        self.cache.set(key, entry, ttl=min(self.ttl, remaining))
+        return True
+
+    def remember(self, dn, password):
+        """Record that the directory just verified C{password} for C{dn}."""
+        salt = os.urandom(16)
+        self.cache.set(('credentials', dn),
+                       (salt, self._hash(password, salt), time.time()))
+
+    def forget(self, dn):
+        """Forget the password remembered for C{dn}, if any."""
+        self.cache.delete(('credentials', dn))
+
+
+def sizeof(value):
+    """
+    Estimate the memory held by C{value}, counting only the lengths of the
+    strings in it: That's what dominates in directory entries.
+
+    """
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, dict):
+        return sum([sizeof(k) + sizeof(v) for (k, v) in value.iteritems()])
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sum([sizeof(item) for item in value])
+    return 0
+
+
+def make_cache(cache=None, ttl=None, max_size=1000, jitter=0.1,
+               max_bytes=None, path=None, namespace='cache'):
+    """
+    Return the cache to be used by a plugin, if any.
+
+    @param cache: A cache object to use as is.
+    @param ttl: If no C{cache} is given, create a L{TTLCache} with this
+        C{ttl}; no cache is used unless it's set.
+    @param max_size: The C{max_size} of the new cache.
+    @param jitter: The C{jitter} of the new cache.
+    @param max_bytes: The C{max_bytes} of the new cache, if it's a
+        L{TTLCache}.
+    @param path: If set, create a L{SQLiteCache} in this file instead of a
+        L{TTLCache}.
+    @param namespace: The C{namespace} of the new L{SQLiteCache}.
+    @return: The cache, or C{None} if caching is disabled.
+
+    """
+    if cache is not None:
+        return cache
+    if ttl is None or ttl == '':
+        return None
+    if path:
+        return SQLiteCache(path, namespace, max_size=max_size, ttl=ttl,
+                           jitter=jitter)
+    return TTLCache(max_size=max_size, ttl=ttl, jitter=jitter,
+                    max_bytes=max_bytes)
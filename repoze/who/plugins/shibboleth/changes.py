@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+#
+# repoze.who.plugins.shibboleth, Shibboleth authentication for WSGI applications.
+# Copyright (C) 2010 by Ralph Bean <http://threebean.wordpress.com/>
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+"""Finding out about the entries changed in the directory, to uncache them."""
+
+__all__ = ['ChangeFeed', 'make_change_feed', 'parse_stamp']
+
+import calendar
+import logging
+import re
+import threading
+import time
+
+import ldap
+
+from repoze.who.plugins.shibboleth.pool import (checkout, ensure_bound,
+                                                 is_pool, paged_search)
+
+
+log = logging.getLogger(__name__)
+
+
+#: How the watermarks are formatted with C{time.strftime}, per attribute.
+WATERMARK_FORMATS = {
+    'modifytimestamp': '%Y%m%d%H%M%SZ',
+    'entrycsn': '%Y%m%d%H%M%S.000000Z#000000#000#000000',
+    }
+
+# A GeneralizedTime, possibly followed by the rest of an entryCSN:
+_STAMP = re.compile(r'^(\d{4})(\d{2})(\d{2})(\d{2})(\d{2})?(\d{2})?'
+                    r'(?:[.,](\d+))?(Z|[+-]\d{2}(?:\d{2})?)(.*)$')
+
+
+class ChangeFeed(object):
+    """
+    Polls the directory for the entries modified lately and tells the
+    listeners about them, e.g. so that the plugins drop what they cached
+    about these entries.
+
+    The entries modified since the previous poll are those whose
+    C{modifyTimestamp} (or C{entryCSN}) is at least the greatest one seen
+    so far, its I{watermark}; the entries modified on the watermark are
+    thus reported twice. The stamps are compared as times (see
+    L{parse_stamp}), whatever their precision and time zone.
+
+    @attention: The deleted entries are not reported: What's cached about
+        them expires as usual.
+    @attention: The directory is polled by a daemon thread, which doesn't
+        survive a C{fork}: Under a preforking server (e.g., gunicorn with
+        C{--preload} or uWSGI without C{lazy-apps}), create and L{start} the
+        feed in each worker once it's forked, instead of before.
+
+    """
+
+    def __init__(self, ldap_connection, base_dn,
+                 search_scope=ldap.SCOPE_SUBTREE, interval=10,
+                 attribute='modifyTimestamp', clock_skew=60, page_size=500,
+                 bind_dn='', bind_pass=''):
+        """
+        Create a change feed starting from now, give or take C{clock_skew}.
+
+        @param ldap_connection: The connection or pool to search with; a
+            connection mustn't be used to bind the users meanwhile, as the
+            changes would be searched as them.
+        @param base_dn: The base of the search.
+        @param search_scope: C{ldap.SCOPE_SUBTREE} or C{ldap.SCOPE_ONELEVEL}.
+        @param interval: How many seconds to wait between the polls.
+        @type interval: C{float}
+        @param attribute: The operational attribute telling when an entry
+            was modified: C{modifyTimestamp} or, on OpenLDAP, C{entryCSN}.
+        @type attribute: C{str}
+        @param clock_skew: How many seconds the clock of the directory
+            server may be behind ours.
+        @type clock_skew: C{float}
+        @param page_size: How many changed entries to request per page, so
+            that a burst of changes doesn't exceed the server's size limit.
+        @type page_size: C{int}
+        @param bind_dn: The service account to search as, if any.
+        @param bind_pass: The password of C{bind_dn}.
+        @raise ValueError: If C{attribute} is not supported.
+
+        """
+        if attribute.lower() not in WATERMARK_FORMATS:
+            raise ValueError('The changes cannot be tracked with %s' %
+                             attribute)
+        self.ldap_connection = ldap_connection
+        self.base_dn = base_dn
+        self.search_scope = search_scope
+        self.interval = float(interval)
+        self.attribute = attribute
+        self.page_size = int(page_size)
+        self.bind_dn = bind_dn
+        self.bind_pass = bind_pass
+        self.watermark = time.strftime(WATERMARK_FORMATS[attribute.lower()],
+                                       time.gmtime(time.time() -
+                                                   float(clock_skew)))
+        self._listeners = []
+        self._attributes = set([attribute])
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        #: The error of the last poll, if it failed.
+        self.last_error = None
+
+    def subscribe(self, listener, attributes=()):
+        """
+        Call C{listener(dn, attributes)} for every entry changed from now on.
+
+        @param attributes: The attributes of the entries the listener needs,
+            such as their naming attribute.
+        @type attributes: C{iterable}
+
+        """
+        self._lock.acquire()
+        try:
+            self._listeners.append(listener)
+            self._attributes.update(attributes)
+        finally:
+            self._lock.release()
+
+    def poll(self):
+        """
+        Tell the listeners about the entries changed since the last poll.
+
+        @return: The number of entries changed.
+        @raise ldap.LDAPError: If the search failed; the same changes are
+            searched again by the next poll.
+
+        """
+        self._lock.acquire()
+        try:
+            listeners = list(self._listeners)
+            attributes = list(self._attributes)
+        finally:
+            self._lock.release()
+        filterstr = '(%s>=%s)' % (self.attribute, self.watermark)
+        with checkout(self.ldap_connection) as conn:
+            if self.bind_dn:
+                ensure_bound(conn, self.bind_dn, self.bind_pass)
+            results = paged_search(conn, self.base_dn, self.search_scope,
+                                   filterstr, attributes, self.page_size)
+        watermark = self.watermark
+        changed = 0
+        for (dn, entry) in results:
+            changed += 1
+            for stamp in self._values(entry, self.attribute):
+                if parse_stamp(stamp) > parse_stamp(watermark):
+                    watermark = stamp
+            for listener in listeners:
+                listener(dn, entry)
+        self.watermark = watermark
+        return changed
+
+    def _values(self, entry, attribute):
+        for (name, values) in entry.iteritems():
+            if name.lower() == attribute.lower():
+                if isinstance(values, basestring):
+                    return [values]
+                return values
+        return []
+
+    def start(self):
+        """
+        Poll the directory in a background thread until L{stop} is called.
+
+        The thread must be started in the process that uses the feed; see
+        the note about the preforking servers above. The failed polls are
+        logged and made again after C{interval} seconds.
+
+        """
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='ChangeFeed')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self._stopped.wait(self.interval)
+            if self._stopped.isSet():
+                return
+            try:
+                self.poll()
+            except ldap.LDAPError, error:
+                log.warning('Cannot poll the changes below %s: %s',
+                            self.base_dn, error)
+                self.last_error = error
+            except Exception, error:
+                # E.g., a failing listener: the changes are polled again.
+                log.exception('Cannot poll the changes below %s',
+                              self.base_dn)
+                self.last_error = error
+            else:
+                self.last_error = None
+
+    def stop(self):
+        """Stop polling the directory."""
+        self._stopped.set()
+        thread, self._thread = self._thread, None
+        if thread is not None and thread is not threading.currentThread():
+            thread.join()
+
+    def __repr__(self):
+        return '<%s %s since %s>' % (self.__class__.__name__, self.base_dn,
+                                     self.watermark)
+
+
+def make_change_feed(change_feed=None, interval=None, ldap_connection=None,
+                     base_dn=None, bind_dn='', bind_pass=''):
+    """
+    Return the change feed to be used by a plugin, if any.
+
+    @param change_feed: A L{ChangeFeed} to use as is, e.g. to share it
+        between the plugins using the same directory.
+    @param interval: If no C{change_feed} is given, create and start a
+        L{ChangeFeed} polling every so many seconds; none is used unless
+        it's set. Its thread is started right away, so the plugins must be
+        created after forking the worker processes, if any.
+    @param ldap_connection: The pool of connections of the new feed; a
+        single connection isn't accepted, since the plugins bind the users
+        on it between the polls.
+    @param base_dn: The base DN of the new feed.
+    @param bind_dn: The service account of the new feed.
+    @param bind_pass: The password of C{bind_dn}.
+    @return: The change feed, or C{None} if it's disabled.
+    @raise ValueError: If a feed must be created without a C{base_dn} or
+        without a pool.
+
+    """
+    if change_feed is not None:
+        return change_feed
+    if not interval:
+        return None
+    if not base_dn:
+        raise ValueError('The changes can only be polled below a base DN')
+    if not is_pool(ldap_connection):
+        raise ValueError('The change feed needs a pool of connections, '
+                         'not to be searched as the users')
+    change_feed = ChangeFeed(ldap_connection, base_dn, interval=interval,
+                             bind_dn=bind_dn, bind_pass=bind_pass)
+    change_feed.start()
+    return change_feed
+
+
+def parse_stamp(stamp):
+    """
+    Return a key ordering the C{modifyTimestamp} or C{entryCSN} values
+    C{stamp} by time, or C{None} if it's not valid.
+
+    The GeneralizedTime values written with a different precision or time
+    zone compare correctly; the rest of the C{entryCSN}s (the change count,
+    server id...) only orders the changes made on the same microsecond.
+
+    """
+    match = _STAMP.match(stamp or '')
+    if match is None:
+        return None
+    (year, month, day, hour, minute, second, fraction, zone,
+     rest) = match.groups()
+    seconds = calendar.timegm((int(year), int(month), int(day), int(hour),
+                               int(minute or 0), int(second or 0), 0, 0, 0))
+    if zone != 'Z':
+        offset = int(zone[1:3]) * 3600 + int(zone[3:5] or 0) * 60
+        if zone[0] == '+':
+            seconds -= offset
+        else:
+            seconds += offset
+    microseconds = int((fraction or '0').ljust(6, '0')[:6])
+    return (seconds, microseconds, rest)
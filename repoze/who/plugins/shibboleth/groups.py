@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+#
+# repoze.who.plugins.shibboleth, Shibboleth authentication for WSGI applications.
+# Copyright (C) 2010 by Ralph Bean <http://threebean.wordpress.com/>
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+"""A local copy of the group memberships, to resolve nested groups."""
+
+__all__ = ['GroupGraph', 'normalize_dn']
+
+import logging
+import threading
+import time
+
+import ldap
+import ldap.dn
+
+from repoze.who.plugins.shibboleth.pool import (checkout, ensure_bound,
+                                                 paged_search)
+
+
+log = logging.getLogger(__name__)
+
+
+#: The default filter of the groups.
+GROUPS_FILTER = ('(|(objectClass=groupOfNames)(objectClass=groupOfUniqueNames)'
+                 '(objectClass=group))')
+
+
+class GroupGraph(object):
+    """
+    Maps the members of the groups, users or groups themselves, to the
+    groups they belong to, from a copy of the groups loaded with a paged
+    search and refreshed periodically in the background.
+
+    The groups an entry belongs to transitively are found by walking the
+    graph up from it. The closure of each group is computed once per load
+    and memoized, so that the users of the same groups share the walk; the
+    cycles in the graph are harmless.
+
+    """
+
+    def __init__(self, ldap_connection, base_dn, filterstr=GROUPS_FILTER,
+                 member_attributes=('member', 'uniqueMember'),
+                 naming_attribute='cn', search_scope=ldap.SCOPE_SUBTREE,
+                 refresh_interval=300, retry_interval=60, page_size=500,
+                 bind_dn='', bind_pass=''):
+        """
+        Create an empty graph; it's loaded by L{load} or L{start}.
+
+        @param ldap_connection: The connection or pool to search with.
+        @param base_dn: The base of the search for the groups.
+        @param filterstr: The filter matching the groups.
+        @param member_attributes: The attributes holding the DNs of the
+            members of the groups.
+        @type member_attributes: C{iterable}
+        @param naming_attribute: The attribute holding the names of the
+            groups.
+        @param search_scope: C{ldap.SCOPE_SUBTREE} or C{ldap.SCOPE_ONELEVEL}.
+        @param refresh_interval: How many seconds to wait between the loads.
+        @type refresh_interval: C{float}
+        @param retry_interval: How many seconds to wait after a failed load.
+        @type retry_interval: C{float}
+        @param page_size: How many groups to request per page.
+        @type page_size: C{int}
+        @param bind_dn: The service account to search as, if any.
+        @param bind_pass: The password of C{bind_dn}.
+
+        """
+        self.ldap_connection = ldap_connection
+        self.base_dn = base_dn
+        self.filterstr = filterstr
+        self.member_attributes = list(member_attributes)
+        self.naming_attribute = naming_attribute
+        self.search_scope = search_scope
+        self.refresh_interval = float(refresh_interval)
+        self.retry_interval = float(retry_interval)
+        self.page_size = int(page_size)
+        self.bind_dn = bind_dn
+        self.bind_pass = bind_pass
+        # {member: set of groups}, {group: (DN, name)} and {group: closure},
+        # all keyed by the normalized DNs; replaced together by each load:
+        self._graph = ({}, {}, {})
+        self._loaded = threading.Event()
+        self._load_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        #: When the graph was last loaded, in seconds since the epoch.
+        self.loaded_at = None
+        #: The error of the last load, if it failed.
+        self.last_error = None
+        # When the last load failed, in seconds since the epoch:
+        self._failed_at = None
+
+    @property
+    def ready(self):
+        """Whether the graph was loaded at least once."""
+        return self._loaded.isSet()
+
+    def groups_of(self, dn):
+        """
+        Return the groups C{dn} belongs to, directly or not, as a set of
+        C{(DN as written, name)} pairs.
+
+        They are all taken from the same load, even if the graph is
+        reloaded meanwhile.
+
+        @rtype: C{frozenset}
+
+        """
+        if not dn:
+            return frozenset()
+        parents, groups, closures = self._graph
+        found = set()
+        for group in parents.get(normalize_dn(dn), ()):
+            found.update(self._closure(group, parents, closures))
+        return frozenset([groups[group] for group in found])
+
+    def _closure(self, group, parents, closures):
+        """Return C{group} and the groups it belongs to, memoized."""
+        closure = closures.get(group)
+        if closure is not None:
+            return closure
+        found = set([group])
+        pending = [group]
+        while pending:
+            for parent in parents.get(pending.pop(), ()):
+                if parent in found:
+                    continue
+                known = closures.get(parent)
+                if known is not None:
+                    found.update(known)
+                else:
+                    found.add(parent)
+                    pending.append(parent)
+        closure = frozenset(found)
+        closures[group] = closure
+        return closure
+
+    def load(self):
+        """
+        Load the graph from the directory, replacing its contents.
+
+        @return: The number of groups in the graph.
+        @raise ldap.LDAPError: If the search failed; the graph is left as it
+            was.
+
+        """
+        parents = {}
+        groups = {}
+        for (dn, attributes) in self._search():
+            group = normalize_dn(dn)
+            names = self._values(attributes, self.naming_attribute)
+            groups[group] = (dn, names and names[0] or dn)
+            for name in self.member_attributes:
+                for member in self._values(attributes, name):
+                    parents.setdefault(normalize_dn(member), set()).add(group)
+        self._graph = (parents, groups, {})
+        self.loaded_at = time.time()
+        self._loaded.set()
+        return len(groups)
+
+    def ensure_loaded(self, timeout=5):
+        """
+        Make sure the graph was loaded at least once.
+
+        If the refresh thread was L{start}ed, it loads the graph and retries
+        after the failures: This only waits at most C{timeout} seconds for
+        its first load, unless that failed already. Otherwise, the graph is
+        loaded by the calling thread, or the one already loading it, but
+        not again within C{retry_interval} seconds of a failure, so that the
+        requests don't all search a directory which is down.
+
+        @raise ldap.LDAPError: If the graph isn't loaded: the error of the
+            last load, or C{ldap.UNAVAILABLE} if it's still going on or
+            failed otherwise.
+
+        """
+        if self.ready:
+            return
+        if self._thread is not None:
+            if self.last_error is None:
+                self.wait(timeout)
+        else:
+            self._load_lock.acquire()
+            try:
+                if not self.ready and not self._backing_off():
+                    self._load()
+            finally:
+                self._load_lock.release()
+        if not self.ready:
+            if isinstance(self.last_error, ldap.LDAPError):
+                raise self.last_error
+            raise ldap.UNAVAILABLE('The groups are not loaded yet')
+
+    def _backing_off(self):
+        """Tell whether the last load failed too recently to try again."""
+        return (self._failed_at is not None and
+                time.time() - self._failed_at < self.retry_interval)
+
+    def _load(self):
+        """L{load}, recording the outcome in C{last_error}."""
+        try:
+            self.load()
+        except ldap.LDAPError, error:
+            log.warning('Cannot load the groups of %s: %s', self.base_dn,
+                        error)
+            self.last_error = error
+            self._failed_at = time.time()
+            return False
+        except Exception, error:
+            log.exception('Cannot load the groups of %s', self.base_dn)
+            self.last_error = error
+            self._failed_at = time.time()
+            return False
+        self.last_error = None
+        self._failed_at = None
+        return True
+
+    def _values(self, attributes, attribute):
+        for (name, values) in attributes.iteritems():
+            if name.lower() == attribute.lower():
+                if isinstance(values, basestring):
+                    return [values]
+                return values
+        return []
+
+    def _search(self):
+        """Return the groups of the directory, page after page."""
+        with checkout(self.ldap_connection) as conn:
+            if self.bind_dn:
+                ensure_bound(conn, self.bind_dn, self.bind_pass)
+            return paged_search(conn, self.base_dn, self.search_scope,
+                                self.filterstr,
+                                [self.naming_attribute] +
+                                self.member_attributes,
+                                self.page_size)
+
+    def start(self):
+        """
+        Load the graph in a background thread, and refresh it every
+        C{refresh_interval} seconds until L{stop} is called.
+
+        """
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='GroupGraph')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self._load_lock.acquire()
+            try:
+                loaded = self._load()
+            finally:
+                self._load_lock.release()
+            if loaded:
+                interval = self.refresh_interval
+            else:
+                interval = self.retry_interval
+            self._stopped.wait(interval)
+            if self._stopped.isSet():
+                return
+
+    def wait(self, timeout=None):
+        """
+        Wait until the graph is loaded, at most C{timeout} seconds.
+
+        @rtype: C{bool}
+        @return: Whether it's loaded.
+
+        """
+        self._loaded.wait(timeout)
+        return self.ready
+
+    def stop(self):
+        """Stop refreshing the graph."""
+        self._stopped.set()
+        thread, self._thread = self._thread, None
+        if thread is not None and thread is not threading.currentThread():
+            thread.join()
+
+    def __len__(self):
+        return len(self._graph[1])
+
+    def __repr__(self):
+        return '<%s %s %d groups>' % (self.__class__.__name__, self.base_dn,
+                                      len(self))
+
+
+def normalize_dn(dn):
+    """
+    Return C{dn} lowercased and without the spaces around its RDNs, so that
+    the member DNs written differently match.
+
+    """
+    try:
+        return ','.join([rdn.strip() for rdn in ldap.dn.explode_dn(dn.lower())])
+    except ldap.DECODING_ERROR:
+        return dn.strip().lower()
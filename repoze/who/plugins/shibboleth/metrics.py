@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+#
+# repoze.who.plugins.shibboleth, Shibboleth authentication for WSGI applications.
+# Copyright (C) 2010 by Ralph Bean <http://threebean.wordpress.com/>
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+"""
+Metrics about the directory operations performed by the plugins.
+
+The plugins report into any object with the C{increment} and C{observe}
+methods of L{Metrics}, which keeps them in memory. L{CallbackMetrics}
+forwards them to a function instead, e.g. to send them to statsd.
+
+The metrics reported are:
+ - C{ldap.operations}, a counter, and C{ldap.duration}, a histogram of the
+   seconds taken, of the C{operation}s (C{search}, C{bind} for the users'
+   credentials or C{service_bind}) per C{server} and C{outcome}
+   (C{success} or the name of the LDAP error, like C{invalid_credentials}).
+ - C{cache.lookups}, a counter of the lookups in each C{cache} (C{dn},
+   C{negative}, C{credentials}, C{attributes}, C{prefetched}, C{userdata}
+   for the snapshots of the attributes, C{mirror}, C{groups}, a hit when
+   the group graph was loaded already, or C{released}, a hit when the SP
+   released all the attributes) per C{outcome} (C{hit} or C{miss}).
+ - C{plugin.duration}, a histogram of the seconds taken by each C{call}
+   (C{authenticate}, C{authenticate_many} or C{add_metadata}).
+
+"""
+
+__all__ = ['Metrics', 'Histogram', 'CallbackMetrics', 'timed', 'timed_call',
+           'count_lookup', 'outcome_of']
+
+import threading
+import time
+
+from contextlib import contextmanager
+
+from repoze.who.plugins.shibboleth.pool import server_of
+
+
+class Histogram(object):
+    """The distribution of some values, in buckets."""
+
+    def __init__(self, buckets):
+        """
+        @param buckets: The upper bounds of the buckets, in ascending order;
+            a last bucket holds the bigger values.
+        @type buckets: C{tuple}
+
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = None
+
+    def observe(self, value):
+        """Add C{value} to the distribution."""
+        for (index, bound) in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            index = len(self.buckets)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+    @property
+    def mean(self):
+        """The mean of the values, or C{None} if there's none."""
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def percentile(self, percent):
+        """
+        Return the upper bound of the bucket of the C{percent}th percentile,
+        or the maximum value if it's in the last bucket.
+
+        @type percent: C{float}
+
+        """
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for (index, count) in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                break
+        if index < len(self.buckets):
+            return self.buckets[index]
+        return self.maximum
+
+    def __repr__(self):
+        return '<%s count=%d mean=%s>' % (self.__class__.__name__,
+                                          self.count, self.mean)
+
+
+class Metrics(object):
+    """A thread-safe registry of counters and histograms, kept in memory."""
+
+    #: The default bucket bounds of the histograms, in seconds.
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+               2.5, 5, 10)
+
+    def __init__(self, buckets=None):
+        """
+        @param buckets: The bucket bounds of the histograms; see
+            L{Histogram}.
+
+        """
+        if buckets is None:
+            buckets = self.BUCKETS
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def _key(self, name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def increment(self, name, value=1, **labels):
+        """Add C{value} to the counter C{name} with the C{labels}."""
+        key = self._key(name, labels)
+        self._lock.acquire()
+        try:
+            self._counters[key] = self._counters.get(key, 0) + value
+        finally:
+            self._lock.release()
+
+    def observe(self, name, value, **labels):
+        """Add C{value} to the histogram C{name} with the C{labels}."""
+        key = self._key(name, labels)
+        self._lock.acquire()
+        try:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+        finally:
+            self._lock.release()
+
+    def counter(self, name, **labels):
+        """
+        Return the value of the counter C{name}, summed over the labels which
+        are not given.
+
+        """
+        wanted = set(labels.items())
+        self._lock.acquire()
+        try:
+            return sum([value for ((counter, items), value)
+                        in self._counters.iteritems()
+                        if counter == name and wanted.issubset(items)])
+        finally:
+            self._lock.release()
+
+    def histograms(self, name, **labels):
+        """
+        Return the histograms C{name} with (at least) the C{labels}, as
+        {labels: histogram}, the labels of each being a sorted tuple of
+        (name, value) pairs.
+
+        """
+        wanted = set(labels.items())
+        self._lock.acquire()
+        try:
+            return dict([(items, histogram) for ((histogram_name, items),
+                                                 histogram)
+                         in self._histograms.iteritems()
+                         if histogram_name == name and
+                            wanted.issubset(items)])
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        """Forget all the metrics."""
+        self._lock.acquire()
+        try:
+            self._counters.clear()
+            self._histograms.clear()
+        finally:
+            self._lock.release()
+
+
+class CallbackMetrics(object):
+    """Forwards the metrics to a function as they are reported."""
+
+    def __init__(self, callback):
+        """
+        @param callback: The function called as C{callback(kind, name, value,
+            labels)} for every metric reported, C{kind} being C{counter} or
+            C{histogram} and C{labels} a dictionary.
+        @type callback: C{callable}
+
+        """
+        self.callback = callback
+
+    def increment(self, name, value=1, **labels):
+        self.callback('counter', name, value, labels)
+
+    def observe(self, name, value, **labels):
+        self.callback('histogram', name, value, labels)
+
+
+def outcome_of(error):
+    """Return the outcome label of an operation which raised C{error}."""
+    if error is None:
+        return 'success'
+    return error.__class__.__name__.lower()
+
+
+@contextmanager
+def timed(metrics, operation, conn):
+    """
+    Report the LDAP C{operation} performed with C{conn} in a C{with} block
+    into C{metrics}, unless it's C{None}.
+
+    """
+    if metrics is None:
+        yield
+        return
+    error = None
+    started_at = time.time()
+    try:
+        yield
+    except Exception, error:
+        raise
+    finally:
+        labels = dict(operation=operation, server=server_of(conn),
+                      outcome=outcome_of(error))
+        metrics.increment('ldap.operations', **labels)
+        metrics.observe('ldap.duration', time.time() - started_at, **labels)
+
+
+def count_lookup(metrics, cache, hit):
+    """Report a lookup in C{cache} into C{metrics}, unless it's C{None}."""
+    if metrics is not None:
+        metrics.increment('cache.lookups', cache=cache,
+                          outcome=hit and 'hit' or 'miss')
+
+
+@contextmanager
+def timed_call(metrics, call):
+    """
+    Report the time taken by the plugin C{call} in a C{with} block into
+    C{metrics}, unless it's C{None}.
+
+    """
+    if metrics is None:
+        yield
+        return
+    started_at = time.time()
+    try:
+        yield
+    finally:
+        metrics.observe('plugin.duration', time.time() - started_at,
+                        call=call)
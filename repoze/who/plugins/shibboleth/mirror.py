@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+#
+# repoze.who.plugins.shibboleth, Shibboleth authentication for WSGI applications.
+# Copyright (C) 2010 by Ralph Bean <http://threebean.wordpress.com/>
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+"""A local index of the logins of the directory, to find DNs without it."""
+
+__all__ = ['DirectoryMirror']
+
+import logging
+import threading
+import time
+
+import ldap
+
+from repoze.who.plugins.shibboleth.pool import (checkout, ensure_bound,
+                                                 paged_search)
+
+
+log = logging.getLogger(__name__)
+
+
+class DirectoryMirror(object):
+    """
+    Maps the logins of the users to their DNs, from a copy of the directory
+    loaded with a paged search and refreshed periodically in the background.
+
+    The logins are normalized like in the DN cache of
+    L{repoze.who.plugins.shibboleth.plugins.ShibbolethSearchAuthenticatorPlugin}:
+    stripped and lowercased. Those shared by several entries are left out,
+    so that the plugin finds out about them with a live search.
+
+    """
+
+    def __init__(self, ldap_connection, base_dn, naming_attribute='uid',
+                 restrict='', search_scope=ldap.SCOPE_SUBTREE,
+                 refresh_interval=3600, retry_interval=60, page_size=500,
+                 bind_dn='', bind_pass=''):
+        """
+        Create an empty mirror; it's loaded by L{load} or L{start}.
+
+        @param ldap_connection: The connection or pool to search with; a
+            connection mustn't be used to bind the users meanwhile, as the
+            pages would be searched as them.
+        @param base_dn: The base of the search.
+        @param naming_attribute: The attribute holding the logins.
+        @param restrict: A filter the entries must match too.
+        @param search_scope: C{ldap.SCOPE_SUBTREE} or C{ldap.SCOPE_ONELEVEL}.
+        @param refresh_interval: How many seconds to wait between the loads.
+        @type refresh_interval: C{float}
+        @param retry_interval: How many seconds to wait after a failed load.
+        @type retry_interval: C{float}
+        @param page_size: How many entries to request per page.
+        @type page_size: C{int}
+        @param bind_dn: The service account to search as, if any.
+        @param bind_pass: The password of C{bind_dn}.
+
+        """
+        self.ldap_connection = ldap_connection
+        self.base_dn = base_dn
+        self.naming_attribute = naming_attribute
+        self.search_scope = search_scope
+        if restrict:
+            self.filterstr = '(&%s(%s=*))' % (restrict, naming_attribute)
+        else:
+            self.filterstr = '(%s=*)' % naming_attribute
+        self.refresh_interval = float(refresh_interval)
+        self.retry_interval = float(retry_interval)
+        self.page_size = int(page_size)
+        self.bind_dn = bind_dn
+        self.bind_pass = bind_pass
+        self._index = {}
+        self._loaded = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        #: When the mirror was last loaded, in seconds since the epoch.
+        self.loaded_at = None
+        #: The error of the last load, if it failed.
+        self.last_error = None
+
+    @property
+    def ready(self):
+        """Whether the mirror was loaded at least once."""
+        return self._loaded.isSet()
+
+    def lookup(self, login):
+        """
+        Return the DN of the only entry whose login is C{login}, or C{None}
+        if there's none or the mirror isn't loaded yet.
+
+        """
+        return self._index.get(login.strip().lower())
+
+    def load(self):
+        """
+        Load the mirror from the directory, replacing its contents.
+
+        @return: The number of logins in the mirror.
+        @raise ldap.LDAPError: If the search failed; the mirror is left as
+            it was.
+
+        """
+        index = {}
+        ambiguous = set()
+        for (dn, attributes) in self._search():
+            for login in self._logins(attributes):
+                login = login.strip().lower()
+                if login in index and index[login] != dn:
+                    ambiguous.add(login)
+                index[login] = dn
+        for login in ambiguous:
+            del index[login]
+        self._index = index
+        self.loaded_at = time.time()
+        self._loaded.set()
+        return len(index)
+
+    def _logins(self, attributes):
+        for (name, values) in attributes.iteritems():
+            if name.lower() == self.naming_attribute.lower():
+                if isinstance(values, basestring):
+                    return [values]
+                return values
+        return []
+
+    def _search(self):
+        """Return the entries of the directory, page after page."""
+        with checkout(self.ldap_connection) as conn:
+            if self.bind_dn:
+                ensure_bound(conn, self.bind_dn, self.bind_pass)
+            return paged_search(conn, self.base_dn, self.search_scope,
+                                self.filterstr, [self.naming_attribute],
+                                self.page_size)
+
+    def start(self):
+        """
+        Load the mirror in a background thread, and refresh it every
+        C{refresh_interval} seconds until L{stop} is called.
+
+        The failed loads are logged and retried after C{retry_interval}
+        seconds, whatever the error; the mirror keeps its previous contents
+        meanwhile.
+
+        """
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='DirectoryMirror')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.load()
+            except ldap.LDAPError, error:
+                log.warning('Cannot load the mirror of %s: %s', self.base_dn,
+                            error)
+                self.last_error = error
+                interval = self.retry_interval
+            except Exception, error:
+                log.exception('Cannot load the mirror of %s', self.base_dn)
+                self.last_error = error
+                interval = self.retry_interval
+            else:
+                self.last_error = None
+                interval = self.refresh_interval
+            self._stopped.wait(interval)
+            if self._stopped.isSet():
+                return
+
+    def wait(self, timeout=None):
+        """
+        Wait until the mirror is loaded, at most C{timeout} seconds.
+
+        @rtype: C{bool}
+        @return: Whether it's loaded.
+
+        """
+        self._loaded.wait(timeout)
+        return self.ready
+
+    def stop(self):
+        """Stop refreshing the mirror."""
+        self._stopped.set()
+        thread, self._thread = self._thread, None
+        if thread is not None and thread is not threading.currentThread():
+            thread.join()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __repr__(self):
+        return '<%s %s %d logins>' % (self.__class__.__name__, self.base_dn,
+                                      len(self._index))
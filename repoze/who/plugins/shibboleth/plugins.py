@@ -18,16 +18,55 @@
 """Shibboleth plugins for repoze.who."""
 
 __all__ = ['ShibbolethBaseAuthenticatorPlugin', 'ShibbolethAuthenticatorPlugin',
-           'ShibbolethSearchAuthenticatorPlugin', 'ShibbolethAttributesPlugin']
+           'ShibbolethSearchAuthenticatorPlugin', 'ShibbolethAttributesPlugin',
+           'ShibbolethGroupsPlugin', 'LazyAttributes', 'AttributesUnavailable']
 
 from zope.interface import implements
 import ldap
+import ldap.filter
 
 from repoze.who.interfaces import IAuthenticator, IMetadataProvider
 
-from base64 import b64encode, b64decode
+from repoze.who.plugins.shibboleth.pool import LDAPConnectionPool, \
+                                               LDAPServerGroup, checkout, \
+                                               is_pool, ensure_bound, \
+                                               bind_user, is_bound, \
+                                               set_timeouts
+from repoze.who.plugins.shibboleth.cache import CredentialsCache, make_cache
+from repoze.who.plugins.shibboleth.breaker import CircuitOpen, make_breaker, \
+                                                  is_failure
+from repoze.who.plugins.shibboleth.metrics import timed, timed_call, \
+                                                  count_lookup
+from repoze.who.plugins.shibboleth.userdata import UserdataCodec, decode_dn
+from repoze.who.plugins.shibboleth.mirror import DirectoryMirror
+from repoze.who.plugins.shibboleth.changes import make_change_feed
+from repoze.who.plugins.shibboleth.groups import GroupGraph, GROUPS_FILTER, \
+                                                 normalize_dn
+from repoze.who.plugins.shibboleth.sp import AddressMatcher, split_values, \
+                                             USERID_KEY
 
+from base64 import b64encode
+from collections import MutableMapping
+
+import hashlib
+import hmac
+import os
 import re
+import sys
+import threading
+
+
+#: The WSGI environ key where authenticators leave the directory entries they
+#: fetched during the request, as {dn: (lowercased attribute names, entry)}.
+ENTRIES_KEY = 'repoze.who.plugins.shibboleth.entries'
+
+#: The WSGI environ key where the plugins memoize the outcome of their
+#: directory operations, so that none is repeated during the request; see
+#: L{request_memo}.
+MEMO_KEY = 'repoze.who.plugins.shibboleth.memo'
+
+# The key of the HMACs of the passwords memoized in the requests:
+_MEMO_SECRET = os.urandom(16)
 
 
 #{ Authenticators
@@ -38,7 +77,19 @@ class ShibbolethBaseAuthenticatorPlugin(object):
     implements(IAuthenticator)
 
     def __init__(self, ldap_connection, base_dn, returned_id='dn',
-                 start_tls=False, bind_dn='', bind_pass='', **kwargs):
+                 start_tls=False, bind_dn='', bind_pass='', pool_min_size=0,
+                 pool_max_size=None, pool_timeout=None,
+                 pool_idle_timeout=None, bind_connection=None,
+                 credentials_cache=None, credentials_cache_ttl=None,
+                 credentials_cache_max_lifetime=None,
+                 credentials_cache_size=1000, network_timeout=None,
+                 operation_timeout=None, circuit_breaker=None,
+                 breaker_threshold=None, breaker_reset_timeout=30,
+                 server_weights=None, server_strategy='round-robin',
+                 server_max_failures=3, server_retry_interval=30,
+                 bind_pool_max_size=None, bind_server_weights=None,
+                 metrics=None, cache_file=None, userdata_secret=None,
+                 change_feed=None, change_poll_interval=None, **kwargs):
         """Create an Shibboleth authentication plugin.
         
         By passing an existing ShibbolethObject, you're free to use the Shibboleth
@@ -51,8 +102,12 @@ class ShibbolethBaseAuthenticatorPlugin(object):
         This plugin is compatible with any identifier plugin that defines the
         C{login} and C{password} items in the I{identity} dictionary.
         
-        @param ldap_connection: An initialized Shibboleth connection.
-        @type ldap_connection: C{ldap.ldapobject.SimpleShibbolethObject}
+        @param ldap_connection: An initialized Shibboleth connection, a
+            connection pool, the LDAP URL of the server or the URLs of
+            several equivalent servers to spread the load over (as a list or
+            separated by spaces).
+        @type ldap_connection: C{ldap.ldapobject.SimpleShibbolethObject},
+            L{LDAPConnectionPool}, L{LDAPServerGroup}, C{str} or C{list}
 
         @param base_dn: The base for the I{Distinguished Name}. Something like
             C{ou=employees,dc=example,dc=org}, to which will be prepended the
@@ -71,21 +126,172 @@ class ShibbolethBaseAuthenticatorPlugin(object):
         @type bind_dn: C{str}
         @param bind_pass: The password for bind_dn directory entry
         @type bind_pass: C{str}
-        @raise ValueError: If at least one of the parameters is not defined.
+        @param pool_min_size: How many pooled connections to keep open when
+            idle; see L{LDAPConnectionPool}.
+        @type pool_min_size: C{int}
+        @param pool_max_size: If C{ldap_connection} is an URL, use a pool of
+            up to this many connections instead of a single one shared by
+            all the threads.
+        @type pool_max_size: C{int}
+        @param pool_timeout: How many seconds to wait for a pooled connection
+            before giving up.
+        @type pool_timeout: C{float}
+        @param pool_idle_timeout: How many seconds to keep an unused pooled
+            connection open.
+        @type pool_idle_timeout: C{float}
+        @param bind_connection: The connection, pool or LDAP URL(s) used to
+            check the users' credentials. By default, a pooled
+            C{ldap_connection} gets a twin pool for this purpose, so that its
+            own connections stay bound as C{bind_dn} for the searches; a
+            single connection is used for both. Setting it splits the reads
+            from the binds: e.g., the searches can go to the read replicas
+            while the binds go to the primary server, which keeps the state
+            of the password policy.
+        @type bind_connection: C{ldap.ldapobject.SimpleShibbolethObject},
+            L{LDAPConnectionPool}, L{LDAPServerGroup}, C{str} or C{list}
+        @param credentials_cache: A
+            L{repoze.who.plugins.shibboleth.cache.CredentialsCache} for the
+            passwords recently verified by the directory.
+        @param credentials_cache_ttl: If no C{credentials_cache} is given,
+            trust a verified password again for this many seconds after its
+            last use; passwords are always checked by the directory unless
+            it's set.
+        @type credentials_cache_ttl: C{float}
+        @param credentials_cache_max_lifetime: How many seconds a verified
+            password is trusted at most; C{credentials_cache_ttl} by default.
+        @type credentials_cache_max_lifetime: C{float}
+        @param credentials_cache_size: How many passwords to remember at most.
+        @type credentials_cache_size: C{int}
+        @attention: A password changed or an account disabled in the
+            directory keeps working for up to C{credentials_cache_max_lifetime}
+            seconds.
+        @param network_timeout: How many seconds to wait for the server when
+            connecting to it, if the connections are created from an URL.
+        @type network_timeout: C{float}
+        @param operation_timeout: How many seconds to wait for the result of
+            each operation, if the connections are created from an URL.
+        @type operation_timeout: C{float}
+        @param circuit_breaker: A
+            L{repoze.who.plugins.shibboleth.breaker.CircuitBreaker}, possibly
+            shared with the other plugins using the same directory.
+        @param breaker_threshold: If no C{circuit_breaker} is given, stop
+            contacting the directory after this many consecutive failures (so
+            that all the authentications fail right away) for
+            C{breaker_reset_timeout} seconds; it's always contacted unless
+            it's set.
+        @type breaker_threshold: C{int}
+        @param breaker_reset_timeout: How many seconds to wait before
+            contacting a failing directory again.
+        @type breaker_reset_timeout: C{float}
+        @param server_weights: The relative share of the load each server
+            gets when several URLs are given, in the same order; see
+            L{LDAPServerGroup}.
+        @type server_weights: C{iterable} or C{str}
+        @param server_strategy: How to pick the server of each connection,
+            C{round-robin} or C{least-outstanding}.
+        @type server_strategy: C{str}
+        @param server_max_failures: How many consecutive failures take a
+            server out of the rotation.
+        @type server_max_failures: C{int}
+        @param server_retry_interval: How many seconds a failing server stays
+            out of the rotation.
+        @type server_retry_interval: C{float}
+        @param bind_pool_max_size: The C{pool_max_size} of the
+            C{bind_connection}, if it's not the same as for the searches.
+        @type bind_pool_max_size: C{int}
+        @param bind_server_weights: The C{server_weights} of the servers of
+            the C{bind_connection}; they all weigh the same by default.
+        @type bind_server_weights: C{iterable} or C{str}
+        @param metrics: Where to report the duration and outcome of the
+            directory operations and the cache lookups, such as a
+            L{repoze.who.plugins.shibboleth.metrics.Metrics} registry.
+        @param cache_file: The path to a file in which to keep the caches
+            created from the C{*_cache_ttl} options, so that all the
+            processes of the host share them; see
+            L{repoze.who.plugins.shibboleth.cache.SQLiteCache}. They are kept
+            in the memory of each process otherwise.
+        @type cache_file: C{str}
+        @param userdata_secret: If set, store the DN of the user in the
+            C{userdata} of the identity as a signed token, which
+            L{ShibbolethAttributesPlugin} completes with a snapshot of the
+            attributes if it's given the same secret; see
+            L{repoze.who.plugins.shibboleth.userdata}.
+        @type userdata_secret: C{str}
+        @param change_feed: A
+            L{repoze.who.plugins.shibboleth.changes.ChangeFeed} telling which
+            entries changed in the directory, so that what's cached about
+            them is forgotten; see L{invalidate}.
+        @param change_poll_interval: If no C{change_feed} is given, create
+            one polling the entries below C{base_dn} every so many seconds;
+            no feed is used unless it's set. The caches may be given long
+            TTLs then. The C{ldap_connection} must be a pool then, so that
+            the changes aren't searched as the users.
+        @type change_poll_interval: C{float}
+        @raise ValueError: If at least one of the parameters is not defined,
+            or if C{change_poll_interval} is set without a pool.
         
         """
         if base_dn is None:
             raise ValueError('A base Distinguished Name must be specified')
-        self.ldap_connection = make_ldap_connection(ldap_connection)
-
+        pool_options = dict(pool_min_size=pool_min_size,
+                            pool_max_size=pool_max_size,
+                            pool_timeout=pool_timeout,
+                            pool_idle_timeout=pool_idle_timeout,
+                            start_tls=start_tls,
+                            network_timeout=network_timeout,
+                            operation_timeout=operation_timeout,
+                            server_weights=server_weights,
+                            server_strategy=server_strategy,
+                            server_max_failures=server_max_failures,
+                            server_retry_interval=server_retry_interval)
+        self.ldap_connection = make_ldap_connection(
+            ldap_connection, bind_dn=bind_dn, bind_pass=bind_pass,
+            **pool_options)
         if start_tls:
-            try:
-                self.ldap_connection.start_tls_s()
-            except:
-                raise ValueError('Cannot upgrade the connection')
+            upgrade_connection(self.ldap_connection)
+
+        if bind_connection is not None:
+            bind_options = dict(pool_options,
+                                server_weights=bind_server_weights)
+            if bind_pool_max_size:
+                bind_options['pool_max_size'] = bind_pool_max_size
+            self.bind_connection = make_ldap_connection(bind_connection,
+                                                        **bind_options)
+            if start_tls and self.bind_connection is not self.ldap_connection:
+                upgrade_connection(self.bind_connection)
+        elif is_pool(self.ldap_connection):
+            self.bind_connection = self.ldap_connection.copy(bind_dn='',
+                                                             bind_pass='')
+        else:
+            self.bind_connection = self.ldap_connection
 
         self.bind_dn = bind_dn
         self.bind_pass = bind_pass
+        self.operation_timeout = operation_timeout
+        self.circuit_breaker = make_breaker(circuit_breaker,
+                                            breaker_threshold,
+                                            breaker_reset_timeout)
+        self.metrics = metrics
+        self.cache_file = cache_file
+        if userdata_secret:
+            self.userdata_codec = UserdataCodec(userdata_secret)
+        else:
+            self.userdata_codec = None
+
+        if credentials_cache is None and credentials_cache_ttl:
+            if not credentials_cache_max_lifetime:
+                credentials_cache_max_lifetime = credentials_cache_ttl
+            shared_cache = None
+            if cache_file:
+                shared_cache = make_cache(
+                    ttl=credentials_cache_ttl,
+                    max_size=credentials_cache_size, jitter=0,
+                    path=cache_file, namespace='credentials')
+            credentials_cache = CredentialsCache(
+                ttl=credentials_cache_ttl,
+                max_lifetime=credentials_cache_max_lifetime,
+                max_size=credentials_cache_size, cache=shared_cache)
+        self.credentials_cache = credentials_cache
 
         self.base_dn = base_dn
 
@@ -96,6 +302,37 @@ class ShibbolethBaseAuthenticatorPlugin(object):
         else:
             raise ValueError("The return style should be 'dn' or 'login'")
 
+        self.change_feed = make_change_feed(
+            change_feed, change_poll_interval, self.ldap_connection, base_dn,
+            bind_dn, bind_pass)
+        if self.change_feed is not None:
+            self.change_feed.subscribe(self.invalidate,
+                                       self._changed_attributes())
+
+    def _changed_attributes(self):
+        """
+        Return the attributes of the changed entries which L{invalidate}
+        needs.
+
+        """
+        return ()
+
+    def invalidate(self, dn, attributes=None):
+        """
+        Forget what's cached about the entry C{dn}, which changed.
+
+        The DNs are compared once normalized (see
+        L{repoze.who.plugins.shibboleth.groups.normalize_dn}), as the
+        directory may write C{dn} differently from the authenticators.
+
+        @param attributes: The attributes of the entry returned by the
+            change feed.
+        @type attributes: C{dict}
+
+        """
+        if self.credentials_cache is not None:
+            self.credentials_cache.forget(normalize_dn(dn))
+
     def _get_dn(self, environ, identity):
         """
         Return the user DN based on the environment and the identity.
@@ -120,29 +357,170 @@ class ShibbolethBaseAuthenticatorPlugin(object):
         @rtype: C{unicode} or C{None}
         
         """
-        
+        with timed_call(self.metrics, 'authenticate'):
+            return self._authenticate(environ, identity)
+
+    def _authenticate(self, environ, identity):
         try:
             dn = self._get_dn(environ, identity)
             password = identity['password']
         except (KeyError, TypeError, ValueError):
             return None
 
-        if not hasattr(self.ldap_connection, 'simple_bind_s'):
-            environ['repoze.who.logger'].warn('Cannot bind with the provided '
-                                              'Shibboleth connection object')
+        if not self._check_credentials(environ, dn, password):
             return None
-        
+
+        # The credentials are valid!
+        return self._authenticated(identity, dn)
+
+    def authenticate_many(self, environ, identities, max_workers=8):
+        """
+        Return the naming identifiers of several users to be authenticated,
+        e.g. by a bulk job, in the same order as their identities.
+
+        The DNs are found first, with as few searches as possible (see
+        L{_get_dns}), then the passwords are checked by up to
+        C{max_workers} threads at a time, which only bind concurrently if
+        the C{bind_connection} is a pool.
+
+        @param environ: The WSGI environment.
+        @param identities: The identity dictionaries, as given to
+            L{authenticate}.
+        @type identities: C{list}
+        @param max_workers: How many passwords to check at once at most.
+        @type max_workers: C{int}
+        @return: The naming identifier of each identity whose credentials
+            were valid, C{None} for the others.
+        @rtype: C{list}
+
+        """
+        with timed_call(self.metrics, 'authenticate_many'):
+            return self._authenticate_many(environ, list(identities),
+                                           max_workers)
+
+    def _authenticate_many(self, environ, identities, max_workers):
+        userids = [None] * len(identities)
+        calls = []
+        dns = self._get_dns(environ, identities)
+        for (index, (identity, dn)) in enumerate(zip(identities, dns)):
+            try:
+                calls.append((index, identity, dn, identity['password']))
+            except (KeyError, TypeError):
+                continue
+        calls = [call for call in calls if call[2] is not None]
+
+        def check(index, identity, dn, password):
+            if self._check_credentials(environ, dn, password):
+                userids[index] = self._authenticated(identity, dn)
+
+        if not is_pool(self.bind_connection):
+            # The binds would overwrite each other on a shared connection:
+            max_workers = 1
+        run_concurrently(check, calls, max_workers)
+        return userids
+
+    def _get_dns(self, environ, identities):
+        """
+        Return the DN of each identity, or C{None} for those whose DN can't
+        be found.
+
+        By default, L{_get_dn} is called for each of them.
+
+        """
+        dns = []
+        for identity in identities:
+            try:
+                dns.append(self._get_dn(environ, identity))
+            except (KeyError, TypeError, ValueError):
+                dns.append(None)
+        return dns
+
+    def _check_credentials(self, environ, dn, password):
+        """
+        Tell whether C{password} is valid for C{dn}, binding as C{dn} unless
+        it's already known.
+
+        @rtype: C{bool}
+
+        """
+        known = self._known_credentials(environ, dn, password)
+        if known is not None:
+            return known
         try:
-            self.ldap_connection.simple_bind_s(dn, password)
-            userdata = identity.get('userdata', '')
-            # The credentials are valid!
-            if self.ret_style == 'd':
-                return dn
-            else:
-                identity['userdata'] = userdata + '<dn:%s>' % b64encode(dn)
-                return identity['login']
-        except ldap.ShibbolethError:
+            with checkout(self.bind_connection,
+                          self.circuit_breaker) as conn:
+                if not hasattr(conn, 'simple_bind_s'):
+                    environ['repoze.who.logger'].warn(
+                        'Cannot bind with the provided Shibboleth '
+                        'connection object')
+                    return False
+                with timed(self.metrics, 'bind', conn):
+                    bind_user(conn, dn, password)
+        except ldap.LDAPError, error:
+            self._verified(environ, dn, password, error)
+            return False
+        self._verified(environ, dn, password)
+        return True
+
+    def _known_credentials(self, environ, dn, password):
+        """
+        Tell whether C{password} is known to be valid for C{dn} without
+        binding.
+
+        @return: C{True} or C{False} if the password was verified earlier
+            during the request or recently, C{None} otherwise.
+
+        """
+        valid = request_memo(environ).get(self._bind_memo_key(dn, password))
+        if valid is not None:
+            return valid
+        if self.credentials_cache is None or not password:
             return None
+        hit = self.credentials_cache.check(normalize_dn(dn), password)
+        count_lookup(self.metrics, 'credentials', hit)
+        return hit or None
+
+    def _verified(self, environ, dn, password, error=None):
+        """
+        Record that binding as C{dn} with C{password} succeeded, or failed
+        with C{error}.
+
+        Only the outcomes which don't depend on the state of the directory
+        are remembered: successes and invalid credentials.
+
+        """
+        if error is None:
+            request_memo(environ)[self._bind_memo_key(dn, password)] = True
+            if self.credentials_cache is not None and password:
+                self.credentials_cache.remember(normalize_dn(dn), password)
+        elif isinstance(error, ldap.INVALID_CREDENTIALS):
+            request_memo(environ)[self._bind_memo_key(dn, password)] = False
+
+    def _bind_memo_key(self, dn, password):
+        """
+        Return the key of the outcome of a bind memoized in the request.
+
+        Only an HMAC of the password is kept, as the environ may be dumped
+        in error reports.
+
+        """
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
+        return ('bind', dn, hmac.new(_MEMO_SECRET, password,
+                                     hashlib.sha256).digest())
+
+    def _authenticated(self, identity, dn):
+        """Return the user id of the identity whose credentials are valid."""
+        userdata = identity.get('userdata', '')
+        if self.ret_style == 'd':
+            return dn
+        elif self.userdata_codec is not None:
+            identity['userdata'] = self.userdata_codec.replace(
+                userdata, self.userdata_codec.encode(dn))
+            return identity['login']
+        else:
+            identity['userdata'] = userdata + '<dn:%s>' % b64encode(dn)
+            return identity['login']
 
     def __repr__(self):
         return '<%s %s>' % (self.__class__.__name__, id(self))
@@ -209,8 +587,11 @@ class ShibbolethAuthenticatorPlugin(ShibbolethBaseAuthenticatorPlugin):
 
         if self.bind_dn:
             try:
-                self.ldap_connection.bind_s(self.bind_dn, self.bind_password)
-            except ldap.ShibbolethError:
+                with checkout(self.ldap_connection,
+                              self.circuit_breaker) as conn:
+                    bind_service(conn, self.bind_dn, self.bind_pass,
+                                 self.metrics)
+            except ldap.LDAPError:
                 raise ValueError("Couldn't bind with supplied credentials")
         try:
             return self.naming_pattern % ( identity['login'], self.base_dn)
@@ -221,7 +602,12 @@ class ShibbolethAuthenticatorPlugin(ShibbolethBaseAuthenticatorPlugin):
 class ShibbolethSearchAuthenticatorPlugin(ShibbolethBaseAuthenticatorPlugin):
 
     def __init__(self, ldap_connection, base_dn, naming_attribute='uid',
-                 search_scope='subtree', restrict='', **kwargs):
+                 search_scope='subtree', restrict='', dn_cache=None,
+                 dn_cache_ttl=None, dn_cache_size=1000, dn_cache_jitter=0.1,
+                 negative_cache=None, negative_cache_ttl=None,
+                 negative_cache_size=10000, fetch_attributes=None,
+                 mirror=None, mirror_refresh_interval=None,
+                 mirror_page_size=500, batch_search_size=100, **kwargs):
         """Create an Shibboleth authentication plugin determining the DN via Shibboleth searches.
         
         By passing an existing ShibbolethObject, you're free to use the Shibboleth
@@ -248,8 +634,52 @@ class ShibbolethSearchAuthenticatorPlugin(ShibbolethBaseAuthenticatorPlugin):
         @attention: restrict will be interpolated into the search string as a
             bare string like in "(&%s(identifier=login))". It must be correctly
             parenthesised for such usage as in restrict = "(objectClass=*)". 
+        @param dn_cache: A cache for the DNs found, such as
+            L{repoze.who.plugins.shibboleth.cache.TTLCache}.
+        @param dn_cache_ttl: If no C{dn_cache} is given, cache the DNs found
+            for this many seconds; they aren't cached unless it's set.
+        @type dn_cache_ttl: C{float}
+        @param dn_cache_size: How many DNs to cache at most.
+        @type dn_cache_size: C{int}
+        @param dn_cache_jitter: The fraction of C{dn_cache_ttl} by which the
+            lifetime of each cached DN is randomly shortened or lengthened.
+        @type dn_cache_jitter: C{float}
+        @param negative_cache: A cache for the logins which matched no entry,
+            or more than one.
+        @param negative_cache_ttl: If no C{negative_cache} is given, remember
+            such logins for this many seconds; they aren't remembered unless
+            it's set.
+        @type negative_cache_ttl: C{float}
+        @attention: Keep C{negative_cache_ttl} short, as new accounts can't
+            log in until their login is forgotten.
+        @param negative_cache_size: How many such logins to remember at most.
+        @type negative_cache_size: C{int}
+        @param fetch_attributes: Attributes to fetch along with the DN, so
+            that L{ShibbolethAttributesPlugin} doesn't have to search the
+            directory again for the same entry during the login request; an
+            iterable or a comma-separated list in a string. Use C{*} to
+            fetch all the user attributes.
+        @type fetch_attributes: C{iterable} or C{str}
+        @param mirror: A L{repoze.who.plugins.shibboleth.mirror.DirectoryMirror}
+            of the logins to look the DNs up in before searching them.
+        @param mirror_refresh_interval: If no C{mirror} is given, create one
+            for this plugin, loaded in the background when the plugin is
+            created and every so many seconds after that; no mirror is used
+            unless it's set. The logins are searched in the directory until
+            it's loaded, and when they aren't in it. The C{ldap_connection}
+            must be a pool then (e.g., with C{pool_max_size}), so that the
+            users aren't bound on the connection the mirror is loaded with.
+        @type mirror_refresh_interval: C{float}
+        @attention: The mirror is loaded by a thread, which doesn't survive a
+            fork: The plugins must be created in the worker processes.
+        @param mirror_page_size: How many entries the mirror loads at once.
+        @type mirror_page_size: C{int}
+        @param batch_search_size: How many logins L{authenticate_many}
+            searches at once, with their filters OR-ed.
+        @type batch_search_size: C{int}
 
-        @raise ValueError: If at least one of the parameters is not defined.
+        @raise ValueError: If at least one of the parameters is not defined,
+            or if C{mirror_refresh_interval} is set without a pool.
 
         The following parameters are inherited from 
         L{ShibbolethBaseAuthenticatorPlugin.__init__}
@@ -264,6 +694,7 @@ class ShibbolethSearchAuthenticatorPlugin(ShibbolethBaseAuthenticatorPlugin):
         @param bind_pass: The password for bind_dn directory entry
         
         """
+        self.naming_attribute = naming_attribute
         ShibbolethBaseAuthenticatorPlugin.__init__(self, ldap_connection, base_dn,
                                              **kwargs)
 
@@ -274,10 +705,44 @@ class ShibbolethSearchAuthenticatorPlugin(ShibbolethBaseAuthenticatorPlugin):
         else:
             raise ValueError("The search scope should be 'one[level]' or 'sub[tree]'")
 
+        self.restrict = restrict
         if restrict:
             self.search_pattern = u'(&%s(%s=%%s))' % (restrict,naming_attribute)
         else:
             self.search_pattern = u'(%s=%%s)' % naming_attribute
+        self.batch_search_size = int(batch_search_size)
+
+        self.dn_cache = make_cache(dn_cache, dn_cache_ttl, dn_cache_size,
+                                   dn_cache_jitter, path=self.cache_file,
+                                   namespace='dn')
+        self.negative_cache = make_cache(negative_cache, negative_cache_ttl,
+                                         negative_cache_size,
+                                         path=self.cache_file,
+                                         namespace='negative')
+
+        if hasattr(fetch_attributes, 'split'):
+            fetch_attributes = fetch_attributes.split(',')
+        if fetch_attributes:
+            self.fetch_attributes = list(fetch_attributes)
+        else:
+            self.fetch_attributes = None
+
+        if mirror is None and mirror_refresh_interval:
+            if not is_pool(self.ldap_connection):
+                raise ValueError('The mirror needs a pool of connections, '
+                                 'not to be searched as the users')
+            mirror = DirectoryMirror(
+                self.ldap_connection, base_dn, naming_attribute, restrict,
+                self.search_scope, mirror_refresh_interval,
+                page_size=mirror_page_size, bind_dn=self.bind_dn,
+                bind_pass=self.bind_pass)
+            mirror.start()
+        self.mirror = mirror
+
+    def _dn_cache_key(self, login):
+        """Return the key of the DN cached for C{login}."""
+        return ('dn', login.strip().lower(), self.base_dn, self.search_scope,
+                self.search_pattern)
 
     def _get_dn(self, environ, identity):
         """
@@ -299,28 +764,251 @@ class ShibbolethSearchAuthenticatorPlugin(ShibbolethBaseAuthenticatorPlugin):
         
         """
 
-        if self.bind_dn:
+        dn = self._cached_dn(environ, identity)
+        if dn is not None:
+            return dn
+        dn = self._mirrored_dn(identity)
+        if dn is not None:
+            return dn
+
+        srch = self._search_filter(identity)
+        try:
+            with checkout(self.ldap_connection, self.circuit_breaker) as conn:
+                if self.bind_dn:
+                    try:
+                        bind_service(conn, self.bind_dn, self.bind_pass,
+                                     self.metrics)
+                    except ldap.LDAPError, msg:
+                        if is_failure(msg):
+                            raise
+                        raise ValueError("Couldn't bind with supplied "
+                                         "credentials")
+                entries = self._search_entries(conn, srch)
+        except ldap.LDAPError, msg:
+            raise ValueError('Cannot search for %s: %s' % (srch, msg))
+        return self._pick_dn(environ, identity, srch, entries)
+
+    def _get_dns(self, environ, identities):
+        """
+        Return the DN of each identity, or C{None} for those whose DN can't
+        be found.
+
+        The DNs which aren't cached or mirrored are searched
+        C{batch_search_size} logins at a time, with a single filter OR-ing
+        theirs. The entries found are matched with the logins by their
+        naming attribute, stripped and lowercased like in the caches.
+
+        This can't tell all the matches the server made (e.g., ignoring the
+        case of non-ASCII letters, or the inner spaces), so only the logins
+        matching exactly one entry are settled by the batch: The others are
+        searched one by one with L{_get_dn}, like all those of the batches
+        where some entries matched no login, and only these searches may
+        record that a login matches no entry.
+
+        """
+        dns = [None] * len(identities)
+        # {normalized login: indexes of its identities}:
+        missing = {}
+        for (index, identity) in enumerate(identities):
             try:
-                self.ldap_connection.bind_s(self.bind_dn, self.bind_password)
-            except ldap.ShibbolethError:
-                raise ValueError("Couldn't bind with supplied credentials")
+                dn = (self._cached_dn(environ, identity) or
+                      self._mirrored_dn(identity))
+                if dn is None:
+                    login = identity['login'].strip().lower()
+                    missing.setdefault(login, []).append(index)
+            except (KeyError, TypeError, ValueError):
+                continue
+            dns[index] = dn
+        logins = sorted(missing)
+        for start in range(0, len(logins), self.batch_search_size):
+            chunk = logins[start:start + self.batch_search_size]
+            try:
+                found = self._search_logins(
+                    [identities[missing[login][0]]['login']
+                     for login in chunk])
+            except ValueError:
+                continue
+            for login in chunk:
+                identity = identities[missing[login][0]]
+                entries = (found or {}).get(login, [])
+                try:
+                    if len(entries) == 1:
+                        dn = self._pick_dn(environ, identity,
+                                           self._search_filter(identity),
+                                           entries)
+                    else:
+                        dn = self._get_dn(environ, identity)
+                except ValueError:
+                    continue
+                for index in missing[login]:
+                    dns[index] = dn
+        return dns
+
+    def _search_logins(self, logins):
+        """
+        Return the entries matching each of the C{logins}, found with one
+        search, as {normalized login: entries}, or C{None} if some of the
+        entries found match none of them once normalized.
+
+        @raise ValueError: If the search failed.
+
+        """
+        srch = u'(|%s)' % ''.join([
+            u'(%s=%s)' % (self.naming_attribute,
+                          ldap.filter.escape_filter_chars(login))
+            for login in logins])
+        if self.restrict:
+            srch = u'(&%s%s)' % (self.restrict, srch)
+        attrlist = [self.naming_attribute] + (self.fetch_attributes or [])
         try:
-            login_name = identity['login'].replace('*',r'\*')
-            srch = self.search_pattern % login_name
-            dn_list = self.ldap_connection.search_s(
-                self.base_dn,
-                self.search_scope,
-                srch,
-                )
-            
-            if len(dn_list) == 1:
-                return dn_list[0][0]
-            elif len(dn_list) > 1:
-                raise ValueError('Too many entries found for %s' % srch)
+            with checkout(self.ldap_connection, self.circuit_breaker) as conn:
+                if self.bind_dn:
+                    try:
+                        bind_service(conn, self.bind_dn, self.bind_pass,
+                                     self.metrics)
+                    except ldap.LDAPError, msg:
+                        if is_failure(msg):
+                            raise
+                        raise ValueError("Couldn't bind with supplied "
+                                         "credentials")
+                with timed(self.metrics, 'search', conn):
+                    results = conn.search_s(self.base_dn, self.search_scope,
+                                            srch, attrlist)
+        except ldap.LDAPError, msg:
+            raise ValueError('Cannot search for %s: %s' % (srch, msg))
+        wanted = set([login.strip().lower() for login in logins])
+        found = {}
+        for (dn, attributes) in entries_only(results):
+            matched = False
+            for (name, values) in attributes.iteritems():
+                if name.lower() != self.naming_attribute.lower():
+                    continue
+                if isinstance(values, basestring):
+                    values = [values]
+                for login in set([value.strip().lower() for value in values]):
+                    if login in wanted:
+                        found.setdefault(login, []).append((dn, attributes))
+                        matched = True
+            if not matched:
+                return None
+        return found
+
+    def _cached_dn(self, environ, identity):
+        """
+        Return the DN found earlier during the request or cached for the
+        C{login} of the identity, if any.
+
+        @raise ValueError: If the login is known not to match one entry.
+
+        """
+        cache_key = self._dn_cache_key(identity['login'])
+        memoized = request_memo(environ).get(cache_key)
+        if memoized is not None:
+            dn, error = memoized
+            if error is not None:
+                raise ValueError(error)
+            return dn
+        if self.dn_cache is not None:
+            dn = self.dn_cache.get(cache_key)
+            count_lookup(self.metrics, 'dn', dn is not None)
+            if dn is not None:
+                return dn
+        if self.negative_cache is not None:
+            error = self.negative_cache.get(cache_key)
+            count_lookup(self.metrics, 'negative', error is not None)
+            if error is not None:
+                raise ValueError(error)
+        return None
+
+    def _changed_attributes(self):
+        return (self.naming_attribute,)
+
+    def invalidate(self, dn, attributes=None):
+        """
+        Forget what's cached about the entry C{dn}, which changed: its
+        password and whether its logins match an entry.
+
+        """
+        ShibbolethBaseAuthenticatorPlugin.invalidate(self, dn, attributes)
+        if self.dn_cache is None and self.negative_cache is None:
+            return
+        for (name, values) in (attributes or {}).iteritems():
+            if name.lower() != self.naming_attribute.lower():
+                continue
+            if isinstance(values, basestring):
+                values = [values]
+            for login in values:
+                cache_key = self._dn_cache_key(login)
+                for cache in (self.dn_cache, self.negative_cache):
+                    if cache is not None:
+                        cache.delete(cache_key)
+
+    def _mirrored_dn(self, identity):
+        """Return the DN of the C{login} of the identity in the mirror, if any."""
+        if self.mirror is None or not self.mirror.ready:
+            return None
+        dn = self.mirror.lookup(identity['login'])
+        count_lookup(self.metrics, 'mirror', dn is not None)
+        return dn
+
+    def _search_filter(self, identity):
+        """Return the filter to search the entry of the identity with."""
+        login_name = ldap.filter.escape_filter_chars(identity['login'])
+        return self.search_pattern % login_name
+
+    def _pick_dn(self, environ, identity, srch, entries):
+        """
+        Return the DN of the only entry found by the search C{srch}.
+
+        The outcome is cached, as well as the fetched attributes.
+
+        @raise ValueError: If there's not exactly one entry.
+
+        """
+        cache_key = self._dn_cache_key(identity['login'])
+        if len(entries) == 1:
+            dn, attributes = entries[0]
+            if self.fetch_attributes:
+                fetched = set([name.lower() for name in self.fetch_attributes])
+                environ.setdefault(ENTRIES_KEY, {})[dn] = (fetched, attributes)
+            request_memo(environ)[cache_key] = (dn, None)
+            if self.dn_cache is not None:
+                self.dn_cache.set(cache_key, dn)
+            return dn
+        elif len(entries) > 1:
+            error = 'Too many entries found for %s' % srch
+        else:
+            error = 'No entry found for %s' % srch
+        request_memo(environ)[cache_key] = (None, error)
+        if self.negative_cache is not None:
+            self.negative_cache.set(cache_key, error)
+        raise ValueError(error)
+
+    def _search_entries(self, conn, srch):
+        """
+        Return (at most two of) the entries matching C{srch}.
+
+        Only the C{fetch_attributes} are requested, if any, and the server
+        is asked to stop after the second entry, as that's enough to tell
+        the login is ambiguous.
+
+        @raise ldap.LDAPError: If the search failed.
+
+        """
+        attrlist = self.fetch_attributes or ['1.1']
+        with timed(self.metrics, 'search', conn):
+            if hasattr(conn, 'search_ext_s'):
+                try:
+                    results = conn.search_ext_s(self.base_dn,
+                                                self.search_scope, srch,
+                                                attrlist=attrlist,
+                                                sizelimit=2)
+                except ldap.SIZELIMIT_EXCEEDED:
+                    return [None, None]
             else:
-                raise ValueError('No entry found for %s' %srch)
-        except (KeyError, TypeError, ldap.ShibbolethError):
-            raise # ValueError
+                results = conn.search_s(self.base_dn, self.search_scope, srch,
+                                        attrlist)
+        return entries_only(results)
 
 
 #{ Metadata providers
@@ -335,12 +1023,29 @@ class ShibbolethAttributesPlugin(object):
     
     def __init__(self, ldap_connection, attributes=None,
                  filterstr='(objectClass=*)', start_tls='',
-                 bind_dn='', bind_pass=''):
+                 bind_dn='', bind_pass='', pool_min_size=0,
+                 pool_max_size=None, pool_timeout=None,
+                 pool_idle_timeout=None, cache=None, cache_ttl=None,
+                 cache_size=1000, cache_max_bytes=None, network_timeout=None,
+                 operation_timeout=None, circuit_breaker=None,
+                 breaker_threshold=None, breaker_reset_timeout=30,
+                 server_weights=None, server_strategy='round-robin',
+                 server_max_failures=3, server_retry_interval=30,
+                 metrics=None, cache_file=None, lazy_key=None,
+                 userdata_secret=None, userdata_max_age=300,
+                 userdata_max_size=1024, change_feed=None,
+                 change_poll_interval=None, change_base_dn=None,
+                 released_attributes=None, released_use_headers=False,
+                 released_trusted_proxies=None,
+                 userdata_excluded_attributes=None):
         """
         Fetch Shibboleth attributes of the authenticated user.
         
-        @param ldap_connection: The Shibboleth connection to use to fetch this data.
-        @type ldap_connection: C{ldap.ldapobject.SimpleShibbolethObject} or C{str}
+        @param ldap_connection: The Shibboleth connection to use to fetch this
+            data, a connection pool, the LDAP URL of the server or the URLs
+            of several equivalent servers.
+        @type ldap_connection: C{ldap.ldapobject.SimpleShibbolethObject},
+            L{LDAPConnectionPool}, L{LDAPServerGroup}, C{str} or C{list}
         @param attributes: The authenticated user's Shibboleth attributes you want to
             use in your application; an interable or a comma-separate list of
             attributes in a string, or C{None} to fetch them all.
@@ -356,9 +1061,106 @@ class ShibbolethAttributesPlugin(object):
         @type bind_dn: C{str}
         @param bind_pass: The password for bind_dn directory entry
         @type bind_pass: C{str}
+        @param pool_min_size: See L{ShibbolethBaseAuthenticatorPlugin.__init__}
+        @param pool_max_size: See L{ShibbolethBaseAuthenticatorPlugin.__init__}
+        @param pool_timeout: See L{ShibbolethBaseAuthenticatorPlugin.__init__}
+        @param pool_idle_timeout: See
+            L{ShibbolethBaseAuthenticatorPlugin.__init__}
+        @param cache: A cache for the attributes found, such as
+            L{repoze.who.plugins.shibboleth.cache.TTLCache}.
+        @param cache_ttl: If no C{cache} is given, cache the attributes of
+            each user for this many seconds; they aren't cached unless it's
+            set.
+        @type cache_ttl: C{float}
+        @param cache_size: How many users' attributes to cache at most.
+        @type cache_size: C{int}
+        @param cache_max_bytes: Roughly how many bytes the cached attributes
+            may use at most.
+        @type cache_max_bytes: C{int}
+        @param network_timeout: See
+            L{ShibbolethBaseAuthenticatorPlugin.__init__}
+        @param operation_timeout: See
+            L{ShibbolethBaseAuthenticatorPlugin.__init__}
+        @param circuit_breaker: See
+            L{ShibbolethBaseAuthenticatorPlugin.__init__}
+        @param breaker_threshold: If no C{circuit_breaker} is given, stop
+            contacting the directory after this many consecutive failures
+            for C{breaker_reset_timeout} seconds; meanwhile, the identities
+            only get the attributes which were cached.
+        @param breaker_reset_timeout: See
+            L{ShibbolethBaseAuthenticatorPlugin.__init__}
+        @param server_weights: See
+            L{ShibbolethBaseAuthenticatorPlugin.__init__}
+        @param server_strategy: See
+            L{ShibbolethBaseAuthenticatorPlugin.__init__}
+        @param server_max_failures: See
+            L{ShibbolethBaseAuthenticatorPlugin.__init__}
+        @param server_retry_interval: See
+            L{ShibbolethBaseAuthenticatorPlugin.__init__}
+        @param metrics: See L{ShibbolethBaseAuthenticatorPlugin.__init__}
+        @param cache_file: The path to a file in which to keep the cached
+            attributes, so that all the processes of the host share them;
+            C{cache_max_bytes} doesn't apply then.
+        @type cache_file: C{str}
+        @param lazy_key: If set, don't fetch the attributes in
+            C{add_metadata}, but put under this key of the identity a
+            L{LazyAttributes} mapping, which fetches them when it's first
+            used; the requests which don't use them don't search the
+            directory then. The snapshot in the C{userdata} (see
+            C{userdata_secret}) is only refreshed when they are used, and
+            reaches the identifiers only if they are used before the
+            identity is remembered.
+        @type lazy_key: C{str}
+        @param userdata_secret: If set, keep a signed snapshot of the
+            attributes in the C{userdata} of the identity (e.g., in the
+            C{auth_tkt} cookie), and use it instead of searching the
+            directory until it's C{userdata_max_age} seconds old. The
+            authenticator should be given the same secret. The snapshot is
+            signed but not encrypted, so the users can read it: Put the
+            sensitive attributes in C{userdata_excluded_attributes}.
+        @type userdata_secret: C{str}
+        @param userdata_max_age: How many seconds a snapshot is used for.
+        @type userdata_max_age: C{float}
+        @param userdata_max_size: How many bytes the token holding the DN
+            and the snapshot may take in the C{userdata}; there's no
+            snapshot if it would take more.
+        @type userdata_max_size: C{int}
+        @param change_feed: See
+            L{ShibbolethBaseAuthenticatorPlugin.__init__}; the cached
+            attributes of the entries changed are forgotten.
+        @param change_poll_interval: See
+            L{ShibbolethBaseAuthenticatorPlugin.__init__}; the entries below
+            C{change_base_dn} are polled.
+        @param change_base_dn: The base DN of the users, to poll the changes
+            below.
+        @type change_base_dn: C{str}
+        @param released_attributes: The attributes the Shibboleth SP may
+            release in the environ, which are taken from there rather than
+            from the directory; an iterable or a comma-separated list in a
+            string of C{name} or C{name=variable}, when the variable isn't
+            named after the attribute. The directory isn't searched when
+            all the C{attributes} were released, so they must be listed for
+            that. They are only taken for the identities found by
+            L{repoze.who.plugins.shibboleth.sp.ShibbolethSPPlugin}, as the
+            SP released them about its own user.
+        @type released_attributes: C{iterable} or C{str}
+        @param released_use_headers: Whether the SP passes the attributes as
+            HTTP headers; see
+            L{repoze.who.plugins.shibboleth.sp.ShibbolethSPPlugin.__init__}.
+        @type released_use_headers: C{bool}
+        @param released_trusted_proxies: The addresses or networks of the
+            proxies whose released attributes are trusted; see
+            L{repoze.who.plugins.shibboleth.sp.ShibbolethSPPlugin.__init__}.
+        @type released_trusted_proxies: C{iterable} or C{str}
+        @param userdata_excluded_attributes: The attributes which must not
+            be kept in the C{userdata}, as an iterable or a comma-separated
+            list in a string; when they are fetched, no snapshot is taken.
+            C{userPassword} never is.
+        @type userdata_excluded_attributes: C{iterable} or C{str}
         @raise ValueError: If L{make_ldap_connection} could not create a
-            connection from C{ldap_connection}, or if C{attributes} is not an
-            iterable.
+            connection from C{ldap_connection}, if C{attributes} is not an
+            iterable, or if C{released_use_headers} is set without
+            C{released_trusted_proxies}.
 
         The following parameters are inherited from 
         L{ShibbolethBaseAuthenticatorPlugin.__init__}
@@ -380,79 +1182,742 @@ class ShibbolethAttributesPlugin(object):
             attributes = list(attributes)
         elif attributes is not None:
             raise ValueError('The needed Shibboleth attributes are not valid')
-        self.ldap_connection = make_ldap_connection(ldap_connection)
+        self.ldap_connection = make_ldap_connection(
+            ldap_connection, pool_min_size=pool_min_size,
+            pool_max_size=pool_max_size, pool_timeout=pool_timeout,
+            pool_idle_timeout=pool_idle_timeout, start_tls=start_tls,
+            bind_dn=bind_dn, bind_pass=bind_pass,
+            network_timeout=network_timeout,
+            operation_timeout=operation_timeout,
+            server_weights=server_weights, server_strategy=server_strategy,
+            server_max_failures=server_max_failures,
+            server_retry_interval=server_retry_interval)
         if start_tls:
-            try:
-                self.ldap_connection.start_tls_s()
-            except:
-                raise ValueError('Cannot upgrade the connection')
+            upgrade_connection(self.ldap_connection)
 
         self.bind_dn   = bind_dn
         self.bind_pass = bind_pass
+        self.operation_timeout = operation_timeout
+        self.circuit_breaker = make_breaker(circuit_breaker,
+                                            breaker_threshold,
+                                            breaker_reset_timeout)
+        self.metrics = metrics
         self.attributes = attributes
         self.filterstr = filterstr
+        self.cache = make_cache(cache, cache_ttl, cache_size,
+                                max_bytes=cache_max_bytes, path=cache_file,
+                                namespace='attributes')
+        self.lazy_key = lazy_key
+        if hasattr(userdata_excluded_attributes, 'split'):
+            userdata_excluded_attributes = \
+                userdata_excluded_attributes.split(',')
+        if userdata_secret:
+            self.userdata_codec = UserdataCodec(
+                userdata_secret, userdata_max_age, userdata_max_size,
+                userdata_excluded_attributes or ())
+        else:
+            self.userdata_codec = None
+        self.change_feed = make_change_feed(
+            change_feed, change_poll_interval, self.ldap_connection,
+            change_base_dn, bind_dn, bind_pass)
+        if self.change_feed is not None:
+            self.change_feed.subscribe(self.invalidate)
+        if hasattr(released_attributes, 'split'):
+            released_attributes = released_attributes.split(',')
+        # [(attribute, variable)]:
+        self.released_attributes = []
+        for name in released_attributes or ():
+            name, _, variable = name.strip().partition('=')
+            if name:
+                self.released_attributes.append((name.strip(),
+                                                 variable.strip() or
+                                                 name.strip()))
+        self.released_use_headers = bool(released_use_headers)
+        if released_trusted_proxies:
+            self.released_trusted_proxies = AddressMatcher(
+                released_trusted_proxies)
+        elif self.released_use_headers:
+            raise ValueError('The headers can only be trusted from trusted '
+                             'proxies')
+        else:
+            self.released_trusted_proxies = None
+
+    def invalidate(self, dn, attributes=None):
+        """
+        Forget the cached attributes of the entry C{dn}, which changed.
+
+        @param attributes: See
+            L{ShibbolethBaseAuthenticatorPlugin.invalidate}.
+
+        """
+        if self.cache is not None:
+            self.cache.delete(self._cache_key(dn))
     
     # IMetadataProvider
     def add_metadata(self, environ, identity):
         """
         Add metadata about the authenticated user to the identity.
         
-        It modifies the C{identity} dictionary to add the metadata.
+        It modifies the C{identity} dictionary to add the metadata, unless
+        they had to be searched while the circuit breaker is open. If
+        C{lazy_key} is set, it only adds a L{LazyAttributes} mapping there.
         
         @param environ: The WSGI environment.
         @param identity: The repoze.who's identity dictionary.
         
         """
-        # Search arguments:
-        dnmatch = self.dnrx.match(identity.get('userdata',''))
-        if dnmatch:
-            dn = b64decode(dnmatch.group('b64dn'))
-        else:
-            dn = identity.get('repoze.who.userid')
+        with timed_call(self.metrics, 'add_metadata'):
+            self._add_metadata(environ, identity)
+
+    def _add_metadata(self, environ, identity):
+        if self.lazy_key:
+            self._add_lazy_metadata(environ, identity)
+            return
+        dn = self._user_dn(identity)
+        attributes = self._load_attributes(environ, identity, dn)
+        if attributes is not None:
+            self._update_identity(identity, attributes)
+
+    def _add_lazy_metadata(self, environ, identity):
+        """
+        Add the attributes as a L{LazyAttributes} mapping.
+
+        It keeps what the plugin uses of the environ, not the environ
+        itself, as it may outlive the request.
+
+        """
+        dn = self._user_dn(identity)
+        # Parsed now, and memoized:
+        self._released(environ, identity)
+        request = {MEMO_KEY: request_memo(environ),
+                   'repoze.who.logger': environ.get('repoze.who.logger')}
+        if ENTRIES_KEY in environ:
+            request[ENTRIES_KEY] = environ[ENTRIES_KEY]
+        identity[self.lazy_key] = LazyAttributes(
+            lambda: self._load_attributes(request, identity, dn))
+
+    def _load_attributes(self, environ, identity, dn):
+        """
+        Return the attributes of C{dn}, or C{None} if they had to be
+        searched while the circuit breaker is open.
+
+        """
+        released = self._released(environ, identity)
+        if self._all_released(released):
+            return released
+        attributes = self._snapshot(identity, dn)
+        if attributes is None:
+            attributes = self._known_attributes(environ, dn)
+            if attributes is None:
+                try:
+                    attributes = self._search(environ, identity, dn)
+                except CircuitOpen:
+                    return released or None
+                self._found_attributes(environ, dn, attributes)
+            self._take_snapshot(identity, dn, attributes)
+        return self._with_released(attributes, released)
+
+    def _released(self, environ, identity):
+        """
+        Return the C{released_attributes} the SP put in C{environ}, with
+        their values split, as {name: values}.
+
+        They are parsed once per request, and only returned if C{identity}
+        is the user of the SP.
+
+        """
+        if not self.released_attributes or USERID_KEY not in identity:
+            return {}
+        memo_key = ('released', tuple(self.released_attributes),
+                    self.released_use_headers)
+        memo = request_memo(environ)
+        if memo_key in memo:
+            return memo[memo_key]
+        released = {}
+        if (self.released_trusted_proxies is None or
+            self.released_trusted_proxies.match(environ.get('REMOTE_ADDR'))):
+            for (name, variable) in self.released_attributes:
+                if self.released_use_headers:
+                    variable = 'HTTP_' + variable.upper().replace('-', '_')
+                values = split_values(environ.get(variable))
+                if values:
+                    released[name] = values
+        memo[memo_key] = released
+        return released
+
+    def _all_released(self, released):
+        """
+        Tell whether the SP released all the C{attributes}, so that the
+        directory needn't be searched.
+
+        """
+        if not self.released_attributes:
+            return False
+        hit = self.attributes is not None and set(
+            [name.lower() for name in self.attributes]).issubset(
+                [name.lower() for name in released])
+        count_lookup(self.metrics, 'released', hit)
+        return hit
+
+    def _with_released(self, attributes, released):
+        """
+        Return the C{attributes} found in the directory with those the SP
+        C{released} in their place.
+
+        """
+        if not released:
+            return attributes
+        names = set([name.lower() for name in released])
+        attributes = dict([(name, values) for (name, values)
+                           in attributes.iteritems()
+                           if name.lower() not in names])
+        attributes.update(released)
+        return attributes
+
+    def _snapshot(self, identity, dn):
+        """
+        Return the attributes of C{dn} in the C{userdata} of the identity,
+        if they are there and still fresh.
+
+        """
+        if self.userdata_codec is None:
+            return None
+        userdata = self.userdata_codec.decode(identity.get('userdata'))
+        hit = (userdata is not None and userdata.dn == dn and
+               self.userdata_codec.fresh(userdata, self._snapshot_names()))
+        count_lookup(self.metrics, 'userdata', hit)
+        if hit:
+            return userdata.attributes
+        return None
+
+    def _take_snapshot(self, identity, dn, attributes):
+        """Put the C{attributes} of C{dn} in the C{userdata} of the identity."""
+        if self.userdata_codec is None:
+            return
+        token = self.userdata_codec.encode(dn, attributes,
+                                           self._snapshot_names())
+        identity['userdata'] = self.userdata_codec.replace(
+            identity.get('userdata'), token)
+
+    def _snapshot_names(self):
+        """Return the attribute names to record with the snapshots."""
+        if self.attributes is None:
+            return ('*',)
+        return tuple(sorted([name.lower() for name in self.attributes]))
+
+    def _user_dn(self, identity):
+        """Return the DN of the authenticated user."""
+        return identity_dn(identity, self.userdata_codec)
+
+    def _known_attributes(self, environ, dn):
+        """
+        Return the attributes of C{dn} if they can be had without searching
+        the directory.
+
+        """
+        attributes = request_memo(environ).get(self._cache_key(dn))
+        if attributes is not None:
+            return attributes
+        if self.cache is not None:
+            attributes = self.cache.get(self._cache_key(dn))
+            count_lookup(self.metrics, 'attributes', attributes is not None)
+            if attributes is not None:
+                return attributes
+        attributes = self._prefetched(environ, dn)
+        if ENTRIES_KEY in environ:
+            count_lookup(self.metrics, 'prefetched', attributes is not None)
+        if attributes is not None:
+            self._found_attributes(environ, dn, attributes)
+        return attributes
+
+    def _found_attributes(self, environ, dn, attributes):
+        """
+        Record the attributes of C{dn} for the rest of the request and for
+        later requests.
+
+        """
+        request_memo(environ)[self._cache_key(dn)] = attributes
+        if self.cache is not None:
+            self.cache.set(self._cache_key(dn), attributes)
+
+    def _update_identity(self, identity, attributes):
+        # Copying the values, which the application may modify:
+        for (name, values) in attributes.iteritems():
+            if isinstance(values, list):
+                values = list(values)
+            identity[name] = values
+
+    def _search(self, environ, identity, dn):
+        """Return the attributes of the entry C{dn} found in the directory."""
         args = (
             dn,
             ldap.SCOPE_BASE,
             self.filterstr,
             self.attributes
         )
-        if self.bind_dn:
-            try:
-                self.ldap_connection.bind_s(self.bind_dn, self.bind_pass)
-            except ldap.ShibbolethError:
-                raise ValueError("Couldn't bind with supplied credentials")
         try:
-            attributes = self.ldap_connection.search_s(*args)
-        except ldap.ShibbolethError, msg:
+            with checkout(self.ldap_connection, self.circuit_breaker) as conn:
+                if self.bind_dn:
+                    try:
+                        bind_service(conn, self.bind_dn, self.bind_pass,
+                                     self.metrics)
+                    except ldap.LDAPError, msg:
+                        if is_failure(msg):
+                            raise
+                        raise ValueError("Couldn't bind with supplied "
+                                         "credentials")
+                with timed(self.metrics, 'search', conn):
+                    attributes = conn.search_s(*args)
+        except CircuitOpen:
+            raise
+        except ldap.LDAPError, msg:
             environ['repoze.who.logger'].warn('Cannot add metadata: %s' % msg)
-            raise Exception(identity)
+            raise AttributesUnavailable(identity)
+        return attributes[0][1]
+
+    def _prefetched(self, environ, dn):
+        """
+        Return the attributes of the entry C{dn} which an authenticator
+        already fetched during this request, if they are the ones we need.
+
+        """
+        if self.filterstr != '(objectClass=*)':
+            return None
+        try:
+            fetched, attributes = environ[ENTRIES_KEY][dn]
+        except (KeyError, TypeError):
+            return None
+        if self.attributes is None:
+            if '*' in fetched:
+                return attributes
+            return None
+        wanted = set([name.lower() for name in self.attributes])
+        if not wanted.issubset(fetched):
+            return None
+        return dict([(name, values) for (name, values)
+                     in attributes.iteritems() if name.lower() in wanted])
+
+    def _cache_key(self, dn):
+        """Return the key of the attributes cached for C{dn}."""
+        if self.attributes is None:
+            attributes = None
+        else:
+            attributes = tuple(self.attributes)
+        return ('attributes', normalize_dn(dn), attributes, self.filterstr)
+
+
+class ShibbolethGroupsPlugin(object):
+    """
+    Loads the groups the authenticated user belongs to, directly or through
+    other groups.
+
+    The groups are looked up in a L{GroupGraph}, a copy of the memberships
+    of all the groups refreshed in the background, so that adding them to
+    the identities doesn't search the directory and checking them is a set
+    lookup.
+
+    """
+
+    implements(IMetadataProvider)
+
+    def __init__(self, ldap_connection, base_dn, filterstr=GROUPS_FILTER,
+                 member_attributes='member,uniqueMember',
+                 naming_attribute='cn', returned_id='name',
+                 identity_key='groups', refresh_interval=300,
+                 retry_interval=60, page_size=500, graph=None, start_tls='',
+                 bind_dn='', bind_pass='', pool_min_size=0, pool_max_size=None,
+                 pool_timeout=None, pool_idle_timeout=None,
+                 network_timeout=None, operation_timeout=None,
+                 server_weights=None, server_strategy='round-robin',
+                 server_max_failures=3, server_retry_interval=30,
+                 metrics=None, userdata_secret=None):
+        """
+        Fetch the groups of the authenticated user.
+
+        @param ldap_connection: See L{ShibbolethAttributesPlugin.__init__}.
+        @param base_dn: The base DN of the groups, such as
+            C{ou=groups,dc=example,dc=org}.
+        @type base_dn: C{str}
+        @param filterstr: The filter matching the groups.
+        @type filterstr: C{str}
+        @param member_attributes: The attributes holding the DNs of the
+            members of the groups; an iterable or a comma-separated list in a
+            string.
+        @type member_attributes: C{iterable} or C{str}
+        @param naming_attribute: The attribute holding the names of the
+            groups.
+        @type naming_attribute: C{str}
+        @param returned_id: Whether to add the names of the groups
+            (C{name}) or their DNs (C{dn}) to the identity.
+        @type returned_id: C{str}
+        @param identity_key: The key of the identity to put the set of groups
+            under.
+        @type identity_key: C{str}
+        @param refresh_interval: If no C{graph} is given, reload the groups
+            every so many seconds; the changes of membership show up that
+            late at most.
+        @type refresh_interval: C{float}
+        @param retry_interval: How many seconds to wait after a failed load.
+        @type retry_interval: C{float}
+        @param page_size: How many groups to load at once.
+        @type page_size: C{int}
+        @param graph: A L{GroupGraph} to use as is, e.g. to share it between
+            plugins.
+        @attention: The graph is refreshed by a thread, which doesn't survive
+            a fork: The plugins must be created in the worker processes.
+        @param start_tls: See L{ShibbolethAttributesPlugin.__init__}
+        @param bind_dn: See L{ShibbolethAttributesPlugin.__init__}
+        @param bind_pass: See L{ShibbolethAttributesPlugin.__init__}
+        @param pool_min_size: See L{ShibbolethBaseAuthenticatorPlugin.__init__}
+        @param pool_max_size: See L{ShibbolethBaseAuthenticatorPlugin.__init__}
+        @param pool_timeout: See L{ShibbolethBaseAuthenticatorPlugin.__init__}
+        @param pool_idle_timeout: See
+            L{ShibbolethBaseAuthenticatorPlugin.__init__}
+        @param network_timeout: See
+            L{ShibbolethBaseAuthenticatorPlugin.__init__}
+        @param operation_timeout: See
+            L{ShibbolethBaseAuthenticatorPlugin.__init__}
+        @param server_weights: See
+            L{ShibbolethBaseAuthenticatorPlugin.__init__}
+        @param server_strategy: See
+            L{ShibbolethBaseAuthenticatorPlugin.__init__}
+        @param server_max_failures: See
+            L{ShibbolethBaseAuthenticatorPlugin.__init__}
+        @param server_retry_interval: See
+            L{ShibbolethBaseAuthenticatorPlugin.__init__}
+        @param metrics: See L{ShibbolethBaseAuthenticatorPlugin.__init__}
+        @param userdata_secret: See L{ShibbolethAttributesPlugin.__init__};
+            only the DN of the user is read from the C{userdata}.
+        @raise ValueError: If L{make_ldap_connection} could not create a
+            connection from C{ldap_connection}, or if C{returned_id} is not
+            valid.
+
+        """
+        if returned_id not in ('name', 'dn'):
+            raise ValueError('The groups can only be returned by name or dn')
+        if hasattr(member_attributes, 'split'):
+            member_attributes = member_attributes.split(',')
+        self.ldap_connection = make_ldap_connection(
+            ldap_connection, pool_min_size=pool_min_size,
+            pool_max_size=pool_max_size, pool_timeout=pool_timeout,
+            pool_idle_timeout=pool_idle_timeout, start_tls=start_tls,
+            bind_dn=bind_dn, bind_pass=bind_pass,
+            network_timeout=network_timeout,
+            operation_timeout=operation_timeout,
+            server_weights=server_weights, server_strategy=server_strategy,
+            server_max_failures=server_max_failures,
+            server_retry_interval=server_retry_interval)
+        if start_tls:
+            upgrade_connection(self.ldap_connection)
+        self.returned_id = returned_id
+        self.identity_key = identity_key
+        self.metrics = metrics
+        if userdata_secret:
+            self.userdata_codec = UserdataCodec(userdata_secret)
+        else:
+            self.userdata_codec = None
+        if graph is None:
+            graph = GroupGraph(
+                self.ldap_connection, base_dn, filterstr,
+                [name.strip() for name in member_attributes],
+                naming_attribute, refresh_interval=refresh_interval,
+                retry_interval=retry_interval, page_size=page_size,
+                bind_dn=bind_dn, bind_pass=bind_pass)
+            graph.start()
+        self.graph = graph
+
+    # IMetadataProvider
+    def add_metadata(self, environ, identity):
+        """
+        Add the set of the groups of the authenticated user to the identity.
+
+        The groups are loaded first if the graph isn't loaded yet; the
+        identity is left alone if they can't be.
+
+        @param environ: The WSGI environment.
+        @param identity: The repoze.who's identity dictionary.
+
+        """
+        with timed_call(self.metrics, 'add_metadata'):
+            self._add_metadata(environ, identity)
+
+    def _add_metadata(self, environ, identity):
+        count_lookup(self.metrics, 'groups', self.graph.ready)
+        try:
+            self.graph.ensure_loaded()
+        except ldap.LDAPError, msg:
+            environ['repoze.who.logger'].warn('Cannot add groups: %s' % msg)
+            return
+        dn = identity_dn(identity, self.userdata_codec)
+        if not dn:
+            return
+        groups = self.graph.groups_of(dn)
+        if self.returned_id == 'dn':
+            identity[self.identity_key] = set([dn for (dn, name) in groups])
         else:
-            identity.update(attributes[0][1])
+            identity[self.identity_key] = set([name for (dn, name) in groups])
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, id(self))
+
+
+class AttributesUnavailable(Exception):
+    """
+    The attributes of a user couldn't be searched in the directory; the
+    argument is the identity of the user.
+
+    """
+
+
+class LazyAttributes(MutableMapping):
+    """
+    The attributes of a user, fetched when they are first used.
+
+    It may be modified like a dictionary of the attributes; the changes
+    aren't written to the directory. Each operation may raise
+    L{AttributesUnavailable} if they have to be fetched and the directory
+    fails; the next use tries again.
+
+    """
+
+    def __init__(self, load):
+        """
+        @param load: The callable returning the attributes, as a dictionary,
+            or C{None} if they can't be fetched for now: they are all
+            missing then, and the next use tries to fetch them again. It's
+            dropped once they are fetched.
+
+        """
+        self._load = load
+        self._attributes = None
+
+    @property
+    def loaded(self):
+        """Whether the attributes were fetched already."""
+        return self._attributes is not None
+
+    def _get_attributes(self):
+        if self._attributes is None:
+            attributes = self._load()
+            if attributes is None:
+                return {}
+            # Copying the values, which the application may modify:
+            self._attributes = dict([
+                (name, isinstance(values, list) and list(values) or values)
+                for (name, values) in attributes.iteritems()])
+            self._load = None
+        return self._attributes
+
+    def __getitem__(self, name):
+        return self._get_attributes()[name]
+
+    def __setitem__(self, name, values):
+        self._get_attributes()[name] = values
+
+    def __delitem__(self, name):
+        del self._get_attributes()[name]
+
+    def __iter__(self):
+        return iter(self._get_attributes())
+
+    def __len__(self):
+        return len(self._get_attributes())
+
+    def __repr__(self):
+        if self._attributes is None:
+            return '<%s (not loaded)>' % self.__class__.__name__
+        return '<%s %r>' % (self.__class__.__name__, self._attributes)
 
 
 #{ Utilities
 
 
-def make_ldap_connection(ldap_connection):
+def make_ldap_connection(ldap_connection, pool_min_size=0, pool_max_size=None,
+                         pool_timeout=None, pool_idle_timeout=None,
+                         start_tls=False, bind_dn='', bind_pass='',
+                         network_timeout=None, operation_timeout=None,
+                         server_weights=None, server_strategy='round-robin',
+                         server_max_failures=3, server_retry_interval=30):
     """Return an Shibboleth connection object to the specified server.
     
-    If the C{ldap_connection} is already an Shibboleth connection object, it will
-    be returned as is. If it's an Shibboleth URL, it will return an Shibboleth connection
-    to the Shibboleth server specified in the URL.
+    If the C{ldap_connection} is already an Shibboleth connection object (or a
+    connection pool), it will be returned as is. If it's an Shibboleth URL, it
+    will return an Shibboleth connection to the Shibboleth server specified in
+    the URL, or a pool of such connections if C{pool_max_size} is set. If
+    there are several URLs, it will return an L{LDAPServerGroup} spreading
+    the connections over all those servers.
     
     @param ldap_connection: The Shibboleth connection object or the Shibboleth URL of the
-        server to be connected to.
-    @type ldap_connection: C{ldap.ldapobject.SimpleShibbolethObject}, C{str} or
-        C{unicode}
+        server to be connected to, or the URLs of several equivalent servers
+        as a list or separated by spaces.
+    @type ldap_connection: C{ldap.ldapobject.SimpleShibbolethObject},
+        L{LDAPConnectionPool}, L{LDAPServerGroup}, C{str}, C{unicode} or
+        C{list}
+    @param pool_min_size: The C{min_size} of the pool.
+    @param pool_max_size: The C{max_size} of the pool; no pool is created
+        unless it's set, or unless there are several servers.
+    @param pool_timeout: The checkout C{timeout} of the pool.
+    @param pool_idle_timeout: The C{idle_timeout} of the pool.
+    @param start_tls: Should the pool negotiate a TLS upgrade on each of its
+        connections?
+    @param bind_dn: The service account the pool binds its connections as.
+    @param bind_pass: The password for C{bind_dn}.
+    @param network_timeout: How many seconds to wait for the server when
+        connecting; see
+        L{repoze.who.plugins.shibboleth.pool.set_timeouts}.
+    @param operation_timeout: How many seconds to wait for the result of each
+        operation; see L{repoze.who.plugins.shibboleth.pool.set_timeouts}.
+    @param server_weights: The C{weights} of the servers.
+    @param server_strategy: The C{strategy} picking the servers.
+    @param server_max_failures: The C{max_failures} ejecting a server.
+    @param server_retry_interval: The C{retry_interval} of ejected servers.
     @return: The Shibboleth connection object.
-    @rtype: C{ldap.ldapobject.SimpleShibbolethObject}
+    @rtype: C{ldap.ldapobject.SimpleShibbolethObject}, L{LDAPConnectionPool}
+        or L{LDAPServerGroup}
     @raise ValueError: If C{ldap_connection} is C{None}.
     
     """
-    if isinstance(ldap_connection, str) or isinstance(ldap_connection, unicode):
-        return ldap.initialize(ldap_connection)
+    if isinstance(ldap_connection, basestring):
+        uris = ldap_connection.split()
+    elif isinstance(ldap_connection, (list, tuple)):
+        uris = list(ldap_connection)
     elif ldap_connection is None:
         raise ValueError('An Shibboleth connection must be specified')
-    return ldap_connection
+    else:
+        return ldap_connection
+    pool_options = dict(min_size=pool_min_size, timeout=pool_timeout,
+                        idle_timeout=pool_idle_timeout, start_tls=start_tls,
+                        bind_dn=bind_dn, bind_pass=bind_pass,
+                        network_timeout=network_timeout,
+                        operation_timeout=operation_timeout)
+    if len(uris) > 1:
+        return LDAPServerGroup(uris, weights=server_weights,
+                               strategy=server_strategy,
+                               max_failures=server_max_failures,
+                               retry_interval=server_retry_interval,
+                               max_size=pool_max_size or 10, **pool_options)
+    if not uris:
+        raise ValueError('An Shibboleth connection must be specified')
+    if pool_max_size:
+        return LDAPConnectionPool(uris[0], max_size=pool_max_size,
+                                  **pool_options)
+    conn = ldap.initialize(uris[0])
+    set_timeouts(conn, network_timeout, operation_timeout)
+    return conn
+
+
+def bind_service(conn, who, cred, metrics=None):
+    """
+    Bind C{conn} as the service account C{who} unless it's already bound so,
+    reporting the bind into C{metrics}.
+
+    @raise ldap.LDAPError: If the bind failed.
+
+    """
+    if is_bound(conn, who, cred):
+        return
+    with timed(metrics, 'service_bind', conn):
+        ensure_bound(conn, who, cred)
+
+
+def identity_dn(identity, userdata_codec=None):
+    """
+    Return the DN of the authenticated user of C{identity}: the one the
+    authenticators put in its C{userdata}, or else its user id.
+
+    @param userdata_codec: The
+        L{repoze.who.plugins.shibboleth.userdata.UserdataCodec} to read the
+        signed C{userdata} with, if any.
+
+    """
+    if userdata_codec is not None:
+        userdata = userdata_codec.decode(identity.get('userdata'))
+        if userdata is not None:
+            return userdata.dn
+    dn = decode_dn(identity.get('userdata'))
+    if dn is not None:
+        return dn
+    return identity.get('repoze.who.userid')
+
+
+def run_concurrently(function, calls, max_workers):
+    """
+    Call C{function(*arguments)} for each C{arguments} tuple in C{calls},
+    from up to C{max_workers} threads, and wait for all the calls to finish.
+
+    @raise Exception: The first exception raised by a call, once they are
+        all finished.
+
+    """
+    calls = list(calls)
+    if max_workers <= 1 or len(calls) <= 1:
+        for arguments in calls:
+            function(*arguments)
+        return
+    pending = iter(calls)
+    lock = threading.Lock()
+    errors = []
+
+    def work():
+        while True:
+            with lock:
+                arguments = next(pending, None)
+            if arguments is None:
+                return
+            try:
+                function(*arguments)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    workers = [threading.Thread(target=work)
+               for i in range(min(max_workers, len(calls)))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+
+def request_memo(environ):
+    """
+    Return the dictionary where the plugins memoize the outcome of their
+    directory operations during the request of C{environ}.
+
+    Entries are keyed by the same tuples as in the caches: e.g., C{('dn',
+    login, ...)} for the DN of a login, C{('attributes', dn, ...)} for the
+    attributes of an entry and C{('bind', dn, ...)} for whether a password
+    is valid.
+
+    """
+    return environ.setdefault(MEMO_KEY, {})
+
+
+def entries_only(results):
+    """
+    Return the entries in the C{results} of a search, leaving out the search
+    continuation references, which come without a DN.
+
+    """
+    return [(dn, attributes) for (dn, attributes) in results
+            if dn is not None]
+
+
+def upgrade_connection(ldap_connection):
+    """
+    Negotiate a TLS upgrade on C{ldap_connection}.
+
+    Pools upgrade their connections by themselves, so they are left alone.
+
+    @raise ValueError: If the connection could not be upgraded.
+
+    """
+    if is_pool(ldap_connection):
+        return
+    try:
+        ldap_connection.start_tls_s()
+    except:
+        raise ValueError('Cannot upgrade the connection')
 
 
 #}
@@ -0,0 +1,752 @@
+# -*- coding: utf-8 -*-
+#
+# repoze.who.plugins.shibboleth, Shibboleth authentication for WSGI applications.
+# Copyright (C) 2010 by Ralph Bean <http://threebean.wordpress.com/>
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+"""LDAP connection pooling for the Shibboleth plugins."""
+
+__all__ = ['LDAPConnectionPool', 'LDAPServerGroup', 'PoolTimeout', 'checkout',
+           'is_pool', 'set_timeouts', 'server_of', 'ensure_bound', 'bind_user',
+           'is_bound', 'mark_bound', 'forget_bind', 'paged_search']
+
+import threading
+import time
+
+from contextlib import contextmanager
+
+import ldap
+from ldap.controls import SimplePagedResultsControl
+
+
+class PoolTimeout(ldap.LDAPError):
+    """No pooled connection became available within the checkout timeout."""
+
+
+class LDAPConnectionPool(object):
+    """
+    A bounded, thread-safe pool of LDAP connections to the same server.
+
+    Connections are created lazily up to C{max_size}, handed out to one
+    thread at a time and put back once the operation is over. Idle
+    connections beyond C{min_size} are unbound after C{idle_timeout} seconds.
+
+    If C{bind_dn} is set, every connection is bound as that (service) account
+    as soon as it's opened and it's meant to stay so, which is why user
+    credentials must be checked against a separate pool (see L{copy}).
+
+    """
+
+    def __init__(self, uri, min_size=0, max_size=10, timeout=None,
+                 idle_timeout=None, start_tls=False, bind_dn='',
+                 bind_pass='', network_timeout=None, operation_timeout=None):
+        """
+        Create a pool of connections to the server at C{uri}.
+
+        All the numeric arguments may be given as strings, so that the pool
+        can be configured from an INI file.
+
+        @param uri: The LDAP URL of the server, or a callable returning a new
+            connection object each time it is called.
+        @type uri: C{str}, C{unicode} or C{callable}
+        @param min_size: The number of connections to open right away and to
+            keep open even when idle.
+        @type min_size: C{int}
+        @param max_size: The maximum number of connections open at once.
+        @type max_size: C{int}
+        @param timeout: How many seconds L{get} should wait for a connection
+            to be released when the pool is exhausted, or C{None} to wait
+            forever.
+        @type timeout: C{float}
+        @param idle_timeout: How many seconds an unused connection is kept
+            open, or C{None} to keep them open forever.
+        @type idle_timeout: C{float}
+        @param start_tls: Should we negotiate a TLS upgrade on every new
+            connection?
+        @type start_tls: C{bool}
+        @param bind_dn: The account to bind every new connection as.
+        @type bind_dn: C{str}
+        @param bind_pass: The password for C{bind_dn}.
+        @type bind_pass: C{str}
+        @param network_timeout: How many seconds to wait for the server when
+            connecting; see L{set_timeouts}.
+        @type network_timeout: C{float}
+        @param operation_timeout: How many seconds to wait for the result of
+            each operation; see L{set_timeouts}.
+        @type operation_timeout: C{float}
+        @raise ValueError: If the sizes are not consistent.
+
+        """
+        if uri is None:
+            raise ValueError('An LDAP URL must be specified')
+        self.uri = uri
+        self.min_size = int(min_size)
+        self.max_size = int(max_size)
+        if self.max_size < 1 or not 0 <= self.min_size <= self.max_size:
+            raise ValueError('The pool sizes should satisfy '
+                             '0 <= min_size <= max_size and max_size >= 1')
+        if timeout is not None:
+            timeout = float(timeout)
+        if idle_timeout is not None:
+            idle_timeout = float(idle_timeout)
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.start_tls = start_tls
+        self.bind_dn = bind_dn
+        self.bind_pass = bind_pass
+        self.network_timeout = network_timeout
+        self.operation_timeout = operation_timeout
+
+        self._lock = threading.Condition(threading.Lock())
+        # Idle connections as (connection, released_at), oldest first:
+        self._idle = []
+        # Connections which are open, whether idle or checked out:
+        self._size = 0
+
+        for i in range(self.min_size):
+            self._size += 1
+            self._idle.append((self._connect(), time.time()))
+
+    def _connect(self):
+        """Open a new connection to the server."""
+        if callable(self.uri):
+            conn = self.uri()
+        else:
+            conn = ldap.initialize(self.uri)
+        setattr(conn, _SERVER, self.uri)
+        set_timeouts(conn, self.network_timeout, self.operation_timeout)
+        if self.start_tls:
+            try:
+                conn.start_tls_s()
+            except ldap.LDAPError:
+                raise ValueError('Cannot upgrade the connection')
+        if self.bind_dn:
+            ensure_bound(conn, self.bind_dn, self.bind_pass)
+        return conn
+
+    def copy(self, **options):
+        """
+        Return a new, empty pool to the same server with the same settings.
+
+        @param options: The settings to override, with the same names as the
+            arguments of the constructor.
+
+        """
+        settings = dict(min_size=self.min_size, max_size=self.max_size,
+                        timeout=self.timeout, idle_timeout=self.idle_timeout,
+                        start_tls=self.start_tls, bind_dn=self.bind_dn,
+                        bind_pass=self.bind_pass,
+                        network_timeout=self.network_timeout,
+                        operation_timeout=self.operation_timeout)
+        settings.update(options)
+        return self.__class__(self.uri, **settings)
+
+    def _evict_idle(self):
+        """
+        Return the idle connections that outlived C{idle_timeout}.
+
+        Must be called with the lock held; the connections returned are no
+        longer accounted for and should be closed by the caller.
+
+        """
+        if self.idle_timeout is None:
+            return []
+        expired = []
+        limit = time.time() - self.idle_timeout
+        while (self._idle and self._idle[0][1] < limit and
+               self._size > self.min_size):
+            expired.append(self._idle.pop(0)[0])
+            self._size -= 1
+        return expired
+
+    def _close(self, connections):
+        for conn in connections:
+            try:
+                conn.unbind_s()
+            except ldap.LDAPError:
+                pass
+
+    def get(self, block=True):
+        """
+        Check a connection out of the pool.
+
+        The most recently released connection is preferred, so that the
+        least used ones are the first to be evicted when the load drops.
+
+        @param block: Wait up to C{timeout} for a connection to be released
+            if the pool is exhausted, instead of giving up right away.
+        @type block: C{bool}
+        @return: A connection that only the calling thread is using.
+        @raise PoolTimeout: If no connection was released within C{timeout}.
+
+        """
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        conn = None
+        reserved = False
+        expired = []
+        self._lock.acquire()
+        try:
+            while True:
+                expired.extend(self._evict_idle())
+                if self._idle:
+                    conn = self._idle.pop()[0]
+                    break
+                if self._size < self.max_size:
+                    # Reserve the slot; the connection is opened below,
+                    # without holding the lock.
+                    self._size += 1
+                    reserved = True
+                    break
+                if not block:
+                    break
+                if self.timeout is None:
+                    self._lock.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._lock.wait(remaining)
+        finally:
+            self._lock.release()
+        self._close(expired)
+
+        if conn is not None:
+            return conn
+        if not reserved:
+            if not block:
+                raise PoolTimeout('No LDAP connection available')
+            raise PoolTimeout('No LDAP connection available after %s '
+                              'seconds' % self.timeout)
+        try:
+            return self._connect()
+        except:
+            self._discard_slot()
+            raise
+
+    def put(self, conn, discard=False):
+        """
+        Return a connection obtained with L{get} to the pool.
+
+        @param conn: The connection.
+        @param discard: Close the connection instead of reusing it, e.g.
+            because the server went away.
+        @type discard: C{bool}
+
+        """
+        if discard:
+            self._discard_slot()
+            self._close([conn])
+            return
+        self._lock.acquire()
+        try:
+            self._idle.append((conn, time.time()))
+            self._lock.notify()
+        finally:
+            self._lock.release()
+
+    def _discard_slot(self):
+        self._lock.acquire()
+        try:
+            self._size -= 1
+            self._lock.notify()
+        finally:
+            self._lock.release()
+
+    def connection(self):
+        """
+        Check a connection out for the duration of a C{with} block.
+
+        The connection is discarded if the server went down while using it,
+        or if it gave up waiting for the server.
+
+        """
+        return _pooled(self)
+
+    def close(self):
+        """Close all the idle connections."""
+        self._lock.acquire()
+        try:
+            idle = [conn for (conn, released_at) in self._idle]
+            self._idle = []
+            self._size -= len(idle)
+        finally:
+            self._lock.release()
+        self._close(idle)
+
+    def __repr__(self):
+        return '<%s %s (%d/%d)>' % (self.__class__.__name__, self.uri,
+                                    self._size, self.max_size)
+
+
+class LDAPServerGroup(object):
+    """
+    A set of pools of connections to equivalent servers, such as the
+    replicas of a directory, which spreads the load over them and avoids the
+    ones which fail.
+
+    It's used like an L{LDAPConnectionPool}. Each connection is taken from
+    the server picked by the C{strategy}, or from the next one if the
+    former is exhausted or can't be reached. A server is ejected from the
+    rotation after C{max_failures} consecutive failures and readmitted
+    C{retry_interval} seconds later; one more failure ejects it again. If
+    all the servers are ejected, they are all tried anyway.
+
+    """
+
+    STRATEGIES = ('round-robin', 'least-outstanding')
+
+    def __init__(self, uris, weights=None, strategy='round-robin',
+                 max_failures=3, retry_interval=30, **pool_options):
+        """
+        Create a group of pools of connections to the servers at C{uris}.
+
+        @param uris: The LDAP URLs of the servers, or callables returning new
+            connections to each of them; a string is split on whitespace.
+        @type uris: C{iterable} or C{str}
+        @param weights: The relative share of the connections each server
+            gets, in the same order; an iterable or a comma-separated list in
+            a string. All the servers weigh 1 by default.
+        @type weights: C{iterable} or C{str}
+        @param strategy: How to pick the server of each connection:
+            C{round-robin} gives them in turn to each server according to its
+            weight, while C{least-outstanding} picks the server with the
+            fewest connections checked out, relative to its weight.
+        @type strategy: C{str}
+        @param max_failures: How many consecutive failures eject a server.
+        @type max_failures: C{int}
+        @param retry_interval: How many seconds a server stays ejected.
+        @type retry_interval: C{float}
+        @param pool_options: The arguments of the L{LDAPConnectionPool} of
+            each server, but its URL.
+        @raise ValueError: If the arguments are not consistent.
+
+        """
+        if hasattr(uris, 'split'):
+            uris = uris.split()
+        if uris is None or not list(uris):
+            raise ValueError('At least one LDAP URL must be specified')
+        uris = list(uris)
+        if hasattr(weights, 'split'):
+            weights = weights.split(',')
+        if not weights:
+            weights = [1] * len(uris)
+        weights = [int(weight) for weight in weights]
+        if len(weights) != len(uris) or min(weights) < 1:
+            raise ValueError('There must be one weight >= 1 per server')
+        if strategy not in self.STRATEGIES:
+            raise ValueError('The strategy should be one of %s' %
+                             ', '.join(self.STRATEGIES))
+        self.uris = uris
+        self.weights = weights
+        self.strategy = strategy
+        self.max_failures = int(max_failures)
+        self.retry_interval = float(retry_interval)
+        if self.max_failures < 1 or self.retry_interval < 0:
+            raise ValueError('The server group needs max_failures >= 1 and '
+                             'retry_interval >= 0')
+        self.pool_options = pool_options
+
+        self._lock = threading.Lock()
+        self._servers = [_Server(LDAPConnectionPool(uri, **pool_options),
+                                 weight)
+                         for (uri, weight) in zip(uris, weights)]
+        # The server of each connection checked out, by id:
+        self._owners = {}
+
+    @property
+    def timeout(self):
+        """How many seconds L{get} may wait for a connection."""
+        return self._servers[0].pool.timeout
+
+    def copy(self, **options):
+        """
+        Return a new group of empty pools to the same servers, with the same
+        settings.
+
+        @param options: The settings of the pools to override; see
+            L{LDAPConnectionPool.copy}.
+
+        """
+        pool_options = dict(self.pool_options)
+        pool_options.update(options)
+        return self.__class__(self.uris, self.weights, self.strategy,
+                              self.max_failures, self.retry_interval,
+                              **pool_options)
+
+    def _candidates(self):
+        """
+        Return the servers to try, in order.
+
+        Must be called with the lock held.
+
+        """
+        now = time.time()
+        available = []
+        ejected = []
+        for server in self._servers:
+            if server.ejected_until is not None and server.ejected_until <= now:
+                # Readmitted, but on probation:
+                server.ejected_until = None
+                server.failures = self.max_failures - 1
+            if server.ejected_until is None:
+                available.append(server)
+            else:
+                ejected.append(server)
+        if not available:
+            ejected.sort(key=lambda server: server.ejected_until)
+            return ejected
+        by_load = sorted(available, key=lambda server: float(
+            server.outstanding) / server.weight)
+        if self.strategy == 'least-outstanding':
+            return by_load
+        # Smooth weighted round-robin:
+        total = 0
+        for server in available:
+            server.current_weight += server.weight
+            total += server.weight
+        chosen = max(available, key=lambda server: server.current_weight)
+        chosen.current_weight -= total
+        by_load.remove(chosen)
+        return [chosen] + by_load
+
+    def get(self, block=True):
+        """
+        Check a connection out of the pool of one of the servers.
+
+        @param block: Wait up to C{timeout} for a connection to be released
+            if all the pools are exhausted, instead of giving up right away.
+        @type block: C{bool}
+        @raise PoolTimeout: If no connection was released within C{timeout}.
+        @raise ldap.LDAPError: If none of the servers could be reached.
+        @raise ValueError: If the connection to the last server tried
+            couldn't be set up (e.g., with C{start_tls}).
+
+        """
+        self._lock.acquire()
+        try:
+            candidates = self._candidates()
+        finally:
+            self._lock.release()
+        exhausted = []
+        error = None
+        for server in candidates:
+            try:
+                conn = server.pool.get(block=False)
+            except PoolTimeout:
+                exhausted.append(server)
+            except Exception, error:
+                # Whatever went wrong while connecting counts against it.
+                self._record(server, failed=True)
+            else:
+                return self._checked_out(server, conn)
+        if exhausted and block:
+            server = exhausted[0]
+            try:
+                conn = server.pool.get()
+            except PoolTimeout:
+                raise
+            except Exception:
+                self._record(server, failed=True)
+                raise
+            return self._checked_out(server, conn)
+        if exhausted or error is None:
+            raise PoolTimeout('No LDAP connection available')
+        raise error
+
+    def _checked_out(self, server, conn):
+        self._lock.acquire()
+        try:
+            server.outstanding += 1
+            self._owners[id(conn)] = server
+        finally:
+            self._lock.release()
+        return conn
+
+    def _record(self, server, failed):
+        """Update the health of C{server} after an operation."""
+        self._lock.acquire()
+        try:
+            if not failed:
+                server.failures = 0
+                return
+            server.failures += 1
+            if server.failures >= self.max_failures:
+                server.ejected_until = time.time() + self.retry_interval
+        finally:
+            self._lock.release()
+
+    def put(self, conn, discard=False):
+        """
+        Return a connection obtained with L{get} to the pool of its server.
+
+        @param conn: The connection.
+        @param discard: Close the connection instead of reusing it because
+            the server went away, which counts as a failure of the server.
+        @type discard: C{bool}
+
+        """
+        self._lock.acquire()
+        try:
+            server = self._owners.pop(id(conn))
+            server.outstanding -= 1
+        finally:
+            self._lock.release()
+        server.pool.put(conn, discard)
+        self._record(server, failed=discard)
+
+    def connection(self):
+        """Check a connection out for the duration of a C{with} block."""
+        return _pooled(self)
+
+    def close(self):
+        """Close all the idle connections."""
+        for server in self._servers:
+            server.pool.close()
+
+    def status(self):
+        """
+        Return the state of each server, as a dictionary with its C{uri},
+        C{weight}, number of C{outstanding} connections, consecutive
+        C{failures} and whether it's C{available}.
+
+        """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            return [dict(uri=server.pool.uri, weight=server.weight,
+                         outstanding=server.outstanding,
+                         failures=server.failures,
+                         available=(server.ejected_until is None or
+                                    server.ejected_until <= now))
+                    for server in self._servers]
+        finally:
+            self._lock.release()
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__,
+                            ' '.join([str(uri) for uri in self.uris]))
+
+
+class _Server(object):
+    """The pool and the health of a member of an L{LDAPServerGroup}."""
+
+    def __init__(self, pool, weight):
+        self.pool = pool
+        self.weight = weight
+        self.current_weight = 0
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = None
+
+
+@contextmanager
+def _pooled(pool):
+    conn = pool.get()
+    try:
+        yield conn
+    except (ldap.SERVER_DOWN, ldap.TIMEOUT):
+        pool.put(conn, discard=True)
+        raise
+    except:
+        pool.put(conn)
+        raise
+    else:
+        pool.put(conn)
+
+
+@contextmanager
+def _shared(conn):
+    try:
+        yield conn
+    except ldap.SERVER_DOWN:
+        # Whatever it reconnects to won't remember our bind:
+        forget_bind(conn)
+        raise
+
+
+@contextmanager
+def _guarded(ldap_connection, breaker):
+    with breaker.guard():
+        with checkout(ldap_connection) as conn:
+            yield conn
+
+
+def checkout(ldap_connection, breaker=None):
+    """
+    Return a context manager providing a connection to work with.
+
+    @param ldap_connection: A connection pool or a single connection object,
+        which is then shared with every other thread.
+    @type ldap_connection: L{LDAPConnectionPool}, L{LDAPServerGroup} or
+        C{ldap.ldapobject.SimpleLDAPObject}
+    @param breaker: The
+        L{repoze.who.plugins.shibboleth.breaker.CircuitBreaker} recording the
+        outcome of the operations performed with the connection, if any.
+    @raise repoze.who.plugins.shibboleth.breaker.CircuitOpen: If the
+        C{breaker} doesn't let us contact the directory now.
+
+    """
+    if breaker is not None:
+        return _guarded(ldap_connection, breaker)
+    if is_pool(ldap_connection):
+        return ldap_connection.connection()
+    return _shared(ldap_connection)
+
+
+def is_pool(ldap_connection):
+    """
+    Tell whether C{ldap_connection} hands out connections, as opposed to
+    being one.
+
+    """
+    return isinstance(ldap_connection, (LDAPConnectionPool, LDAPServerGroup))
+
+
+def set_timeouts(conn, network_timeout=None, operation_timeout=None):
+    """
+    Set the timeouts of a new connection, so that a stalled server can't
+    block the calling thread forever.
+
+    @param network_timeout: How many seconds to wait for the server when
+        connecting, or C{None} to leave the default (no timeout).
+    @type network_timeout: C{float}
+    @param operation_timeout: How many seconds to wait for the result of
+        each synchronous operation, or C{None} to leave the default (no
+        timeout); C{ldap.TIMEOUT} is raised when it's over.
+    @type operation_timeout: C{float}
+
+    """
+    if network_timeout is not None and network_timeout != '':
+        conn.set_option(ldap.OPT_NETWORK_TIMEOUT, float(network_timeout))
+    if operation_timeout is not None and operation_timeout != '':
+        conn.set_option(ldap.OPT_TIMEOUT, float(operation_timeout))
+        # What the *_s methods of python-ldap wait for:
+        conn.timeout = float(operation_timeout)
+
+
+# The attribute of the pooled connections which records the URL (or the
+# factory) they were opened with:
+_SERVER = '_repoze_who_server'
+
+
+def server_of(conn):
+    """Return the URL of the server C{conn} is connected to, if known."""
+    server = getattr(conn, _SERVER, None)
+    if server is None:
+        # Set by python-ldap:
+        server = getattr(conn, '_uri', None)
+    if server is None:
+        return 'unknown'
+    if not isinstance(server, basestring):
+        server = getattr(server, '__name__', None) or repr(server)
+    return server
+
+
+#{ Bind state tracking
+
+
+# The attribute of the connection objects which records their identity as
+# (who, cred), or (who, None) after a user's credentials were checked:
+_BOUND_AS = '_repoze_who_bound_as'
+
+
+def ensure_bound(conn, who, cred):
+    """
+    Bind C{conn} as C{who} unless it's already bound so.
+
+    This saves a round trip to the server on every request for connections
+    which are kept bound as a service account.
+
+    @raise ldap.LDAPError: If the bind failed.
+
+    """
+    if is_bound(conn, who, cred):
+        return
+    forget_bind(conn)
+    conn.simple_bind_s(who, cred)
+    mark_bound(conn, who, cred)
+
+
+def bind_user(conn, who, cred):
+    """
+    Bind C{conn} as C{who} to check its credentials.
+
+    Unlike L{ensure_bound}, the bind is always performed. The password isn't
+    recorded, so the next L{ensure_bound} rebinds the connection.
+
+    @raise ldap.LDAPError: If the bind failed.
+
+    """
+    forget_bind(conn)
+    conn.simple_bind_s(who, cred)
+    mark_bound(conn, who, None)
+
+
+def is_bound(conn, who, cred):
+    """Tell whether C{conn} is known to be bound as C{who}."""
+    return getattr(conn, _BOUND_AS, None) == (who, cred)
+
+
+def mark_bound(conn, who, cred):
+    """
+    Record that C{conn} was just bound as C{who}, with C{cred} or with
+    C{None} for the credentials of a user which must not be remembered.
+
+    """
+    setattr(conn, _BOUND_AS, (who, cred))
+
+
+def forget_bind(conn):
+    """Mark C{conn} as not bound, e.g. because it was reset."""
+    try:
+        delattr(conn, _BOUND_AS)
+    except AttributeError:
+        pass
+
+
+#}
+
+
+#{ Searching
+
+
+def paged_search(conn, base, scope, filterstr, attrlist, page_size):
+    """
+    Return the entries matched by a search of C{conn}, requested
+    C{page_size} at a time so that the server's size limit doesn't cut
+    the results short. The search references are left out.
+
+    Connections which can't page, like those of the tests, are searched in
+    one go.
+
+    @param page_size: How many entries to request per page.
+    @type page_size: C{int}
+    @raise ldap.LDAPError: If a page couldn't be retrieved.
+
+    """
+    if not hasattr(conn, 'result3'):
+        return [(dn, attributes) for (dn, attributes)
+                in conn.search_s(base, scope, filterstr, attrlist)
+                if dn is not None]
+    entries = []
+    control = SimplePagedResultsControl(False, size=page_size, cookie='')
+    while True:
+        msgid = conn.search_ext(base, scope, filterstr, attrlist,
+                                serverctrls=[control])
+        rtype, results, rmsgid, controls = conn.result3(msgid)
+        entries.extend([(dn, attributes) for (dn, attributes) in results
+                        if dn is not None])
+        cookies = [c.cookie for c in controls or []
+                   if c.controlType == SimplePagedResultsControl.controlType]
+        if not cookies or not cookies[0]:
+            return entries
+        control.cookie = cookies[0]
+
+
+#}
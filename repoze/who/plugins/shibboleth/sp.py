@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+#
+# repoze.who.plugins.shibboleth, Shibboleth authentication for WSGI applications.
+# Copyright (C) 2010 by Ralph Bean <http://threebean.wordpress.com/>
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+"""
+Plugins trusting the identity established by a Shibboleth Service Provider.
+
+The SP (e.g., C{mod_shib}) authenticates the users against their identity
+provider and hands the outcome to the application: as variables of the WSGI
+environ (C{REMOTE_USER}, C{eppn}, C{Shib-Session-ID}...) when the application
+runs in the web server, or as HTTP headers when it's behind a proxy. In the
+latter case, the headers can be forged by the clients which reach the
+application directly, so they are only trusted from the C{trusted_proxies}.
+
+"""
+
+__all__ = ['ShibbolethSPPlugin', 'split_values', 'AddressMatcher']
+
+import socket
+import struct
+
+from zope.interface import implements
+import ldap.dn
+
+from repoze.who.interfaces import IIdentifier, IAuthenticator
+
+from repoze.who.plugins.shibboleth.userdata import UserdataCodec
+
+from base64 import b64encode
+
+
+#: The identity key holding the user id established by the SP.
+USERID_KEY = 'repoze.who.plugins.shibboleth.sp.userid'
+
+#: The identity key holding the SP session id.
+SESSION_KEY = 'repoze.who.plugins.shibboleth.sp.session'
+
+
+class ShibbolethSPPlugin(object):
+    """
+    Identifies and authenticates the users from what the Shibboleth SP
+    released in the request, without contacting the directory.
+
+    The LDAP metadata providers can still add the attributes of the users if
+    the plugin is given the C{dn_pattern} of their entries.
+
+    """
+
+    implements(IIdentifier, IAuthenticator)
+
+    def __init__(self, user_keys='REMOTE_USER,eppn',
+                 session_key='Shib-Session-ID', use_headers=False,
+                 trusted_proxies=None, require_session=True,
+                 dn_pattern=None, userdata_secret=None):
+        """
+        @param user_keys: The names of the variables holding the user id,
+            tried in this order; an iterable or a comma-separated list in a
+            string.
+        @type user_keys: C{iterable} or C{str}
+        @param session_key: The name of the variable holding the SP session
+            id.
+        @type session_key: C{str}
+        @param use_headers: Whether the SP passes the variables as HTTP
+            headers (e.g., C{eppn} as C{HTTP_EPPN} in the environ) instead of
+            environ variables.
+        @type use_headers: C{bool}
+        @param trusted_proxies: The addresses or networks (as
+            C{10.0.0.0/8}) of the proxies whose requests are trusted; an
+            iterable or a list separated by commas or spaces in a string.
+            They must be set if C{use_headers} is.
+        @type trusted_proxies: C{iterable} or C{str}
+        @param require_session: Whether to ignore the requests without an SP
+            session id, e.g. those to the paths the SP doesn't protect.
+        @type require_session: C{bool}
+        @param dn_pattern: The DN of the users' entries, with C{%s} standing
+            for their (escaped) user id, such as
+            C{uid=%s,ou=people,dc=example,dc=org}; it's put in the
+            C{userdata} of the identity for the LDAP metadata providers.
+        @type dn_pattern: C{str}
+        @param userdata_secret: See
+            L{repoze.who.plugins.shibboleth.plugins.ShibbolethBaseAuthenticatorPlugin.__init__}.
+        @type userdata_secret: C{str}
+        @raise ValueError: If C{use_headers} is set without
+            C{trusted_proxies}, or if one of them is not valid.
+
+        """
+        if hasattr(user_keys, 'split'):
+            user_keys = user_keys.split(',')
+        self.user_keys = [key.strip() for key in user_keys if key.strip()]
+        if not self.user_keys:
+            raise ValueError('The variables of the user id must be given')
+        self.session_key = session_key
+        self.use_headers = bool(use_headers)
+        if trusted_proxies:
+            self.trusted_proxies = AddressMatcher(trusted_proxies)
+        elif self.use_headers:
+            raise ValueError('The headers can only be trusted from trusted '
+                             'proxies')
+        else:
+            self.trusted_proxies = None
+        self.require_session = require_session
+        self.dn_pattern = dn_pattern
+        if userdata_secret:
+            self.userdata_codec = UserdataCodec(userdata_secret)
+        else:
+            self.userdata_codec = None
+
+    def _value(self, environ, name):
+        """Return the variable C{name} passed by the SP, if any."""
+        if self.use_headers:
+            name = 'HTTP_' + name.upper().replace('-', '_')
+        return environ.get(name) or None
+
+    def trusted(self, environ):
+        """Tell whether the variables of the SP can be trusted in C{environ}."""
+        if self.trusted_proxies is None:
+            return True
+        return self.trusted_proxies.match(environ.get('REMOTE_ADDR'))
+
+    # IIdentifier
+    def identify(self, environ):
+        """
+        Return the identity established by the SP, or C{None} if there's
+        none or it can't be trusted.
+
+        The users with several ids (in the multi-valued variables the SP
+        separates with C{;}) are ignored.
+
+        """
+        if not self.trusted(environ):
+            return None
+        session = self._value(environ, self.session_key)
+        if self.require_session and not session:
+            return None
+        for key in self.user_keys:
+            values = split_values(self._value(environ, key))
+            if len(values) == 1:
+                return {USERID_KEY: values[0], SESSION_KEY: session}
+            if values:
+                return None
+        return None
+
+    # IIdentifier
+    def remember(self, environ, identity):
+        """The SP keeps its own session: nothing to remember."""
+        return None
+
+    # IIdentifier
+    def forget(self, environ, identity):
+        """The SP keeps its own session: nothing to forget."""
+        return None
+
+    # IAuthenticator
+    def authenticate(self, environ, identity):
+        """
+        Return the user id of the identities found by L{identify}, which
+        the SP authenticated already.
+
+        @rtype: C{unicode} or C{None}
+
+        """
+        userid = identity.get(USERID_KEY)
+        if userid is None:
+            return None
+        if self.dn_pattern:
+            dn = self.dn_pattern % ldap.dn.escape_dn_chars(userid)
+            userdata = identity.get('userdata', '')
+            if self.userdata_codec is not None:
+                identity['userdata'] = self.userdata_codec.replace(
+                    userdata, self.userdata_codec.encode(dn))
+            else:
+                identity['userdata'] = userdata + '<dn:%s>' % b64encode(dn)
+        return userid
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, id(self))
+
+
+class AddressMatcher(object):
+    """Tells whether IP addresses belong to some addresses or networks."""
+
+    def __init__(self, networks):
+        """
+        @param networks: The IPv4 or IPv6 addresses or networks (in the CIDR
+            notation); an iterable or a list separated by commas or spaces
+            in a string.
+        @raise ValueError: If one of them is not valid.
+
+        """
+        if hasattr(networks, 'split'):
+            networks = networks.replace(',', ' ').split()
+        self.networks = [self._parse(network) for network in networks]
+
+    def _parse(self, network):
+        address, _, bits = network.strip().partition('/')
+        family, packed = _pack(address)
+        if packed is None:
+            raise ValueError('Invalid address: %s' % network)
+        size = len(packed) * 8
+        try:
+            if bits:
+                bits = int(bits)
+            else:
+                bits = size
+        except ValueError:
+            raise ValueError('Invalid network: %s' % network)
+        if not 0 <= bits <= size:
+            raise ValueError('Invalid network: %s' % network)
+        return (family, _prefix(packed, bits), bits)
+
+    def match(self, address):
+        """
+        Tell whether C{address} belongs to one of the networks.
+
+        @rtype: C{bool}
+
+        """
+        family, packed = _pack(address or '')
+        if packed is None:
+            return False
+        for (network_family, prefix, bits) in self.networks:
+            if network_family == family and _prefix(packed, bits) == prefix:
+                return True
+        return False
+
+
+def split_values(value):
+    """
+    Return the values of a variable set by the SP, which separates them with
+    C{;} and escapes the C{;} in the values as C{\\;}.
+
+    @rtype: C{list}
+
+    """
+    if not value:
+        return []
+    values = []
+    current = []
+    escaped = False
+    for char in value:
+        if escaped:
+            if char != ';':
+                current.append('\\')
+            current.append(char)
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == ';':
+            values.append(''.join(current))
+            current = []
+        else:
+            current.append(char)
+    if escaped:
+        current.append('\\')
+    values.append(''.join(current))
+    return [value for value in values if value]
+
+
+#{ Address helpers
+
+
+def _pack(address):
+    """Return the family and the bytes of C{address}, if it's valid."""
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return family, socket.inet_pton(family, address.strip())
+        except (socket.error, ValueError):
+            continue
+    return None, None
+
+
+def _prefix(packed, bits):
+    """Return the first C{bits} bits of the C{packed} address, as a number."""
+    number = 0
+    for byte in struct.unpack('%dB' % len(packed), packed):
+        number = number << 8 | byte
+    return number >> (len(packed) * 8 - bits)
+
+
+#}
@@ -16,21 +16,61 @@
 # FITNESS FOR A PARTICULAR PURPOSE.
 """Test suite for repoze.who.plugins.ldap"""
 
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
 from dataflake.ldapconnection.tests import fakeldap
 import ldap
 from ldap import modlist, dn
 from ldap.ldapobject import SimpleLDAPObject
+from ldap.controls import SimplePagedResultsControl
 from zope.interface.verify import verifyClass
 from repoze.who.interfaces import IAuthenticator, IMetadataProvider
 
-from repoze.who.plugins.ldap import LDAPAuthenticatorPlugin, \
-                                    LDAPAttributesPlugin, \
-                                    LDAPSearchAuthenticatorPlugin
-from repoze.who.plugins.ldap.plugins import make_ldap_connection
+from repoze.who.plugins.shibboleth import ShibbolethAuthenticatorPlugin, \
+                                          ShibbolethAttributesPlugin, \
+                                          ShibbolethSearchAuthenticatorPlugin, \
+                                          ShibbolethGroupsPlugin, \
+                                          ShibbolethSPPlugin
+from repoze.who.plugins.shibboleth.plugins import make_ldap_connection, \
+                                                  ENTRIES_KEY, MEMO_KEY, \
+                                                  LazyAttributes, \
+                                                  AttributesUnavailable, \
+                                                  run_concurrently
+from repoze.who.plugins.shibboleth.pool import LDAPConnectionPool, \
+                                               LDAPServerGroup, PoolTimeout, \
+                                               ensure_bound, bind_user, \
+                                               forget_bind
+from repoze.who.plugins.shibboleth.cache import TTLCache, SQLiteCache, \
+                                                make_cache, \
+                                                CredentialsCache
+from repoze.who.plugins.shibboleth.breaker import CircuitBreaker, CircuitOpen
+from repoze.who.plugins.shibboleth.metrics import Metrics, Histogram, \
+                                                  CallbackMetrics
+from repoze.who.plugins.shibboleth import benchmark
+from repoze.who.plugins.shibboleth.userdata import UserdataCodec
+from repoze.who.plugins.shibboleth.mirror import DirectoryMirror
+from repoze.who.plugins.shibboleth.changes import ChangeFeed, \
+                                                  make_change_feed, parse_stamp
+from repoze.who.plugins.shibboleth.groups import GroupGraph, normalize_dn
+from repoze.who.plugins.shibboleth.sp import AddressMatcher, split_values, \
+                                             USERID_KEY
+from repoze.who.plugins.shibboleth.aio import LDAPEventLoop, Return, Wait, \
+        AsyncShibbolethAuthenticatorPlugin, \
+        AsyncShibbolethSearchAuthenticatorPlugin, \
+        AsyncShibbolethAttributesPlugin
 
 from base64 import b64encode
+from hashlib import sha1
+from cStringIO import StringIO
+from functools import partial
 
 
 class Base(unittest.TestCase):
@@ -72,36 +112,36 @@ class Base(unittest.TestCase):
 #{ Test cases for the plugins
 
 
-class TestMakeLDAPAuthenticatorPlugin(unittest.TestCase):
-    """Tests for the constructor of the L{LDAPAuthenticatorPlugin} plugin"""
+class TestMakeShibbolethAuthenticatorPlugin(unittest.TestCase):
+    """Tests for the constructor of the L{ShibbolethAuthenticatorPlugin} plugin"""
     
     def test_without_connection(self):
-        self.assertRaises(ValueError, LDAPAuthenticatorPlugin, None,
+        self.assertRaises(ValueError, ShibbolethAuthenticatorPlugin, None,
                           'dc=example,dc=org')
     
     def test_without_base_dn(self):
         conn = fakeldap.FakeLDAPConnection()
-        self.assertRaises(TypeError, LDAPAuthenticatorPlugin, conn)
-        self.assertRaises(ValueError, LDAPAuthenticatorPlugin, conn, None)
+        self.assertRaises(TypeError, ShibbolethAuthenticatorPlugin, conn)
+        self.assertRaises(ValueError, ShibbolethAuthenticatorPlugin, conn, None)
     
     def test_with_connection(self):
         conn = fakeldap.FakeLDAPConnection()
-        LDAPAuthenticatorPlugin(conn, 'dc=example,dc=org')
+        ShibbolethAuthenticatorPlugin(conn, 'dc=example,dc=org')
     
     def test_connection_is_url(self):
-        LDAPAuthenticatorPlugin('ldap://example.org', 'dc=example,dc=org')
+        ShibbolethAuthenticatorPlugin('ldap://example.org', 'dc=example,dc=org')
 
 
-class TestLDAPAuthenticatorPlugin(Base):
-    """Tests for the L{LDAPAuthenticatorPlugin} IAuthenticator plugin"""
+class TestShibbolethAuthenticatorPlugin(Base):
+    """Tests for the L{ShibbolethAuthenticatorPlugin} IAuthenticator plugin"""
     
     def setUp(self):
-        super(TestLDAPAuthenticatorPlugin, self).setUp()
+        super(TestShibbolethAuthenticatorPlugin, self).setUp()
         # Loading the plugin:
-        self.plugin = LDAPAuthenticatorPlugin(self.connection, base_dn)
+        self.plugin = ShibbolethAuthenticatorPlugin(self.connection, base_dn)
 
     def test_implements(self):
-        verifyClass(IAuthenticator, LDAPAuthenticatorPlugin, tentative=True)
+        verifyClass(IAuthenticator, ShibbolethAuthenticatorPlugin, tentative=True)
 
     def test_authenticate_nologin(self):
         result = self.plugin.authenticate(self.env, None)
@@ -134,9 +174,9 @@ class TestLDAPAuthenticatorPlugin(Base):
         self.assertEqual(result, fakeuser['dn'])
     
     def test_custom_authenticator(self):
-        """L{LDAPAuthenticatorPlugin._get_dn} should be overriden with no
+        """L{ShibbolethAuthenticatorPlugin._get_dn} should be overriden with no
         problems"""
-        plugin = CustomLDAPAuthenticatorPlugin(self.connection, base_dn)
+        plugin = CustomShibbolethAuthenticatorPlugin(self.connection, base_dn)
         identity = {'login': fakeuser['uid'],
                     'password': fakeuser['password']}
         result = plugin.authenticate(self.env, identity)
@@ -144,13 +184,13 @@ class TestLDAPAuthenticatorPlugin(Base):
         self.assertEqual(result, expected)
         self.assertTrue(plugin.called)
 
-class TestLDAPSearchAuthenticatorPluginNaming(Base):
-    """Tests for the L{LDAPSearchAuthenticatorPlugin} IAuthenticator plugin"""
+class TestShibbolethSearchAuthenticatorPluginNaming(Base):
+    """Tests for the L{ShibbolethSearchAuthenticatorPlugin} IAuthenticator plugin"""
     
     def setUp(self):
-        super(TestLDAPSearchAuthenticatorPluginNaming, self).setUp()
+        super(TestShibbolethSearchAuthenticatorPluginNaming, self).setUp()
         # Loading the plugin:
-        self.plugin = LDAPSearchAuthenticatorPlugin(
+        self.plugin = ShibbolethSearchAuthenticatorPlugin(
             self.connection,
             base_dn,
             naming_attribute='telephone',
@@ -174,17 +214,17 @@ class TestLDAPSearchAuthenticatorPluginNaming(Base):
         result = self.plugin.authenticate(self.env, identity)
         self.assertEqual(result, fakeuser['dn'])
     
-class TestLDAPAuthenticatorReturnLogin(Base):
+class TestShibbolethAuthenticatorReturnLogin(Base):
     """
-    Tests the L{LDAPAuthenticatorPlugin} IAuthenticator plugin returning
+    Tests the L{ShibbolethAuthenticatorPlugin} IAuthenticator plugin returning
     login.
     
     """
     
     def setUp(self):
-        super(TestLDAPAuthenticatorReturnLogin, self).setUp()
+        super(TestShibbolethAuthenticatorReturnLogin, self).setUp()
         # Loading the plugin:
-        self.plugin = LDAPAuthenticatorPlugin(
+        self.plugin = ShibbolethAuthenticatorPlugin(
             self.connection,
             base_dn,
             returned_id='login',
@@ -216,17 +256,17 @@ class TestLDAPAuthenticatorReturnLogin(Base):
         self.assertEqual(identity['userdata'], expected_dn)
         
     
-class TestLDAPSearchAuthenticatorReturnLogin(Base):
+class TestShibbolethSearchAuthenticatorReturnLogin(Base):
     """
-    Tests the L{LDAPSearchAuthenticatorPlugin} IAuthenticator plugin returning
+    Tests the L{ShibbolethSearchAuthenticatorPlugin} IAuthenticator plugin returning
     login.
     
     """
     
     def setUp(self):
-        super(TestLDAPSearchAuthenticatorReturnLogin, self).setUp()
+        super(TestShibbolethSearchAuthenticatorReturnLogin, self).setUp()
         # Loading the plugin:
-        self.plugin = LDAPSearchAuthenticatorPlugin(
+        self.plugin = ShibbolethSearchAuthenticatorPlugin(
             self.connection,
             base_dn,
             returned_id='login',
@@ -258,70 +298,70 @@ class TestLDAPSearchAuthenticatorReturnLogin(Base):
         self.assertEqual(identity['userdata'], expected_dn)
         
     
-class TestLDAPAuthenticatorPluginStartTls(Base):
-    """Tests for the L{LDAPAuthenticatorPlugin} IAuthenticator plugin"""
+class TestShibbolethAuthenticatorPluginStartTls(Base):
+    """Tests for the L{ShibbolethAuthenticatorPlugin} IAuthenticator plugin"""
     
     def setUp(self):
-        super(TestLDAPAuthenticatorPluginStartTls, self).setUp()
+        super(TestShibbolethAuthenticatorPluginStartTls, self).setUp()
         # Loading the plugin:
-        self.plugin = LDAPAuthenticatorPlugin(self.connection, base_dn,
+        self.plugin = ShibbolethAuthenticatorPlugin(self.connection, base_dn,
                                               start_tls=True)
 
     def test_implements(self):
-        verifyClass(IAuthenticator, LDAPAuthenticatorPlugin, tentative=True)
+        verifyClass(IAuthenticator, ShibbolethAuthenticatorPlugin, tentative=True)
 
 
-class TestMakeLDAPAttributesPlugin(unittest.TestCase):
-    """Tests for the constructor of L{LDAPAttributesPlugin}"""
+class TestMakeShibbolethAttributesPlugin(unittest.TestCase):
+    """Tests for the constructor of L{ShibbolethAttributesPlugin}"""
     
     def test_connection_is_invalid(self):
-        self.assertRaises(ValueError, LDAPAttributesPlugin, None, 'cn')
+        self.assertRaises(ValueError, ShibbolethAttributesPlugin, None, 'cn')
     
     def test_attributes_is_none(self):
         """If attributes is None then fetch all the attributes"""
-        plugin = LDAPAttributesPlugin('ldap://localhost', None)
+        plugin = ShibbolethAttributesPlugin('ldap://localhost', None)
         self.assertEqual(plugin.attributes, None)
     
     def test_attributes_is_comma_separated_str(self):
         attributes = "cn,uid,mail"
-        plugin = LDAPAttributesPlugin('ldap://localhost', attributes)
+        plugin = ShibbolethAttributesPlugin('ldap://localhost', attributes)
         self.assertEqual(plugin.attributes, attributes.split(','))
     
     def test_attributes_is_only_one_as_str(self):
         attributes = "mail"
-        plugin = LDAPAttributesPlugin('ldap://localhost', attributes)
+        plugin = ShibbolethAttributesPlugin('ldap://localhost', attributes)
         self.assertEqual(plugin.attributes, ['mail'])
     
     def test_attributes_is_iterable(self):
         # The plugin, with a tuple as attributes
         attributes_t = ('cn', 'mail')
-        plugin_t = LDAPAttributesPlugin('ldap://localhost', attributes_t)
+        plugin_t = ShibbolethAttributesPlugin('ldap://localhost', attributes_t)
         self.assertEqual(plugin_t.attributes, list(attributes_t))
         # The plugin, with a list as attributes
         attributes_l = ['cn', 'mail']
-        plugin_l = LDAPAttributesPlugin('ldap://localhost', attributes_l)
+        plugin_l = ShibbolethAttributesPlugin('ldap://localhost', attributes_l)
         self.assertEqual(plugin_l.attributes, attributes_l)
         # The plugin, with a dict as attributes
         attributes_d = {'first': 'cn', 'second': 'mail'}
-        plugin_d = LDAPAttributesPlugin('ldap://localhost', attributes_d)
+        plugin_d = ShibbolethAttributesPlugin('ldap://localhost', attributes_d)
         self.assertEqual(plugin_d.attributes, list(attributes_d))
     
     def test_attributes_is_not_iterable_nor_string(self):
-        self.assertRaises(ValueError, LDAPAttributesPlugin, 'ldap://localhost',
+        self.assertRaises(ValueError, ShibbolethAttributesPlugin, 'ldap://localhost',
                           12345)
     
     def test_parameters_are_valid(self):
-        LDAPAttributesPlugin('ldap://localhost', 'cn', '(objectClass=*)')
+        ShibbolethAttributesPlugin('ldap://localhost', 'cn', '(objectClass=*)')
 
 
-class TestLDAPAttributesPlugin(Base):
-    """Tests for the L{LDAPAttributesPlugin} IMetadata plugin"""
+class TestShibbolethAttributesPlugin(Base):
+    """Tests for the L{ShibbolethAttributesPlugin} IMetadata plugin"""
 
     def test_implements(self):
-        verifyClass(IMetadataProvider, LDAPAttributesPlugin, tentative=True)
+        verifyClass(IMetadataProvider, ShibbolethAttributesPlugin, tentative=True)
 
     def test_add_metadata(self):
-        plugin = LDAPAttributesPlugin(self.connection)
+        plugin = ShibbolethAttributesPlugin(self.connection)
         environ = {}
         identity = {'repoze.who.userid': fakeuser['dn']}
         expected_identity = {
@@ -355,6 +395,2282 @@ class TestLDAPConnectionFactory(unittest.TestCase):
     
     def test_connection_is_none(self):
         self.assertRaises(ValueError, make_ldap_connection, None)
+    
+    def test_connection_is_pooled(self):
+        pool = make_ldap_connection('ldap://example.org', pool_max_size=4)
+        self.assertTrue(isinstance(pool, LDAPConnectionPool))
+        self.assertEqual(pool.max_size, 4)
+    
+    def test_pool_is_object(self):
+        pool = LDAPConnectionPool(FakeClosableConnection)
+        self.assertEqual(make_ldap_connection(pool), pool)
+    
+    def test_several_servers(self):
+        group = make_ldap_connection('ldap://a.example.org '
+                                     'ldap://b.example.org',
+                                     server_weights='2,1')
+        self.assertTrue(isinstance(group, LDAPServerGroup))
+        self.assertEqual(group.weights, [2, 1])
+        group = make_ldap_connection(['ldap://a.example.org',
+                                      'ldap://b.example.org'],
+                                     pool_max_size=3)
+        self.assertEqual(group.copy().pool_options['max_size'], 3)
+
+
+class TestLDAPConnectionPool(unittest.TestCase):
+    """Tests for L{LDAPConnectionPool}"""
+    
+    def test_invalid_sizes(self):
+        self.assertRaises(ValueError, LDAPConnectionPool,
+                          FakeClosableConnection, max_size=0)
+        self.assertRaises(ValueError, LDAPConnectionPool,
+                          FakeClosableConnection, min_size=3, max_size=2)
+    
+    def test_min_size_is_opened(self):
+        pool = LDAPConnectionPool(FakeClosableConnection, min_size=2,
+                                  max_size='5')
+        self.assertEqual(pool._size, 2)
+        self.assertEqual(len(pool._idle), 2)
+    
+    def test_connection_is_reused(self):
+        pool = LDAPConnectionPool(FakeClosableConnection)
+        conn = pool.get()
+        pool.put(conn)
+        self.assertTrue(pool.get() is conn)
+        self.assertEqual(pool._size, 1)
+    
+    def test_checkout_timeout(self):
+        pool = LDAPConnectionPool(FakeClosableConnection, max_size=1,
+                                  timeout='0.01')
+        pool.get()
+        self.assertRaises(PoolTimeout, pool.get)
+    
+    def test_idle_connections_are_evicted(self):
+        pool = LDAPConnectionPool(FakeClosableConnection, min_size=1,
+                                  idle_timeout=0)
+        conn1 = pool.get()
+        conn2 = pool.get()
+        pool.put(conn1)
+        pool.put(conn2)
+        # Only the least recently used one is evicted, as min_size is 1:
+        self.assertTrue(pool.get() is conn2)
+        self.assertTrue(conn1.closed)
+        self.assertEqual(pool._size, 1)
+    
+    def test_server_down_discards_connection(self):
+        pool = LDAPConnectionPool(FakeClosableConnection, max_size=1)
+        try:
+            with pool.connection() as conn:
+                raise ldap.SERVER_DOWN()
+        except ldap.SERVER_DOWN:
+            pass
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool._size, 0)
+        self.assertFalse(pool.get() is conn)
+
+
+class TestShibbolethAuthenticatorPluginPooled(Base):
+    """Tests for the authenticators using a connection pool"""
+    
+    def setUp(self):
+        super(TestShibbolethAuthenticatorPluginPooled, self).setUp()
+        self.pool = LDAPConnectionPool(lambda: self.connection, max_size=2)
+        self.plugin = ShibbolethSearchAuthenticatorPlugin(self.pool, base_dn)
+    
+    def test_authenticate_comparesuccess(self):
+        identity = {'login': fakeuser['uid'],
+                    'password': fakeuser['password']}
+        result = self.plugin.authenticate(self.env, identity)
+        self.assertEqual(result, fakeuser['dn'])
+        self.assertEqual(len(self.pool._idle), 1)
+    
+    def test_authenticate_comparefail(self):
+        identity = {'login': fakeuser['uid'],
+                    'password': 'wrong password'}
+        result = self.plugin.authenticate(self.env, identity)
+        self.assertEqual(result, None)
+        self.assertEqual(len(self.pool._idle), 1)
+    
+    def test_authenticate_pool_exhausted(self):
+        self.pool.timeout = 0.01
+        self.pool.get()
+        self.pool.get()
+        identity = {'login': fakeuser['uid'],
+                    'password': fakeuser['password']}
+        result = self.plugin.authenticate(self.env, identity)
+        self.assertEqual(result, None)
+
+
+class TestShibbolethAuthenticatorPluginBindConnection(Base):
+    """
+    Tests for the separation of the search and credential check connections
+    of the authenticators.
+    
+    """
+    
+    def test_single_connection_is_shared(self):
+        plugin = ShibbolethSearchAuthenticatorPlugin(self.connection, base_dn)
+        self.assertTrue(plugin.bind_connection is self.connection)
+    
+    def test_pool_gets_twin_bind_pool(self):
+        pool = LDAPConnectionPool(fakeldap.FakeLDAPConnection,
+                                  bind_dn='Manager',
+                                  bind_pass='some password')
+        plugin = ShibbolethSearchAuthenticatorPlugin(
+            pool, base_dn, bind_dn='Manager', bind_pass='some password')
+        self.assertTrue(isinstance(plugin.bind_connection,
+                                   LDAPConnectionPool))
+        self.assertFalse(plugin.bind_connection is pool)
+        self.assertEqual(plugin.bind_connection.bind_dn, '')
+        identity = {'login': fakeuser['uid'],
+                    'password': fakeuser['password']}
+        result = plugin.authenticate(self.env, identity)
+        self.assertEqual(result, fakeuser['dn'])
+        self.assertEqual(len(pool._idle), 1)
+        self.assertEqual(len(plugin.bind_connection._idle), 1)
+    
+    def test_explicit_bind_connection(self):
+        bind_conn = fakeldap.FakeLDAPConnection()
+        plugin = ShibbolethSearchAuthenticatorPlugin(
+            self.connection, base_dn, bind_connection=bind_conn)
+        self.assertTrue(plugin.bind_connection is bind_conn)
+        identity = {'login': fakeuser['uid'],
+                    'password': fakeuser['password']}
+        result = plugin.authenticate(self.env, identity)
+        self.assertEqual(result, fakeuser['dn'])
+
+
+class TestBindTracking(Base):
+    """Tests for the tracking of the identity connections are bound as"""
+    
+    def setUp(self):
+        super(TestBindTracking, self).setUp()
+        self.conn = FakeCountingConnection()
+    
+    def test_ensure_bound_binds_once(self):
+        ensure_bound(self.conn, 'Manager', 'some password')
+        ensure_bound(self.conn, 'Manager', 'some password')
+        self.assertEqual(self.conn.binds, 1)
+    
+    def test_user_bind_is_always_performed(self):
+        bind_user(self.conn, fakeuser['dn'], fakeuser['password'])
+        bind_user(self.conn, fakeuser['dn'], fakeuser['password'])
+        self.assertEqual(self.conn.binds, 2)
+    
+    def test_rebind_after_user_bind(self):
+        ensure_bound(self.conn, 'Manager', 'some password')
+        bind_user(self.conn, fakeuser['dn'], fakeuser['password'])
+        ensure_bound(self.conn, 'Manager', 'some password')
+        self.assertEqual(self.conn.binds, 3)
+    
+    def test_rebind_after_reset(self):
+        ensure_bound(self.conn, 'Manager', 'some password')
+        forget_bind(self.conn)
+        ensure_bound(self.conn, 'Manager', 'some password')
+        self.assertEqual(self.conn.binds, 2)
+    
+    def test_failed_bind_is_not_recorded(self):
+        self.assertRaises(ldap.LDAPError, bind_user, self.conn,
+                          fakeuser['dn'], 'wrong password')
+        bind_user(self.conn, fakeuser['dn'], fakeuser['password'])
+        self.assertEqual(self.conn.binds, 2)
+    
+    def test_metadata_provider_binds_once(self):
+        plugin = ShibbolethAttributesPlugin(self.conn, bind_dn='Manager',
+                                            bind_pass='some password')
+        plugin.add_metadata(self.env, {'repoze.who.userid': fakeuser['dn']})
+        plugin.add_metadata(self.env, {'repoze.who.userid': fakeuser['dn']})
+        self.assertEqual(self.conn.binds, 1)
+    
+    def test_pool_connections_stay_bound(self):
+        pool = LDAPConnectionPool(FakeCountingConnection, bind_dn='Manager',
+                                  bind_pass='some password')
+        plugin = ShibbolethSearchAuthenticatorPlugin(
+            pool, base_dn, bind_dn='Manager', bind_pass='some password')
+        identity = {'login': fakeuser['uid'],
+                    'password': fakeuser['password']}
+        plugin.authenticate(self.env, identity)
+        plugin.authenticate(self.env, identity)
+        conn = pool.get()
+        self.assertEqual(conn.binds, 1)
+
+
+class TestTTLCache(unittest.TestCase):
+    """Tests for L{TTLCache}"""
+    
+    def test_invalid_arguments(self):
+        self.assertRaises(ValueError, TTLCache, max_size=0)
+        self.assertRaises(ValueError, TTLCache, ttl=-1)
+        self.assertRaises(ValueError, TTLCache, jitter=1)
+    
+    def test_get_and_set(self):
+        cache = TTLCache(ttl='60')
+        self.assertEqual(cache.get('key'), None)
+        self.assertEqual(cache.get('key', 'default'), 'default')
+        cache.set('key', 'value')
+        self.assertEqual(cache.get('key'), 'value')
+        cache.delete('key')
+        self.assertEqual(cache.get('key'), None)
+    
+    def test_entries_expire(self):
+        cache = TTLCache(ttl=60, jitter=0)
+        cache.set('key', 'value', ttl=0)
+        self.assertEqual(cache.get('key'), None)
+        self.assertEqual(len(cache), 0)
+    
+    def test_least_recently_used_is_dropped(self):
+        cache = TTLCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+    
+    def test_memory_cap(self):
+        cache = TTLCache(max_bytes=9)
+        cache.set('a', {'cn': ['abc']})
+        cache.set('b', ['defgh'])
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), ['defgh'])
+        cache.set('c', 'this is too big')
+        self.assertEqual(cache.get('c'), None)
+        self.assertEqual(cache._bytes, 5)
+
+
+class TestSQLiteCache(unittest.TestCase):
+    """Tests for L{SQLiteCache}"""
+    
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache.db')
+        self.cache = SQLiteCache(self.path, ttl='60', jitter=0)
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def test_invalid_arguments(self):
+        self.assertRaises(ValueError, SQLiteCache, self.path, max_size=0)
+        self.assertRaises(ValueError, SQLiteCache, self.path, ttl=-1)
+        self.assertRaises(ValueError, SQLiteCache, self.path, jitter=1)
+    
+    def test_get_and_set(self):
+        self.assertEqual(self.cache.get(('dn', 'jsmith')), None)
+        self.assertEqual(self.cache.get('key', 'default'), 'default')
+        self.cache.set(('dn', 'jsmith'), {'mail': ['jsmith@example.org']})
+        self.assertEqual(self.cache.get(('dn', 'jsmith')),
+                         {'mail': ['jsmith@example.org']})
+        self.assertEqual(len(self.cache), 1)
+        self.cache.delete(('dn', 'jsmith'))
+        self.assertEqual(self.cache.get(('dn', 'jsmith')), None)
+    
+    def test_expiry(self):
+        self.cache.set('key', 'value', ttl=0)
+        self.assertEqual(self.cache.get('key'), None)
+        self.assertEqual(len(self.cache), 0)
+    
+    def test_file_is_private(self):
+        self.assertEqual(os.stat(self.path).st_mode & 0777, 0600)
+    
+    def test_unsafe_file(self):
+        os.chmod(self.path, 0666)
+        self.assertRaises(ValueError, SQLiteCache, self.path)
+    
+    def test_locked_database(self):
+        cache = SQLiteCache(self.path, timeout=0)
+        cache.set('key', 'value')
+        other = sqlite3.connect(self.path, isolation_level=None)
+        other.execute('BEGIN EXCLUSIVE')
+        try:
+            cache.delete('key')
+            cache.clear()
+            cache.set('other key', 'value')
+        finally:
+            other.execute('ROLLBACK')
+            other.close()
+        self.assertEqual(cache.get('key'), 'value')
+    
+    def test_shared_between_instances(self):
+        other = SQLiteCache(self.path)
+        self.cache.set('key', 'value')
+        self.assertEqual(other.get('key'), 'value')
+        other.clear()
+        self.assertEqual(self.cache.get('key'), None)
+    
+    def test_shared_between_processes(self):
+        pid = os.fork()
+        if not pid:
+            try:
+                self.cache.set('key', 'from the child')
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(self.cache.get('key'), 'from the child')
+    
+    def test_namespaces(self):
+        other = SQLiteCache(self.path, namespace='other')
+        self.cache.set('key', 'value')
+        self.assertEqual(other.get('key'), None)
+        other.set('key', 'other value')
+        other.clear()
+        self.assertEqual(self.cache.get('key'), 'value')
+    
+    def test_max_size(self):
+        cache = SQLiteCache(self.path, max_size=3, jitter=0)
+        for i in range(5):
+            cache.set(i, i, ttl=60 + i)
+        cache.purge()
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.get(0), None)
+        self.assertEqual(cache.get(4), 4)
+    
+    def test_make_cache(self):
+        cache = make_cache(ttl=60, path=self.path, namespace='dn')
+        self.assertTrue(isinstance(cache, SQLiteCache))
+        self.assertEqual(cache.namespace, 'dn')
+        self.assertTrue(isinstance(make_cache(ttl=60), TTLCache))
+
+
+class TestSharedCaches(Base):
+    """Tests for the caches shared through a file by the plugins"""
+    
+    def setUp(self):
+        super(TestSharedCaches, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache.db')
+        self.connection = FakeCountingConnection()
+    
+    def tearDown(self):
+        super(TestSharedCaches, self).tearDown()
+        shutil.rmtree(self.directory)
+    
+    def test_dns_are_shared(self):
+        plugins = [ShibbolethSearchAuthenticatorPlugin(
+                       self.connection, base_dn, dn_cache_ttl=60,
+                       negative_cache_ttl=60, cache_file=self.path)
+                   for i in range(2)]
+        self.assertTrue(isinstance(plugins[0].dn_cache, SQLiteCache))
+        for plugin in plugins:
+            self.assertEqual(plugin._get_dn(self.env,
+                                            {'login': fakeuser['uid']}),
+                             fakeuser['dn'])
+            self.assertRaises(ValueError, plugin._get_dn, self.env,
+                              {'login': 'nobody'})
+        self.assertEqual(self.connection.searches, 2)
+    
+    def test_credentials_are_shared(self):
+        plugins = [ShibbolethAuthenticatorPlugin(
+                       self.connection, base_dn, credentials_cache_ttl=60,
+                       cache_file=self.path)
+                   for i in range(2)]
+        identity = {'login': fakeuser['uid'],
+                    'password': fakeuser['password']}
+        self.assertEqual(plugins[0].authenticate(self.env, dict(identity)),
+                         fakeuser['dn'])
+        binds = self.connection.binds
+        self.assertEqual(plugins[1].authenticate(self.env, dict(identity)),
+                         fakeuser['dn'])
+        self.assertEqual(self.connection.binds, binds)
+    
+    def test_attributes_are_shared(self):
+        plugins = [ShibbolethAttributesPlugin(self.connection, 'cn,mail',
+                                              cache_ttl=60,
+                                              cache_file=self.path)
+                   for i in range(2)]
+        for plugin in plugins:
+            identity = {'repoze.who.userid': fakeuser['dn']}
+            plugin.add_metadata(self.env, identity)
+            self.assertEqual(identity['mail'], [fakeuser['mail']])
+        self.assertEqual(self.connection.searches, 1)
+
+
+class TestShibbolethSearchAuthenticatorPluginDNCache(Base):
+    """Tests for the DN cache of L{ShibbolethSearchAuthenticatorPlugin}"""
+    
+    def setUp(self):
+        super(TestShibbolethSearchAuthenticatorPluginDNCache, self).setUp()
+        self.connection = FakeCountingConnection()
+        self.plugin = ShibbolethSearchAuthenticatorPlugin(
+            self.connection, base_dn, dn_cache_ttl=60)
+    
+    def test_disabled_by_default(self):
+        plugin = ShibbolethSearchAuthenticatorPlugin(self.connection, base_dn)
+        self.assertEqual(plugin.dn_cache, None)
+    
+    def test_dn_is_cached(self):
+        identity = {'login': fakeuser['uid']}
+        self.assertEqual(self.plugin._get_dn(self.env, identity),
+                         fakeuser['dn'])
+        self.assertEqual(self.plugin._get_dn(self.env, identity),
+                         fakeuser['dn'])
+        self.assertEqual(self.connection.searches, 1)
+    
+    def test_login_is_normalized(self):
+        self.plugin._get_dn(self.env, {'login': fakeuser['uid']})
+        dn = self.plugin._get_dn(self.env,
+                                 {'login': ' %s ' % fakeuser['uid'].upper()})
+        self.assertEqual(dn, fakeuser['dn'])
+        self.assertEqual(self.connection.searches, 1)
+    
+    def test_authenticate_still_binds(self):
+        identity = {'login': fakeuser['uid'],
+                    'password': 'wrong password'}
+        self.plugin._get_dn(self.env, identity)
+        self.assertEqual(self.plugin.authenticate(self.env, identity), None)
+
+
+class TestShibbolethAttributesPluginCache(Base):
+    """Tests for the attributes cache of L{ShibbolethAttributesPlugin}"""
+    
+    def setUp(self):
+        super(TestShibbolethAttributesPluginCache, self).setUp()
+        self.connection = FakeCountingConnection()
+        self.plugin = ShibbolethAttributesPlugin(self.connection, 'cn,mail',
+                                                 cache_ttl=60)
+    
+    def test_disabled_by_default(self):
+        plugin = ShibbolethAttributesPlugin(self.connection)
+        self.assertEqual(plugin.cache, None)
+    
+    def test_attributes_are_cached(self):
+        identity1 = {'repoze.who.userid': fakeuser['dn']}
+        identity2 = {'repoze.who.userid': fakeuser['dn']}
+        self.plugin.add_metadata(self.env, identity1)
+        self.plugin.add_metadata(self.env, identity2)
+        self.assertEqual(identity1, identity2)
+        self.assertEqual(identity2['mail'], [fakeuser['mail']])
+        self.assertEqual(self.connection.searches, 1)
+    
+    def test_cached_attributes_are_copied(self):
+        identity1 = {'repoze.who.userid': fakeuser['dn']}
+        identity2 = {'repoze.who.userid': fakeuser['dn']}
+        self.plugin.add_metadata(self.env, identity1)
+        identity1['mail'].append('someone@example.org')
+        self.plugin.add_metadata(self.env, identity2)
+        self.assertEqual(identity2['mail'], [fakeuser['mail']])
+    
+    def test_key_includes_the_search(self):
+        other = ShibbolethAttributesPlugin(self.connection, 'cn',
+                                           cache=self.plugin.cache)
+        self.assertNotEqual(self.plugin._cache_key(fakeuser['dn']),
+                            other._cache_key(fakeuser['dn']))
+
+
+class TestShibbolethSearchAuthenticatorPluginNegativeCache(Base):
+    """
+    Tests for the negative cache of L{ShibbolethSearchAuthenticatorPlugin}
+    
+    """
+    
+    def setUp(self):
+        super(TestShibbolethSearchAuthenticatorPluginNegativeCache,
+              self).setUp()
+        self.connection = FakeCountingConnection()
+        self.plugin = ShibbolethSearchAuthenticatorPlugin(
+            self.connection, base_dn, negative_cache_ttl=60)
+    
+    def test_disabled_by_default(self):
+        plugin = ShibbolethSearchAuthenticatorPlugin(self.connection, base_dn)
+        self.assertEqual(plugin.negative_cache, None)
+    
+    def test_unknown_login_is_remembered(self):
+        identity = {'login': 'i_dont_exist',
+                    'password': 'super secure password'}
+        self.assertEqual(self.plugin.authenticate(self.env, identity), None)
+        self.assertEqual(self.plugin.authenticate(self.env, identity), None)
+        self.assertRaises(ValueError, self.plugin._get_dn, self.env, identity)
+        self.assertEqual(self.connection.searches, 1)
+    
+    def test_known_login_is_not_remembered(self):
+        identity = {'login': fakeuser['uid'],
+                    'password': fakeuser['password']}
+        self.assertEqual(self.plugin.authenticate(self.env, identity),
+                         fakeuser['dn'])
+        self.assertEqual(len(self.plugin.negative_cache), 0)
+
+
+class TestCredentialsCache(unittest.TestCase):
+    """Tests for L{CredentialsCache}"""
+    
+    def test_invalid_lifetime(self):
+        self.assertRaises(ValueError, CredentialsCache, ttl=60,
+                          max_lifetime=30)
+    
+    def test_check(self):
+        cache = CredentialsCache(iterations=1)
+        self.assertFalse(cache.check(fakeuser['dn'], fakeuser['password']))
+        cache.remember(fakeuser['dn'], fakeuser['password'])
+        self.assertTrue(cache.check(fakeuser['dn'], fakeuser['password']))
+        self.assertFalse(cache.check(fakeuser['dn'], 'wrong password'))
+        cache.forget(fakeuser['dn'])
+        self.assertFalse(cache.check(fakeuser['dn'], fakeuser['password']))
+    
+    def test_password_is_not_stored(self):
+        cache = CredentialsCache(iterations=1)
+        cache.remember(fakeuser['dn'], fakeuser['password'])
+        entry = cache.cache.get(('credentials', fakeuser['dn']))
+        self.assertFalse(fakeuser['password'] in entry)
+    
+    def test_max_lifetime(self):
+        cache = CredentialsCache(ttl=0, max_lifetime=0, iterations=1)
+        cache.remember(fakeuser['dn'], fakeuser['password'])
+        self.assertFalse(cache.check(fakeuser['dn'], fakeuser['password']))
+
+
+class TestShibbolethAuthenticatorPluginCredentialsCache(Base):
+    """Tests for the credentials cache of the authenticators"""
+    
+    def setUp(self):
+        super(TestShibbolethAuthenticatorPluginCredentialsCache, self).setUp()
+        self.connection = FakeCountingConnection()
+        self.plugin = ShibbolethAuthenticatorPlugin(
+            self.connection, base_dn,
+            credentials_cache=CredentialsCache(iterations=1))
+    
+    def test_disabled_by_default(self):
+        plugin = ShibbolethAuthenticatorPlugin(self.connection, base_dn)
+        self.assertEqual(plugin.credentials_cache, None)
+    
+    def test_ttl_enables_cache(self):
+        plugin = ShibbolethAuthenticatorPlugin(self.connection, base_dn,
+                                               credentials_cache_ttl='30')
+        self.assertEqual(plugin.credentials_cache.max_lifetime, 30)
+    
+    def test_repeated_credentials_skip_bind(self):
+        identity = {'login': fakeuser['uid'],
+                    'password': fakeuser['password']}
+        self.assertEqual(self.plugin.authenticate(self.env, identity),
+                         fakeuser['dn'])
+        self.assertEqual(self.plugin.authenticate(self.env, identity),
+                         fakeuser['dn'])
+        self.assertEqual(self.connection.binds, 1)
+    
+    def test_wrong_password_is_checked(self):
+        identity = {'login': fakeuser['uid'],
+                    'password': fakeuser['password']}
+        self.plugin.authenticate(self.env, identity)
+        identity = {'login': fakeuser['uid'],
+                    'password': 'wrong password'}
+        self.assertEqual(self.plugin.authenticate(self.env, identity), None)
+        self.assertEqual(self.connection.binds, 2)
+
+
+class TestShibbolethSearchAuthenticatorPluginDNSearch(Base):
+    """
+    Tests for the DN searches of L{ShibbolethSearchAuthenticatorPlugin}
+    
+    """
+    
+    def setUp(self):
+        super(TestShibbolethSearchAuthenticatorPluginDNSearch, self).setUp()
+        self.connection = FakeCountingConnection()
+        self.plugin = ShibbolethSearchAuthenticatorPlugin(self.connection,
+                                                          base_dn)
+    
+    def test_no_attributes_are_requested(self):
+        dn = self.plugin._get_dn(self.env, {'login': fakeuser['uid']})
+        self.assertEqual(dn, fakeuser['dn'])
+        self.assertEqual(self.connection.last_search, (['1.1'], 2))
+    
+    def test_size_limit_means_too_many_entries(self):
+        def search_ext_s(*args, **kwargs):
+            raise ldap.SIZELIMIT_EXCEEDED()
+        self.connection.search_ext_s = search_ext_s
+        try:
+            self.plugin._get_dn(self.env, {'login': fakeuser['uid']})
+        except ValueError, e:
+            self.assertTrue(str(e).startswith('Too many entries'))
+        else:
+            self.fail('The login should be ambiguous')
+    
+    def test_references_are_ignored(self):
+        def search_ext_s(*args, **kwargs):
+            return [(None, ['ldap://other.example.org/']),
+                    (fakeuser['dn'], {})]
+        self.connection.search_ext_s = search_ext_s
+        dn = self.plugin._get_dn(self.env, {'login': fakeuser['uid']})
+        self.assertEqual(dn, fakeuser['dn'])
+
+
+class TestPrefetchedAttributes(Base):
+    """
+    Tests for the attributes fetched by L{ShibbolethSearchAuthenticatorPlugin}
+    and reused by L{ShibbolethAttributesPlugin}
+    
+    """
+    
+    def setUp(self):
+        super(TestPrefetchedAttributes, self).setUp()
+        self.connection = FakeCountingConnection()
+        self.authenticator = ShibbolethSearchAuthenticatorPlugin(
+            self.connection, base_dn, fetch_attributes='cn,mail')
+        self.identity = {'login': fakeuser['uid'],
+                         'password': fakeuser['password']}
+        self.identity['repoze.who.userid'] = self.authenticator.authenticate(
+            self.env, self.identity)
+        # The fake connection also searches to check passwords:
+        self.searches = self.connection.searches
+    
+    def test_entry_is_stashed(self):
+        self.assertEqual(self.connection.last_search, (['cn', 'mail'], 2))
+        fetched, attributes = self.env[ENTRIES_KEY][fakeuser['dn']]
+        self.assertEqual(fetched, set(['cn', 'mail']))
+        self.assertEqual(attributes['mail'], [fakeuser['mail']])
+    
+    def test_attributes_are_reused(self):
+        plugin = ShibbolethAttributesPlugin(self.connection, 'mail')
+        plugin.add_metadata(self.env, self.identity)
+        self.assertEqual(self.identity['mail'], [fakeuser['mail']])
+        self.assertFalse('cn' in self.identity)
+        self.assertEqual(self.connection.searches, self.searches)
+    
+    def test_missing_attributes_are_searched(self):
+        plugin = ShibbolethAttributesPlugin(self.connection, 'mail,telephone')
+        plugin.add_metadata(self.env, self.identity)
+        self.assertEqual(self.identity['telephone'], [fakeuser['telephone']])
+        self.assertEqual(self.connection.searches, self.searches + 1)
+    
+    def test_other_requests_search(self):
+        plugin = ShibbolethAttributesPlugin(self.connection, 'mail')
+        plugin.add_metadata(self._makeEnviron(), self.identity)
+        self.assertEqual(self.connection.searches, self.searches + 1)
+
+
+class TestRequestMemo(Base):
+    """Tests for the memoization of the directory operations in a request"""
+    
+    def setUp(self):
+        super(TestRequestMemo, self).setUp()
+        self.connection = FakeCountingConnection()
+        self.plugin = ShibbolethSearchAuthenticatorPlugin(self.connection,
+                                                          base_dn)
+    
+    def _operations(self):
+        return (self.connection.searches, self.connection.binds)
+    
+    def _authenticate(self, environ, password):
+        identity = {'login': fakeuser['uid'], 'password': password}
+        return self.plugin.authenticate(environ, identity)
+    
+    def test_authenticate(self):
+        self.assertEqual(self._authenticate(self.env, fakeuser['password']),
+                         fakeuser['dn'])
+        operations = self._operations()
+        self.assertEqual(self._authenticate(self.env, fakeuser['password']),
+                         fakeuser['dn'])
+        self.assertEqual(self._operations(), operations)
+        self._authenticate(self._makeEnviron(), fakeuser['password'])
+        self.assertNotEqual(self._operations(), operations)
+    
+    def test_wrong_password(self):
+        self.assertEqual(self._authenticate(self.env, 'wrong password'), None)
+        operations = self._operations()
+        self.assertEqual(self._authenticate(self.env, 'wrong password'), None)
+        self.assertEqual(self._operations(), operations)
+        self.assertEqual(self._authenticate(self.env, fakeuser['password']),
+                         fakeuser['dn'])
+        self.assertEqual(self.connection.binds, operations[1] + 1)
+    
+    def test_passwords_are_not_kept(self):
+        self._authenticate(self.env, fakeuser['password'])
+        self.assertFalse(fakeuser['password'] in repr(self.env[MEMO_KEY]))
+    
+    def test_unknown_login(self):
+        identity = {'login': 'i_dont_exist', 'password': 'secret'}
+        self.assertEqual(self.plugin.authenticate(self.env, identity), None)
+        operations = self._operations()
+        self.assertEqual(self.plugin.authenticate(self.env, identity), None)
+        self.assertEqual(self._operations(), operations)
+    
+    def test_add_metadata(self):
+        plugin = ShibbolethAttributesPlugin(self.connection, 'cn,mail')
+        for i in range(2):
+            identity = {'repoze.who.userid': fakeuser['dn']}
+            plugin.add_metadata(self.env, identity)
+            self.assertEqual(identity['mail'], [fakeuser['mail']])
+        self.assertEqual(self.connection.searches, 1)
+    
+    def test_shared_with_async_plugins(self):
+        plugin = AsyncShibbolethSearchAuthenticatorPlugin(
+            FakeAsyncConnection(), base_dn)
+        self._authenticate(self.env, fakeuser['password'])
+        identity = {'login': fakeuser['uid'],
+                    'password': fakeuser['password']}
+        result = LDAPEventLoop(poll_interval=0).run_until_complete(
+            plugin.async_authenticate(self.env, identity))
+        self.assertEqual(result, fakeuser['dn'])
+        self.assertEqual(plugin.ldap_connection.searches, 0)
+        self.assertEqual(plugin.ldap_connection.binds, 0)
+
+
+class TestLazyAttributes(Base):
+    """Tests for the lazy mode of L{ShibbolethAttributesPlugin}"""
+    
+    def setUp(self):
+        super(TestLazyAttributes, self).setUp()
+        self.connection = FakeCountingConnection()
+        self.plugin = ShibbolethAttributesPlugin(self.connection, 'cn,mail',
+                                                 lazy_key='attributes')
+        self.identity = {'repoze.who.userid': fakeuser['dn']}
+    
+    def test_no_search_until_used(self):
+        self.plugin.add_metadata(self.env, self.identity)
+        attributes = self.identity['attributes']
+        self.assertTrue(isinstance(attributes, LazyAttributes))
+        self.assertFalse(attributes.loaded)
+        self.assertFalse('mail' in self.identity)
+        self.assertEqual(self.connection.searches, 0)
+    
+    def test_search_on_first_use(self):
+        self.plugin.add_metadata(self.env, self.identity)
+        attributes = self.identity['attributes']
+        self.assertEqual(attributes['mail'], [fakeuser['mail']])
+        self.assertEqual(attributes.get('cn'), [fakeuser['cn']])
+        self.assertTrue(set(['cn', 'mail']).issubset(attributes))
+        self.assertTrue(attributes.loaded)
+        self.assertEqual(self.connection.searches, 1)
+    
+    def test_request_not_kept(self):
+        self.plugin.add_metadata(self.env, self.identity)
+        attributes = self.identity['attributes']
+        self.assertFalse([cell for cell in attributes._load.func_closure
+                          if cell.cell_contents is self.env])
+        attributes.keys()
+        self.assertEqual(attributes._load, None)
+        # The search was still memoized in the request:
+        self.plugin.add_metadata(self.env, self.identity)
+        self.identity['attributes'].keys()
+        self.assertEqual(self.connection.searches, 1)
+    
+    def test_directory_down(self):
+        def search_s(*args, **kwargs):
+            raise ldap.SERVER_DOWN()
+        self.connection.search_s = search_s
+        logger = FakeLogger()
+        self.plugin.add_metadata(
+            self._makeEnviron({'repoze.who.logger': logger}), self.identity)
+        attributes = self.identity['attributes']
+        self.assertRaises(AttributesUnavailable, attributes.get, 'mail')
+        self.assertFalse(attributes.loaded)
+        self.assertEqual(len(logger.warnings), 1)
+    
+    def test_modifications(self):
+        self.plugin.add_metadata(self.env, self.identity)
+        attributes = self.identity['attributes']
+        attributes['mail'].append('someone@example.org')
+        del attributes['cn']
+        identity = {'repoze.who.userid': fakeuser['dn']}
+        self.plugin.add_metadata(self.env, identity)
+        self.assertEqual(identity['attributes']['mail'], [fakeuser['mail']])
+        self.assertEqual(identity['attributes']['cn'], [fakeuser['cn']])
+    
+    def test_circuit_open(self):
+        loads = []
+        def load():
+            loads.append(None)
+            if len(loads) == 1:
+                return None
+            return {'mail': [fakeuser['mail']]}
+        attributes = LazyAttributes(load)
+        self.assertFalse('mail' in attributes)
+        self.assertFalse(attributes.loaded)
+        self.assertTrue('mail' in attributes)
+        self.assertEqual(len(loads), 2)
+    
+    def test_async(self):
+        plugin = AsyncShibbolethAttributesPlugin(FakeAsyncConnection(),
+                                                 'mail', lazy_key='ldap')
+        LDAPEventLoop(poll_interval=0).run_until_complete(
+            plugin.async_add_metadata(self.env, self.identity))
+        self.assertEqual(plugin.ldap_connection.searches, 0)
+        self.assertEqual(self.identity['ldap']['mail'], [fakeuser['mail']])
+
+
+class TestUserdataCodec(unittest.TestCase):
+    """Tests for L{UserdataCodec}"""
+    
+    def setUp(self):
+        self.codec = UserdataCodec('secret', max_age=60)
+        self.attributes = {'mail': [fakeuser['mail']], 'uid': 'carla',
+                           'cn': [u'Carla Pa\xf3la'.encode('utf-8')]}
+    
+    def test_secret_required(self):
+        self.assertRaises(ValueError, UserdataCodec, '')
+    
+    def test_dn(self):
+        userdata = self.codec.decode(self.codec.encode(fakeuser['dn']))
+        self.assertEqual(userdata.dn, fakeuser['dn'])
+        self.assertEqual(userdata.attributes, None)
+        self.assertFalse(self.codec.fresh(userdata, ('*',)))
+    
+    def test_snapshot(self):
+        token = self.codec.encode(fakeuser['dn'], self.attributes,
+                                  ('cn', 'mail', 'uid'))
+        userdata = self.codec.decode('other data' + token)
+        self.assertEqual(userdata.attributes, self.attributes)
+        self.assertEqual(userdata.names, ('cn', 'mail', 'uid'))
+        self.assertTrue(self.codec.fresh(userdata, ('cn', 'mail', 'uid')))
+        self.assertFalse(self.codec.fresh(userdata, ('mail',)))
+    
+    def test_expiry(self):
+        token = self.codec.encode(fakeuser['dn'], self.attributes, ('*',),
+                                  issued_at=time.time() - 61)
+        self.assertFalse(self.codec.fresh(self.codec.decode(token), ('*',)))
+    
+    def test_signature(self):
+        token = self.codec.encode(fakeuser['dn'], self.attributes, ('*',))
+        other = UserdataCodec('other secret')
+        self.assertEqual(other.decode(token), None)
+        payload, signature = token[len('<shib1:'):-1].split('.')
+        forged = '<shib1:%s.%s>' % (payload[:-2] + 'AA', signature)
+        self.assertEqual(self.codec.decode(forged), None)
+    
+    def test_max_size(self):
+        codec = UserdataCodec('secret', max_size=100)
+        token = codec.encode(fakeuser['dn'], {'description': ['x' * 500]})
+        self.assertTrue(len(token) <= 150)
+        self.assertEqual(codec.decode(token).attributes, None)
+    
+    def test_binary_values(self):
+        token = self.codec.encode(fakeuser['dn'], {'photo': ['\xff\xd8']})
+        self.assertEqual(self.codec.decode(token).attributes, None)
+    
+    def test_passwords_are_excluded(self):
+        token = self.codec.encode(fakeuser['dn'], {'userPassword': ['x'],
+                                                   'mail': ['y']})
+        self.assertEqual(self.codec.decode(token).attributes, {'mail': ['y']})
+    
+    def test_legacy_tokens(self):
+        userdata = self.codec.decode('<dn:%s>' % b64encode(fakeuser['dn']))
+        self.assertEqual(userdata.dn, fakeuser['dn'])
+        self.assertEqual(self.codec.decode('nothing'), None)
+    
+    def test_replace(self):
+        legacy = 'data<dn:%s>' % b64encode(fakeuser['dn'])
+        token = self.codec.encode(fakeuser['dn'])
+        self.assertEqual(self.codec.replace(legacy, token), 'data' + token)
+        other = self.codec.encode('uid=other,' + base_dn)
+        self.assertEqual(self.codec.replace(token, other), other)
+
+
+class TestUserdataSnapshot(Base):
+    """Tests for the attribute snapshots kept in the userdata"""
+    
+    def setUp(self):
+        super(TestUserdataSnapshot, self).setUp()
+        self.connection = FakeCountingConnection()
+        self.authenticator = ShibbolethAuthenticatorPlugin(
+            self.connection, base_dn, returned_id='login',
+            userdata_secret='secret')
+        self.plugin = ShibbolethAttributesPlugin(self.connection, 'cn,mail',
+                                                 userdata_secret='secret',
+                                                 userdata_max_age=60)
+    
+    def _login(self):
+        identity = {'login': fakeuser['uid'],
+                    'password': fakeuser['password']}
+        self.assertEqual(self.authenticator.authenticate(self.env, identity),
+                         fakeuser['uid'])
+        self.plugin.add_metadata(self.env, identity)
+        return identity
+    
+    def test_snapshot_is_used(self):
+        userdata = self._login()['userdata']
+        self.assertTrue(userdata.startswith('<shib1:'))
+        searches = self.connection.searches
+        identity = {'repoze.who.userid': fakeuser['uid'],
+                    'userdata': userdata}
+        self.plugin.add_metadata(self._makeEnviron(), identity)
+        self.assertEqual(identity['mail'], [fakeuser['mail']])
+        self.assertEqual(identity['userdata'], userdata)
+        self.assertEqual(self.connection.searches, searches)
+    
+    def test_stale_snapshot_is_refreshed(self):
+        userdata = self.plugin.userdata_codec.encode(
+            fakeuser['dn'], {'mail': ['old@example.org']}, ('cn', 'mail'),
+            issued_at=time.time() - 61)
+        identity = {'repoze.who.userid': fakeuser['uid'],
+                    'userdata': userdata}
+        self.plugin.add_metadata(self.env, identity)
+        self.assertEqual(identity['mail'], [fakeuser['mail']])
+        self.assertEqual(self.connection.searches, 1)
+        self.assertNotEqual(identity['userdata'], userdata)
+    
+    def test_other_attributes_are_searched(self):
+        userdata = self._login()['userdata']
+        plugin = ShibbolethAttributesPlugin(self.connection, 'telephone',
+                                            userdata_secret='secret')
+        searches = self.connection.searches
+        identity = {'repoze.who.userid': fakeuser['uid'],
+                    'userdata': userdata}
+        plugin.add_metadata(self._makeEnviron(), identity)
+        self.assertEqual(self.connection.searches, searches + 1)
+    
+    def test_excluded_attributes(self):
+        plugin = ShibbolethAttributesPlugin(
+            self.connection, 'cn,mail', userdata_secret='secret',
+            userdata_excluded_attributes='Mail, telephone')
+        self.assertEqual(plugin.userdata_codec.excluded_attributes,
+                         frozenset(['mail', 'telephone']))
+        identity = {'repoze.who.userid': fakeuser['dn']}
+        plugin.add_metadata(self.env, identity)
+        self.assertEqual(identity['mail'], [fakeuser['mail']])
+        userdata = plugin.userdata_codec.decode(identity['userdata'])
+        self.assertEqual(userdata.dn, fakeuser['dn'])
+        self.assertEqual(userdata.attributes, None)
+        # Without the excluded attributes, the snapshot is taken:
+        token = plugin.userdata_codec.encode(fakeuser['dn'],
+                                             {'cn': [fakeuser['cn']]})
+        self.assertEqual(plugin.userdata_codec.decode(token).attributes,
+                         {'cn': [fakeuser['cn']]})
+    
+    def test_legacy_userdata(self):
+        identity = {'repoze.who.userid': fakeuser['uid'],
+                    'userdata': '<dn:%s>' % b64encode(fakeuser['dn'])}
+        self.plugin.add_metadata(self.env, identity)
+        self.assertEqual(identity['mail'], [fakeuser['mail']])
+        self.assertTrue(identity['userdata'].startswith('<shib1:'))
+    
+    def test_async(self):
+        userdata = self._login()['userdata']
+        plugin = AsyncShibbolethAttributesPlugin(FakeAsyncConnection(),
+                                                 'cn,mail',
+                                                 userdata_secret='secret')
+        identity = {'repoze.who.userid': fakeuser['uid'],
+                    'userdata': userdata}
+        LDAPEventLoop(poll_interval=0).run_until_complete(
+            plugin.async_add_metadata(self._makeEnviron(), identity))
+        self.assertEqual(identity['mail'], [fakeuser['mail']])
+        self.assertEqual(plugin.ldap_connection.searches, 0)
+
+
+class TestDirectoryMirror(Base):
+    """Tests for L{DirectoryMirror}"""
+    
+    others = {'uid=alice': 'alice', 'uid=bob': 'bob', 'uid=bob2': 'bob'}
+    
+    def setUp(self):
+        super(TestDirectoryMirror, self).setUp()
+        for (rdn, login) in self.others.items():
+            self.connection.add_s('%s,%s' % (rdn, base_dn),
+                                  modlist.addModlist({'uid': login}))
+        self.connection = FakePagedConnection()
+    
+    def tearDown(self):
+        for rdn in self.others:
+            self.connection.delete_s('%s,%s' % (rdn, base_dn))
+        super(TestDirectoryMirror, self).tearDown()
+    
+    def test_lookup(self):
+        mirror = DirectoryMirror(self.connection, base_dn)
+        self.assertFalse(mirror.ready)
+        self.assertEqual(mirror.lookup(fakeuser['uid']), None)
+        self.assertEqual(mirror.load(), 2)
+        self.assertTrue(mirror.ready)
+        self.assertEqual(mirror.lookup(' %s ' % fakeuser['uid'].upper()),
+                         fakeuser['dn'])
+        self.assertEqual(mirror.lookup('alice'), 'uid=alice,' + base_dn)
+        # Ambiguous:
+        self.assertEqual(mirror.lookup('bob'), None)
+    
+    def test_paged_search(self):
+        mirror = DirectoryMirror(self.connection, base_dn, page_size=1)
+        mirror.load()
+        self.assertEqual(len(mirror), 2)
+        self.assertEqual(self.connection.pages, 4)
+    
+    def test_restrict(self):
+        mirror = DirectoryMirror(fakeldap.FakeLDAPConnection(), base_dn,
+                                 restrict='(mail=*)')
+        self.assertEqual(mirror.filterstr, '(&(mail=*)(uid=*))')
+        mirror.load()
+        self.assertEqual(mirror.lookup(fakeuser['uid']), fakeuser['dn'])
+    
+    def test_plugin(self):
+        mirror = DirectoryMirror(self.connection, base_dn)
+        mirror.load()
+        plugin = ShibbolethSearchAuthenticatorPlugin(self.connection,
+                                                     base_dn, mirror=mirror)
+        searches = self.connection.searches
+        identity = {'login': fakeuser['uid'],
+                    'password': fakeuser['password']}
+        self.assertEqual(plugin._get_dn(self.env, identity), fakeuser['dn'])
+        self.assertEqual(self.connection.searches, searches)
+        self.assertRaises(ValueError, plugin._get_dn, self.env,
+                          {'login': 'bob'})
+        self.assertEqual(self.connection.searches, searches + 1)
+    
+    def test_background_load(self):
+        self.assertRaises(ValueError, ShibbolethSearchAuthenticatorPlugin,
+                          self.connection, base_dn,
+                          mirror_refresh_interval=3600)
+        plugin = ShibbolethSearchAuthenticatorPlugin(
+            LDAPConnectionPool(FakePagedConnection), base_dn,
+            mirror_refresh_interval=3600)
+        try:
+            self.assertTrue(plugin.mirror.wait(5))
+            self.assertEqual(plugin.mirror.lookup(fakeuser['uid']),
+                             fakeuser['dn'])
+        finally:
+            plugin.mirror.stop()
+    
+    def test_user_bind_between_pages(self):
+        plugin = ShibbolethSearchAuthenticatorPlugin(
+            LDAPConnectionPool(FakeInterleavedConnection), base_dn,
+            mirror_refresh_interval=3600, mirror_page_size=1)
+        identity = {'login': fakeuser['uid'],
+                    'password': fakeuser['password']}
+        try:
+            self.assertTrue(plugin.mirror.wait(5))
+            FakeInterleavedConnection.searched_as = []
+            FakeInterleavedConnection.between_pages = staticmethod(
+                lambda: plugin.authenticate(self._makeEnviron(),
+                                            dict(identity)))
+            self.assertEqual(plugin.mirror.load(), 2)
+        finally:
+            FakeInterleavedConnection.between_pages = None
+            plugin.mirror.stop()
+        # All the pages were searched by the service, not by the user:
+        self.assertEqual(FakeInterleavedConnection.searched_as,
+                         [None] * 4)
+    
+    def test_failed_load(self):
+        mirror = DirectoryMirror(LDAPConnectionPool(FakeDownConnection),
+                                 base_dn, retry_interval=3600)
+        self.assertRaises(ldap.SERVER_DOWN, mirror.load)
+        mirror.start()
+        mirror.stop()
+        self.assertFalse(mirror.ready)
+        self.assertTrue(isinstance(mirror.last_error, ldap.SERVER_DOWN))
+    
+    def test_unexpected_error(self):
+        mirror = DirectoryMirror(self.connection, base_dn, retry_interval=0)
+        load = mirror.load
+        errors = [ValueError('Bad entry')]
+        def flaky_load():
+            if errors:
+                raise errors.pop()
+            return load()
+        mirror.load = flaky_load
+        mirror.start()
+        try:
+            # The thread survived the error and loaded the mirror again:
+            self.assertTrue(mirror.wait(5))
+            self.assertEqual(mirror.last_error, None)
+        finally:
+            mirror.stop()
+
+
+class TestBatchAuthentication(Base):
+    """Tests for the C{authenticate_many} method of the authenticators"""
+    
+    others = ('alice', 'bob')
+    
+    def setUp(self):
+        super(TestBatchAuthentication, self).setUp()
+        for login in self.others:
+            password = '{SHA}%s' % b64encode(sha1(login + '!').digest())
+            self.connection.add_s('uid=%s,%s' % (login, base_dn),
+                                  modlist.addModlist({'uid': login,
+                                                      'userPassword':
+                                                      [password]}))
+        self.connection = FakeCountingConnection()
+        self.identities = [
+            {'login': fakeuser['uid'], 'password': fakeuser['password']},
+            {'login': 'alice', 'password': 'wrong'},
+            {'login': 'nobody', 'password': 'nobody!'},
+            {'login': 'ALICE ', 'password': 'alice!'},
+            {'login': 'bob'},
+            {'login': 'bob', 'password': 'bob!'},
+            ]
+        self.expected = [fakeuser['dn'], None, None,
+                         'uid=alice,' + base_dn, None, 'uid=bob,' + base_dn]
+    
+    def tearDown(self):
+        for login in self.others:
+            self.connection.delete_s('uid=%s,%s' % (login, base_dn))
+        super(TestBatchAuthentication, self).tearDown()
+    
+    def test_search_authenticator(self):
+        plugin = ShibbolethSearchAuthenticatorPlugin(self.connection, base_dn)
+        self.assertEqual(plugin.authenticate_many(self.env, self.identities),
+                         self.expected)
+    
+    def test_one_search(self):
+        plugin = ShibbolethSearchAuthenticatorPlugin(self.connection, base_dn)
+        dns = plugin._get_dns(self.env, self.identities)
+        # The login which matched no entry is searched again on its own:
+        self.assertEqual(self.connection.searches, 2)
+        self.assertEqual(dns, [fakeuser['dn'], 'uid=alice,' + base_dn, None,
+                               'uid=alice,' + base_dn, 'uid=bob,' + base_dn,
+                               'uid=bob,' + base_dn])
+        # The DNs found are memoized like those of authenticate():
+        plugin._get_dns(self.env, self.identities)
+        self.assertEqual(self.connection.searches, 2)
+    
+    def test_batch_search_size(self):
+        plugin = ShibbolethSearchAuthenticatorPlugin(self.connection, base_dn,
+                                                     batch_search_size=2)
+        plugin._get_dns(self.env, self.identities)
+        # alice and bob, then carla and nobody, then nobody alone:
+        self.assertEqual(self.connection.searches, 3)
+    
+    def test_unmatched_entries(self):
+        connection = FakeCaseIgnoreConnection(['jos\xc3\xa9', 'mary  ann'])
+        plugin = ShibbolethSearchAuthenticatorPlugin(connection, base_dn,
+                                                     dn_cache_ttl=60,
+                                                     negative_cache_ttl=60)
+        identities = [{'login': u'JOS\xc9'}, {'login': u'Mary Ann'},
+                      {'login': 'nobody'}]
+        # The entries found can't be told apart, so each login is searched:
+        self.assertEqual(plugin._get_dns(self.env, identities),
+                         ['uid=jos\xc3\xa9,' + base_dn,
+                          'uid=mary  ann,' + base_dn, None])
+        self.assertEqual(connection.searches, 4)
+        self.assertEqual(len(plugin.negative_cache), 1)
+    
+    def test_cached_dns(self):
+        plugin = ShibbolethSearchAuthenticatorPlugin(self.connection, base_dn,
+                                                     dn_cache_ttl=60,
+                                                     negative_cache_ttl=60)
+        plugin._get_dns(self.env, self.identities)
+        searches = self.connection.searches
+        self.assertEqual(plugin._get_dns(self._makeEnviron(),
+                                         self.identities)[2], None)
+        self.assertEqual(self.connection.searches, searches)
+    
+    def test_restrict(self):
+        plugin = ShibbolethSearchAuthenticatorPlugin(
+            self.connection, base_dn, restrict='(mail=*)')
+        self.assertEqual(plugin._get_dns(self.env, self.identities[:2]),
+                         [fakeuser['dn'], None])
+    
+    def test_escaped_logins(self):
+        filters = []
+        plugin = ShibbolethSearchAuthenticatorPlugin(self.connection, base_dn)
+        search_s = self.connection.search_s
+        def record(base, scope, filterstr, *args, **kwargs):
+            filters.append(filterstr)
+            return search_s(base, scope, filterstr, *args, **kwargs)
+        self.connection.search_s = record
+        plugin._get_dns(self.env, [{'login': 'carla)(uid=*'}])
+        # It matched no entry, so it was searched again on its own:
+        self.assertEqual(filters, [r'(|(uid=carla\29\28uid=\2a))',
+                                   r'(uid=carla\29\28uid=\2a)'])
+        self.assertEqual(plugin._search_filter({'login': 'a*(b)\\'}),
+                         r'(uid=a\2a\28b\29\5c)')
+    
+    def test_pooled_binds(self):
+        pool = LDAPConnectionPool(FakeCountingConnection, max_size=4)
+        plugin = ShibbolethSearchAuthenticatorPlugin(pool, base_dn)
+        self.assertEqual(plugin.authenticate_many(self.env, self.identities,
+                                                  max_workers=4),
+                         self.expected)
+    
+    def test_pattern_authenticator(self):
+        plugin = ShibbolethAuthenticatorPlugin(self.connection, base_dn,
+                                               returned_id='login')
+        identities = [dict(identity) for identity in self.identities]
+        self.assertEqual(plugin.authenticate_many(self.env, identities),
+                         [fakeuser['uid'], None, None, None, None, 'bob'])
+        self.assertEqual(identities[5]['userdata'],
+                         '<dn:%s>' % b64encode('uid=bob,' + base_dn))
+    
+    def test_run_concurrently(self):
+        results = {}
+        run_concurrently(results.__setitem__,
+                         [(number, number * 2) for number in range(20)], 4)
+        self.assertEqual(results, dict([(number, number * 2)
+                                        for number in range(20)]))
+        self.assertRaises(ZeroDivisionError, run_concurrently,
+                          lambda number: 1 / number, [(1,), (0,), (2,)], 2)
+
+
+class TestShibbolethSPPlugin(unittest.TestCase):
+    """Tests for L{ShibbolethSPPlugin}"""
+    
+    def _environ(self, **variables):
+        environ = {'REMOTE_ADDR': '10.1.2.3', 'Shib-Session-ID': '_abc123'}
+        environ.update(variables)
+        return environ
+    
+    def test_identify(self):
+        plugin = ShibbolethSPPlugin()
+        identity = plugin.identify(self._environ(eppn='carla@example.org'))
+        self.assertEqual(identity[USERID_KEY], 'carla@example.org')
+        self.assertEqual(plugin.authenticate({}, identity),
+                         'carla@example.org')
+        # REMOTE_USER comes first:
+        identity = plugin.identify(self._environ(eppn='carla@example.org',
+                                                 REMOTE_USER='carla'))
+        self.assertEqual(identity[USERID_KEY], 'carla')
+    
+    def test_without_session(self):
+        environ = self._environ(REMOTE_USER='carla')
+        del environ['Shib-Session-ID']
+        self.assertEqual(ShibbolethSPPlugin().identify(environ), None)
+        plugin = ShibbolethSPPlugin(require_session=False)
+        self.assertEqual(plugin.identify(environ)[USERID_KEY], 'carla')
+    
+    def test_several_ids(self):
+        plugin = ShibbolethSPPlugin(user_keys='eppn')
+        environ = self._environ(eppn='carla@example.org;c@example.org')
+        self.assertEqual(plugin.identify(environ), None)
+        self.assertEqual(plugin.identify(self._environ()), None)
+    
+    def test_other_identities(self):
+        plugin = ShibbolethSPPlugin()
+        self.assertEqual(plugin.authenticate({}, {'login': 'carla',
+                                                  'password': 'x'}), None)
+    
+    def test_headers(self):
+        self.assertRaises(ValueError, ShibbolethSPPlugin, use_headers=True)
+        plugin = ShibbolethSPPlugin(user_keys='eppn', use_headers=True,
+                                    trusted_proxies='10.0.0.0/8, ::1')
+        environ = {'REMOTE_ADDR': '10.1.2.3', 'HTTP_SHIB_SESSION_ID': '_a',
+                   'HTTP_EPPN': 'carla@example.org',
+                   'eppn': 'mallory@example.org'}
+        self.assertEqual(plugin.identify(environ)[USERID_KEY],
+                         'carla@example.org')
+        environ['REMOTE_ADDR'] = '192.168.1.1'
+        self.assertEqual(plugin.identify(environ), None)
+        environ['REMOTE_ADDR'] = '::1'
+        self.assertNotEqual(plugin.identify(environ), None)
+        del environ['REMOTE_ADDR']
+        self.assertEqual(plugin.identify(environ), None)
+    
+    def test_dn_pattern(self):
+        plugin = ShibbolethSPPlugin(dn_pattern='uid=%s,' + base_dn)
+        identity = plugin.identify(self._environ(REMOTE_USER='carla'))
+        plugin.authenticate({}, identity)
+        self.assertEqual(identity['userdata'],
+                         '<dn:%s>' % b64encode('uid=carla,' + base_dn))
+        plugin = ShibbolethSPPlugin(dn_pattern='uid=%s,' + base_dn,
+                                    userdata_secret='secret')
+        identity = plugin.identify(self._environ(REMOTE_USER='carla'))
+        plugin.authenticate({}, identity)
+        self.assertEqual(UserdataCodec('secret').decode(
+            identity['userdata']).dn, 'uid=carla,' + base_dn)
+    
+    def test_address_matcher(self):
+        matcher = AddressMatcher(['192.168.0.0/16', '10.0.0.1', 'fe80::/10'])
+        self.assertTrue(matcher.match('192.168.200.1'))
+        self.assertTrue(matcher.match('10.0.0.1'))
+        self.assertFalse(matcher.match('10.0.0.2'))
+        self.assertTrue(matcher.match('fe80::1'))
+        self.assertFalse(matcher.match('::1'))
+        self.assertFalse(matcher.match('not an address'))
+        self.assertTrue(AddressMatcher('0.0.0.0/0').match('8.8.8.8'))
+        self.assertRaises(ValueError, AddressMatcher, '10.0.0.0/33')
+        self.assertRaises(ValueError, AddressMatcher, 'example.org')
+    
+    def test_split_values(self):
+        self.assertEqual(split_values(None), [])
+        self.assertEqual(split_values('a;b'), ['a', 'b'])
+        self.assertEqual(split_values(r'a\;b;c'), ['a;b', 'c'])
+        self.assertEqual(split_values(r'a\b;;'), [r'a\b'])
+
+
+class TestReleasedAttributes(Base):
+    """Tests for the attributes released by the SP in the environ"""
+    
+    def setUp(self):
+        super(TestReleasedAttributes, self).setUp()
+        self.connection = FakeCountingConnection()
+        self.identity = {'repoze.who.userid': fakeuser['dn'],
+                         USERID_KEY: fakeuser['uid']}
+    
+    def _plugin(self, attributes='cn,mail', **kwargs):
+        kwargs.setdefault('released_attributes', 'cn,mail=Shib-Mail')
+        return ShibbolethAttributesPlugin(self.connection, attributes,
+                                          **kwargs)
+    
+    def test_all_released(self):
+        environ = self._makeEnviron({'cn': 'Carla', 'Shib-Mail':
+                                     r'carla@example.org;c\;p@example.org'})
+        self._plugin().add_metadata(environ, self.identity)
+        self.assertEqual(self.identity['cn'], ['Carla'])
+        self.assertEqual(self.identity['mail'],
+                         ['carla@example.org', 'c;p@example.org'])
+        self.assertEqual(self.connection.searches, 0)
+    
+    def test_some_released(self):
+        environ = self._makeEnviron({'cn': 'Carla'})
+        self._plugin().add_metadata(environ, self.identity)
+        self.assertEqual(self.identity['cn'], ['Carla'])
+        self.assertEqual(self.identity['mail'], [fakeuser['mail']])
+        self.assertEqual(self.connection.searches, 1)
+    
+    def test_all_attributes(self):
+        environ = self._makeEnviron({'cn': 'Carla', 'Shib-Mail': 'c@x.org'})
+        self._plugin(None).add_metadata(environ, self.identity)
+        self.assertEqual(self.connection.searches, 1)
+        self.assertEqual(self.identity['cn'], ['Carla'])
+        self.assertEqual(self.identity['telephone'], [fakeuser['telephone']])
+    
+    def test_parsed_once(self):
+        environ = self._makeEnviron({'cn': 'Carla', 'Shib-Mail': 'c@x.org'})
+        plugin = self._plugin()
+        plugin.add_metadata(environ, self.identity)
+        environ['cn'] = 'Someone else'
+        plugin.add_metadata(environ, self.identity)
+        self.assertEqual(self.identity['cn'], ['Carla'])
+    
+    def test_not_the_sp_user(self):
+        # E.g., a user logged in with a form while the SP let someone else in:
+        identity = {'repoze.who.userid': fakeuser['dn']}
+        environ = self._makeEnviron({'cn': 'Mallory', 'Shib-Mail': 'm@x.org'})
+        self._plugin().add_metadata(environ, identity)
+        self.assertEqual(identity['cn'], [fakeuser['cn']])
+        self.assertEqual(identity['mail'], [fakeuser['mail']])
+        self.assertEqual(self.connection.searches, 1)
+    
+    def test_lazy(self):
+        environ = self._makeEnviron({'cn': 'Carla', 'Shib-Mail': 'c@x.org'})
+        self._plugin(lazy_key='ldap').add_metadata(environ, self.identity)
+        self.assertEqual(dict(self.identity['ldap']),
+                         {'cn': ['Carla'], 'mail': ['c@x.org']})
+        self.assertEqual(self.connection.searches, 0)
+    
+    def test_headers(self):
+        self.assertRaises(ValueError, self._plugin, released_use_headers=True)
+        plugin = self._plugin(released_use_headers=True,
+                              released_trusted_proxies='127.0.0.1')
+        environ = self._makeEnviron({'HTTP_CN': 'Carla',
+                                     'HTTP_SHIB_MAIL': 'c@x.org',
+                                     'REMOTE_ADDR': '127.0.0.1'})
+        plugin.add_metadata(environ, self.identity)
+        self.assertEqual(self.identity['mail'], ['c@x.org'])
+        self.assertEqual(self.connection.searches, 0)
+        # From an untrusted address:
+        environ = self._makeEnviron({'HTTP_CN': 'Carla',
+                                     'HTTP_SHIB_MAIL': 'c@x.org',
+                                     'REMOTE_ADDR': '10.0.0.1'})
+        plugin.add_metadata(environ, self.identity)
+        self.assertEqual(self.identity['mail'], [fakeuser['mail']])
+        self.assertEqual(self.connection.searches, 1)
+    
+    def test_async(self):
+        plugin = AsyncShibbolethAttributesPlugin(
+            FakeAsyncConnection(), 'cn,mail',
+            released_attributes='cn,mail=Shib-Mail')
+        environ = self._makeEnviron({'cn': 'Carla'})
+        LDAPEventLoop(poll_interval=0).run_until_complete(
+            plugin.async_add_metadata(environ, self.identity))
+        self.assertEqual(self.identity['cn'], ['Carla'])
+        self.assertEqual(self.identity['mail'], [fakeuser['mail']])
+        self.assertEqual(plugin.ldap_connection.searches, 1)
+
+
+class TestGroups(Base):
+    """Tests for L{GroupGraph} and L{ShibbolethGroupsPlugin}"""
+    
+    groups_dn = 'ou=groups,dc=example,dc=org'
+    
+    def setUp(self):
+        super(TestGroups, self).setUp()
+        group = lambda name: 'cn=%s,%s' % (name, self.groups_dn)
+        self.connection = FakeGroupsConnection([
+            # The member DN is written differently from the user's:
+            (group('staff'),
+             {'cn': ['staff'],
+              'member': [fakeuser['dn'].upper().replace(',', ', ')]}),
+            (group('devs'), {'cn': ['devs'], 'uniqueMember': [group('staff')],
+                             'member': [group('all')]}),
+            # A cycle:
+            (group('all'), {'cn': ['all'], 'member': [group('devs')]}),
+            (group('other'), {'cn': ['other'],
+                              'member': ['uid=alice,' + base_dn]}),
+            (None, ['ldap://example.com/ou=more,dc=example,dc=org']),
+            ])
+        self.graph = GroupGraph(self.connection, self.groups_dn)
+    
+    def _plugin(self, **kwargs):
+        kwargs.setdefault('graph', self.graph)
+        return ShibbolethGroupsPlugin(self.connection, self.groups_dn,
+                                      **kwargs)
+    
+    def test_normalize_dn(self):
+        self.assertEqual(normalize_dn('UID=Jsmith, OU=People,dc=example'),
+                         'uid=jsmith,ou=people,dc=example')
+    
+    def test_load(self):
+        self.assertFalse(self.graph.ready)
+        self.assertEqual(self.graph.groups_of(fakeuser['dn']), frozenset())
+        self.assertEqual(self.graph.load(), 4)
+        self.assertTrue(self.graph.ready)
+        base, filterstr, attrlist = self.connection.last_search
+        self.assertEqual(base, self.groups_dn)
+        self.assertEqual(attrlist, ['cn', 'member', 'uniqueMember'])
+    
+    def test_paged_search(self):
+        # More groups than the server returns at once:
+        self.connection.sizelimit = 2
+        self.assertRaises(ldap.SIZELIMIT_EXCEEDED, self.connection.search_s,
+                          self.groups_dn, ldap.SCOPE_SUBTREE,
+                          '(objectClass=group)')
+        graph = GroupGraph(self.connection, self.groups_dn, page_size=2)
+        self.assertEqual(graph.load(), 4)
+        self.assertEqual(self.connection.pages, 3)
+        self.assertEqual(len(graph.groups_of(fakeuser['dn'])), 3)
+    
+    def test_groups_of(self):
+        self.graph.load()
+        groups = self.graph.groups_of(fakeuser['dn'])
+        self.assertEqual(groups,
+                         frozenset([('cn=%s,%s' % (name, self.groups_dn), name)
+                                    for name in ('staff', 'devs', 'all')]))
+        self.assertEqual(self.graph.groups_of('uid=alice,' + base_dn),
+                         frozenset([('cn=other,' + self.groups_dn, 'other')]))
+        self.assertEqual(self.graph.groups_of('uid=bob,' + base_dn),
+                         frozenset())
+        self.assertEqual(self.graph.groups_of(None), frozenset())
+    
+    def test_memoized_closures(self):
+        self.graph.load()
+        self.graph.groups_of(fakeuser['dn'])
+        closures = self.graph._graph[2]
+        staff = normalize_dn('cn=staff,' + self.groups_dn)
+        self.assertEqual(len(closures[staff]), 3)
+        # The closures are computed again once the graph is reloaded:
+        self.graph.load()
+        self.assertEqual(self.graph._graph[2], {})
+    
+    def test_ensure_loaded(self):
+        self.graph.ensure_loaded()
+        self.graph.ensure_loaded()
+        self.assertEqual(self.connection.searches, 1)
+    
+    def test_ensure_loaded_backoff(self):
+        self.connection.down = True
+        self.assertRaises(ldap.LDAPError, self.graph.ensure_loaded)
+        # The directory isn't searched again until the retry interval passed:
+        self.assertRaises(ldap.LDAPError, self.graph.ensure_loaded)
+        self.assertEqual(self.connection.searches, 1)
+        self.connection.down = False
+        self.graph.retry_interval = 0
+        self.graph.ensure_loaded()
+        self.assertTrue(self.graph.ready)
+        self.assertEqual(self.graph.last_error, None)
+    
+    def test_unexpected_error(self):
+        def load():
+            raise ValueError('Bad group')
+        self.graph.load = load
+        self.assertRaises(ldap.UNAVAILABLE, self.graph.ensure_loaded)
+        self.assertTrue(isinstance(self.graph.last_error, ValueError))
+    
+    def test_ensure_loaded_by_thread(self):
+        self.connection.down = True
+        self.graph.retry_interval = 3600
+        self.graph.start()
+        try:
+            while self.graph.last_error is None:
+                time.sleep(0.01)
+            # The requests leave the retries to the refresh thread:
+            self.assertRaises(ldap.LDAPError, self.graph.ensure_loaded)
+            self.assertEqual(self.connection.searches, 1)
+        finally:
+            self.graph.stop()
+    
+    def test_background_load(self):
+        plugin = ShibbolethGroupsPlugin(self.connection, self.groups_dn,
+                                        refresh_interval=3600)
+        try:
+            self.assertTrue(plugin.graph.wait(5))
+            self.assertEqual(len(plugin.graph), 4)
+        finally:
+            plugin.graph.stop()
+    
+    def test_plugin(self):
+        plugin = self._plugin()
+        identity = {'repoze.who.userid': fakeuser['dn']}
+        plugin.add_metadata(self.env, identity)
+        self.assertEqual(identity['groups'], set(['staff', 'devs', 'all']))
+        plugin.add_metadata(self._makeEnviron(), identity)
+        self.assertEqual(self.connection.searches, 1)
+    
+    def test_plugin_dn_from_userdata(self):
+        plugin = self._plugin(returned_id='dn', identity_key='memberOf')
+        identity = {'repoze.who.userid': fakeuser['uid'],
+                    'userdata': '<dn:%s>' % b64encode(fakeuser['dn'])}
+        plugin.add_metadata(self.env, identity)
+        self.assertEqual(identity['memberOf'],
+                         set(['cn=%s,%s' % (name, self.groups_dn)
+                              for name in ('staff', 'devs', 'all')]))
+    
+    def test_plugin_without_dn(self):
+        plugin = self._plugin()
+        identity = {'userdata': ''}
+        plugin.add_metadata(self.env, identity)
+        self.assertFalse('groups' in identity)
+    
+    def test_plugin_without_graph(self):
+        self.connection.down = True
+        logger = FakeLogger()
+        identity = {'repoze.who.userid': fakeuser['dn']}
+        self._plugin().add_metadata(
+            self._makeEnviron({'repoze.who.logger': logger}), identity)
+        self.assertFalse('groups' in identity)
+        self.assertEqual(len(logger.warnings), 1)
+    
+    def test_invalid_returned_id(self):
+        self.assertRaises(ValueError, self._plugin, returned_id='login')
+
+
+class TestChangeFeed(Base):
+    """Tests for L{ChangeFeed} and the invalidation of the caches"""
+    
+    def setUp(self):
+        super(TestChangeFeed, self).setUp()
+        self.connection = FakeChangesConnection()
+        self.feed = ChangeFeed(self.connection, base_dn)
+        self.change = (fakeuser['dn'],
+                       {'modifyTimestamp': ['20990101000000Z'],
+                        'uid': [fakeuser['uid']]})
+    
+    def test_invalid_attribute(self):
+        self.assertRaises(ValueError, ChangeFeed, self.connection, base_dn,
+                          attribute='createTimestamp')
+    
+    def test_watermark(self):
+        self.assertEqual(len(self.feed.watermark), 15)
+        feed = ChangeFeed(self.connection, base_dn, attribute='entryCSN')
+        self.assertTrue(feed.watermark.endswith('Z#000000#000#000000'))
+    
+    def test_parse_stamp(self):
+        self.assertEqual(parse_stamp('20990101000000Z'),
+                         parse_stamp('20990101010000+0100'))
+        self.assertTrue(parse_stamp('20990101000000.5Z') >
+                        parse_stamp('20990101000000Z'))
+        csn = '20990101000000.000001Z#00000%d#000#000000'
+        self.assertTrue(parse_stamp(csn % 1) > parse_stamp(csn % 0))
+        self.assertEqual(parse_stamp('yesterday'), None)
+    
+    def test_watermark_formats(self):
+        # The later stamp wins even though it's smaller as a string:
+        self.feed.watermark = '20990101000000.5Z'
+        self.connection.changes.append(
+            (fakeuser['dn'], {'modifyTimestamp': ['20990101010001+0100']}))
+        self.feed.poll()
+        self.assertEqual(self.feed.watermark, '20990101010001+0100')
+    
+    def test_poll(self):
+        changes = []
+        self.feed.subscribe(lambda dn, entry: changes.append(dn), ['uid'])
+        watermark = self.feed.watermark
+        self.assertEqual(self.feed.poll(), 0)
+        self.assertEqual(self.connection.last_search,
+                         ('(modifyTimestamp>=%s)' % watermark,
+                          set(['modifyTimestamp', 'uid'])))
+        self.connection.changes.append(self.change)
+        self.assertEqual(self.feed.poll(), 1)
+        self.assertEqual(changes, [fakeuser['dn']])
+        self.assertEqual(self.feed.watermark, '20990101000000Z')
+    
+    def test_paged_search(self):
+        # More changes than the server returns at once:
+        self.connection.sizelimit = 1
+        for minute in range(3):
+            self.connection.changes.append(
+                ('uid=user%d,%s' % (minute, base_dn),
+                 {'modifyTimestamp': ['2099010100%02d00Z' % minute]}))
+        feed = ChangeFeed(self.connection, base_dn, page_size=2)
+        self.assertEqual(feed.poll(), 3)
+        self.assertEqual(self.connection.pages, 2)
+        self.assertEqual(feed.watermark, '20990101000200Z')
+    
+    def test_failing_listener(self):
+        def listener(dn, entry):
+            raise ValueError('Bad listener')
+        self.feed.subscribe(listener)
+        self.feed.interval = 0.01
+        self.connection.changes.append(self.change)
+        self.feed.start()
+        try:
+            deadline = time.time() + 5
+            while self.feed.last_error is None and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertTrue(self.feed._thread.isAlive())
+        finally:
+            self.feed.stop()
+        self.assertTrue(isinstance(self.feed.last_error, ValueError))
+    
+    def test_search_authenticator(self):
+        plugin = ShibbolethSearchAuthenticatorPlugin(
+            self.connection, base_dn, dn_cache_ttl=60, negative_cache_ttl=60,
+            credentials_cache_ttl=60, change_feed=self.feed)
+        identity = {'login': fakeuser['uid'],
+                    'password': fakeuser['password']}
+        self.assertEqual(plugin.authenticate(self.env, identity),
+                         fakeuser['dn'])
+        self.assertEqual(len(plugin.dn_cache), 1)
+        self.connection.changes.append(self.change)
+        self.feed.poll()
+        self.assertEqual(len(plugin.dn_cache), 0)
+        self.assertFalse(plugin.credentials_cache.check(
+            normalize_dn(fakeuser['dn']), fakeuser['password']))
+    
+    def test_dn_written_differently(self):
+        plugin = ShibbolethAuthenticatorPlugin(
+            self.connection, 'uid=%s,' + base_dn, credentials_cache_ttl=60,
+            change_feed=self.feed)
+        # The login as typed by the user:
+        dn = 'uid=CARLA,' + base_dn
+        plugin._verified(self.env, dn, fakeuser['password'])
+        self.assertTrue(plugin._known_credentials(self._makeEnviron(), dn,
+                                                  fakeuser['password']))
+        self.connection.changes.append(self.change)
+        self.feed.poll()
+        self.assertEqual(plugin._known_credentials(self._makeEnviron(), dn,
+                                                   fakeuser['password']),
+                         None)
+    
+    def test_new_account(self):
+        plugin = ShibbolethSearchAuthenticatorPlugin(
+            self.connection, base_dn, negative_cache_ttl=60,
+            change_feed=self.feed)
+        self.assertRaises(ValueError, plugin._get_dn, self.env,
+                          {'login': 'newcomer'})
+        self.connection.changes.append(
+            ('uid=newcomer,' + base_dn,
+             {'modifyTimestamp': ['20990101000000Z'], 'uid': 'newcomer'}))
+        self.feed.poll()
+        self.assertEqual(len(plugin.negative_cache), 0)
+    
+    def test_attributes_plugin(self):
+        plugin = ShibbolethAttributesPlugin(self.connection, 'mail',
+                                            cache_ttl=60,
+                                            change_feed=self.feed)
+        plugin.add_metadata(self.env, {'repoze.who.userid': fakeuser['dn']})
+        self.assertEqual(len(plugin.cache), 1)
+        self.connection.changes.append(self.change)
+        self.feed.poll()
+        self.assertEqual(len(plugin.cache), 0)
+    
+    def test_make_change_feed(self):
+        self.assertEqual(make_change_feed(), None)
+        self.assertEqual(make_change_feed(self.feed, 10), self.feed)
+        self.assertRaises(ValueError, make_change_feed, None, 10,
+                          self.connection)
+        # The users may be bound on a single connection between the polls:
+        self.assertRaises(ValueError, make_change_feed, None, 10,
+                          self.connection, base_dn)
+        pool = LDAPConnectionPool(FakeChangesConnection)
+        feed = make_change_feed(None, 3600, pool, base_dn)
+        try:
+            self.assertEqual(feed.interval, 3600)
+            self.assertNotEqual(feed._thread, None)
+        finally:
+            feed.stop()
+    
+    def test_polling_plugin(self):
+        self.assertRaises(ValueError, ShibbolethAttributesPlugin,
+                          self.connection, change_poll_interval=10)
+        self.assertRaises(ValueError, ShibbolethSearchAuthenticatorPlugin,
+                          self.connection, base_dn, change_poll_interval=10)
+        plugin = ShibbolethSearchAuthenticatorPlugin(
+            LDAPConnectionPool(FakeChangesConnection), base_dn,
+            change_poll_interval=3600)
+        try:
+            self.assertEqual(plugin.change_feed.base_dn, base_dn)
+            self.assertTrue(isinstance(plugin.change_feed.ldap_connection,
+                                       LDAPConnectionPool))
+        finally:
+            plugin.change_feed.stop()
+
+
+class TestLDAPEventLoop(unittest.TestCase):
+    """Tests for L{LDAPEventLoop}"""
+    
+    def setUp(self):
+        self.loop = LDAPEventLoop(poll_interval=0)
+    
+    def test_return_value(self):
+        def coroutine():
+            yield None
+            raise Return(42)
+        self.assertEqual(self.loop.run_until_complete(coroutine()), 42)
+    
+    def test_nested_coroutines(self):
+        def inner(value):
+            yield None
+            raise Return(value * 2)
+        def outer():
+            first = yield inner(1)
+            second = yield inner(first)
+            raise Return([first, second])
+        self.assertEqual(self.loop.run_until_complete(outer()), [2, 4])
+    
+    def test_exceptions_propagate(self):
+        def inner():
+            yield None
+            raise ValueError('inner')
+        def outer():
+            try:
+                yield inner()
+            except ValueError:
+                raise Return('caught')
+        self.assertEqual(self.loop.run_until_complete(outer()), 'caught')
+        self.assertRaises(ValueError, self.loop.run_until_complete, inner())
+    
+    def test_ldap_operations(self):
+        conn = FakeAsyncConnection()
+        def coroutine():
+            rtype, results = yield Wait(conn, conn.search_ext(
+                base_dn, ldap.SCOPE_SUBTREE, '(uid=nobody)'))
+            raise Return(results)
+        self.assertEqual(self.loop.run_until_complete(coroutine()), [])
+    
+    def test_operation_timeout(self):
+        conn = FakeAsyncConnection()
+        msgid = conn.search_ext(base_dn, ldap.SCOPE_SUBTREE, '(uid=nobody)')
+        def coroutine():
+            yield Wait(conn, msgid, timeout=0)
+        self.assertRaises(ldap.TIMEOUT, self.loop.run_until_complete,
+                          coroutine())
+        self.assertEqual(conn.abandoned, [msgid])
+
+
+class TestAsyncPlugins(Base):
+    """Tests for the asynchronous variants of the plugins"""
+    
+    def setUp(self):
+        super(TestAsyncPlugins, self).setUp()
+        self.connection = FakeAsyncConnection()
+        self.loop = LDAPEventLoop(poll_interval=0)
+        self.plugin = AsyncShibbolethSearchAuthenticatorPlugin(
+            self.connection, base_dn, bind_dn='Manager',
+            bind_pass='some password')
+    
+    def test_authenticate_comparesuccess(self):
+        identity = {'login': fakeuser['uid'],
+                    'password': fakeuser['password']}
+        result = self.loop.run_until_complete(
+            self.plugin.async_authenticate(self.env, identity))
+        self.assertEqual(result, fakeuser['dn'])
+    
+    def test_authenticate_comparefail(self):
+        identity = {'login': fakeuser['uid'],
+                    'password': 'wrong password'}
+        result = self.loop.run_until_complete(
+            self.plugin.async_authenticate(self.env, identity))
+        self.assertEqual(result, None)
+    
+    def test_authenticate_noresults(self):
+        identity = {'login': 'i_dont_exist',
+                    'password': 'super secure password'}
+        result = self.loop.run_until_complete(
+            self.plugin.async_authenticate(self.env, identity))
+        self.assertEqual(result, None)
+    
+    def test_shared_connection(self):
+        connection = FakeOverlapConnection()
+        plugin = AsyncShibbolethSearchAuthenticatorPlugin(
+            connection, base_dn, bind_dn='Manager', bind_pass='some password')
+        tasks = []
+        for password in [fakeuser['password'], 'wrong password']:
+            identity = {'login': fakeuser['uid'], 'password': password}
+            tasks.append(self.loop.spawn(
+                plugin.async_authenticate(self._makeEnviron(), identity)))
+        self.loop.run()
+        self.assertEqual([task.result() for task in tasks],
+                         [fakeuser['dn'], None])
+        # The operations of the coroutines never overlapped:
+        self.assertEqual(connection.max_outstanding, 1)
+    
+    def test_concurrent_logins(self):
+        pool = LDAPConnectionPool(FakeAsyncConnection, max_size=2)
+        plugin = AsyncShibbolethSearchAuthenticatorPlugin(pool, base_dn)
+        tasks = []
+        for password in [fakeuser['password'], 'wrong password'] * 3:
+            identity = {'login': fakeuser['uid'], 'password': password}
+            tasks.append(self.loop.spawn(
+                plugin.async_authenticate(self.env, identity)))
+        self.loop.run()
+        self.assertEqual([task.result() for task in tasks],
+                         [fakeuser['dn'], None] * 3)
+        self.assertEqual(len(pool._idle), 2)
+    
+    def test_pattern_authenticator(self):
+        plugin = AsyncShibbolethAuthenticatorPlugin(self.connection, base_dn)
+        identity = {'login': fakeuser['uid'],
+                    'password': fakeuser['password']}
+        result = self.loop.run_until_complete(
+            plugin.async_authenticate(self.env, identity))
+        self.assertEqual(result, fakeuser['dn'])
+    
+    def test_add_metadata(self):
+        plugin = AsyncShibbolethAttributesPlugin(self.connection, 'cn,mail')
+        identity = {'repoze.who.userid': fakeuser['dn']}
+        self.loop.run_until_complete(
+            plugin.async_add_metadata(self.env, identity))
+        self.assertEqual(identity['mail'], [fakeuser['mail']])
+    
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(threshold=1, reset_timeout=60)
+        breaker.failure()
+        plugin = AsyncShibbolethSearchAuthenticatorPlugin(
+            self.connection, base_dn, circuit_breaker=breaker)
+        identity = {'login': fakeuser['uid'],
+                    'password': fakeuser['password']}
+        result = self.loop.run_until_complete(
+            plugin.async_authenticate(self.env, identity))
+        self.assertEqual(result, None)
+        self.assertEqual(self.connection.searches, 0)
+        metadata = AsyncShibbolethAttributesPlugin(self.connection,
+                                                   circuit_breaker=breaker)
+        identity = {'repoze.who.userid': fakeuser['dn']}
+        self.loop.run_until_complete(
+            metadata.async_add_metadata(self.env, identity))
+        self.assertEqual(identity, {'repoze.who.userid': fakeuser['dn']})
+    
+    def test_metrics(self):
+        metrics = Metrics()
+        plugin = AsyncShibbolethSearchAuthenticatorPlugin(
+            self.connection, base_dn, metrics=metrics)
+        identity = {'login': fakeuser['uid'],
+                    'password': 'wrong password'}
+        self.loop.run_until_complete(
+            plugin.async_authenticate(self.env, identity))
+        self.assertEqual(metrics.counter('ldap.operations',
+                                         operation='search',
+                                         outcome='success'), 1)
+        self.assertEqual(metrics.counter('ldap.operations', operation='bind',
+                                         outcome='invalid_credentials'), 1)
+        self.assertEqual(len(metrics.histograms('plugin.duration',
+                                                call='authenticate')), 1)
+
+
+class TestLDAPServerGroup(Base):
+    """Tests for L{LDAPServerGroup}"""
+    
+    def _servers(self, conns):
+        return [conn.args[0] for conn in conns]
+    
+    def _spread(self, group, count):
+        """Check connections out and in, and return their servers"""
+        conns = []
+        for i in range(count):
+            conn = group.get()
+            group.put(conn)
+            conns.append(conn)
+        return self._servers(conns)
+    
+    def test_invalid_arguments(self):
+        self.assertRaises(ValueError, LDAPServerGroup, [])
+        self.assertRaises(ValueError, LDAPServerGroup, 'ldap://a ldap://b',
+                          weights='1')
+        self.assertRaises(ValueError, LDAPServerGroup, 'ldap://a',
+                          strategy='random')
+    
+    def test_weighted_round_robin(self):
+        group = LDAPServerGroup([partial(FakeClosableConnection, 'a'),
+                                 partial(FakeClosableConnection, 'b')],
+                                weights='2,1')
+        servers = self._spread(group, 6)
+        self.assertEqual(servers.count('a'), 4)
+        self.assertEqual(servers.count('b'), 2)
+    
+    def test_least_outstanding(self):
+        group = LDAPServerGroup([partial(FakeClosableConnection, 'a'),
+                                 partial(FakeClosableConnection, 'b')],
+                                strategy='least-outstanding')
+        conns = [group.get() for i in range(3)]
+        self.assertEqual(self._servers(conns), ['a', 'b', 'a'])
+        group.put(conns[2])
+        group.put(conns[0])
+        self.assertEqual(self._servers([group.get()]), ['a'])
+        self.assertEqual([server['outstanding'] for server in group.status()],
+                         [1, 1])
+    
+    def test_failover(self):
+        group = LDAPServerGroup([FakeDownConnection,
+                                 partial(FakeClosableConnection, 'b')],
+                                max_failures=1)
+        self.assertEqual(self._spread(group, 2), ['b', 'b'])
+        self.assertEqual([server['available'] for server in group.status()],
+                         [False, True])
+    
+    def test_setup_failure(self):
+        def misconfigured():
+            raise ValueError('Cannot upgrade the connection')
+        group = LDAPServerGroup([misconfigured,
+                                 partial(FakeClosableConnection, 'b')],
+                                max_failures=1)
+        self.assertEqual(self._spread(group, 2), ['b', 'b'])
+        self.assertEqual([server['available'] for server in group.status()],
+                         [False, True])
+        group = LDAPServerGroup([misconfigured])
+        self.assertRaises(ValueError, group.get)
+        self.assertEqual(group.status()[0]['failures'], 1)
+    
+    def test_ejection_and_readmission(self):
+        group = LDAPServerGroup([partial(FakeClosableConnection, 'a'),
+                                 partial(FakeClosableConnection, 'b')],
+                                max_failures=1, retry_interval=60)
+        conn = group.get()
+        group.put(conn, discard=True)
+        self.assertEqual(self._servers([conn]), ['a'])
+        self.assertEqual(self._spread(group, 2), ['b', 'b'])
+        group._servers[0].ejected_until = 0
+        self.assertTrue('a' in self._spread(group, 2))
+        self.assertEqual(group.status()[0]['failures'], 0)
+    
+    def test_all_servers_ejected(self):
+        group = LDAPServerGroup([partial(FakeClosableConnection, 'a')],
+                                max_failures=1)
+        group.put(group.get(), discard=True)
+        self.assertEqual(self._spread(group, 1), ['a'])
+    
+    def test_all_servers_down(self):
+        group = LDAPServerGroup([FakeDownConnection, FakeDownConnection])
+        self.assertRaises(ldap.SERVER_DOWN, group.get)
+    
+    def test_exhausted_server_is_skipped(self):
+        group = LDAPServerGroup([partial(FakeClosableConnection, 'a'),
+                                 partial(FakeClosableConnection, 'b')],
+                                max_size=1, timeout=0.01)
+        conns = [group.get(), group.get()]
+        self.assertEqual(sorted(self._servers(conns)), ['a', 'b'])
+        self.assertRaises(PoolTimeout, group.get)
+        self.assertRaises(PoolTimeout, group.get, False)
+    
+    def test_authenticate(self):
+        group = LDAPServerGroup([fakeldap.FakeLDAPConnection] * 2)
+        plugin = ShibbolethSearchAuthenticatorPlugin(group, base_dn)
+        self.assertTrue(isinstance(plugin.bind_connection, LDAPServerGroup))
+        identity = {'login': fakeuser['uid'],
+                    'password': fakeuser['password']}
+        self.assertEqual(plugin.authenticate(self.env, identity),
+                         fakeuser['dn'])
+
+
+class TestReadWriteSplit(Base):
+    """Tests for the searches and binds sent to different servers"""
+    
+    def setUp(self):
+        super(TestReadWriteSplit, self).setUp()
+        self.replicas = [FakeCountingConnection(), FakeCountingConnection()]
+        self.primary = FakeCountingConnection()
+        replicas = [partial(lambda conn: conn, replica)
+                    for replica in self.replicas]
+        self.plugin = ShibbolethSearchAuthenticatorPlugin(
+            replicas, base_dn, server_weights='2,1',
+            bind_connection=[lambda: self.primary], bind_pool_max_size=1)
+    
+    def test_searches_go_to_replicas(self):
+        identity = {'login': fakeuser['uid'],
+                    'password': fakeuser['password']}
+        self.assertEqual(self.plugin.authenticate(self.env, identity),
+                         fakeuser['dn'])
+        self.assertEqual(self.primary.binds, 1)
+        self.assertEqual([replica.binds for replica in self.replicas], [0, 0])
+        self.assertEqual(sum([replica.searches for replica
+                              in self.replicas]), 1)
+    
+    def test_bind_pool(self):
+        self.assertEqual(self.plugin.ldap_connection.weights, [2, 1])
+        self.assertTrue(isinstance(self.plugin.bind_connection,
+                                   LDAPConnectionPool))
+        self.assertEqual(self.plugin.bind_connection.max_size, 1)
+        self.assertEqual(self.plugin.bind_connection.bind_dn, '')
+
+
+class TestMetrics(unittest.TestCase):
+    """Tests for L{Metrics}"""
+    
+    def test_counters(self):
+        metrics = Metrics()
+        metrics.increment('ops', operation='search', outcome='success')
+        metrics.increment('ops', 2, operation='bind', outcome='success')
+        metrics.increment('ops', operation='bind', outcome='timeout')
+        self.assertEqual(metrics.counter('ops'), 4)
+        self.assertEqual(metrics.counter('ops', operation='bind'), 3)
+        self.assertEqual(metrics.counter('ops', outcome='success'), 3)
+        self.assertEqual(metrics.counter('other'), 0)
+    
+    def test_histograms(self):
+        metrics = Metrics(buckets=[0.1, 1])
+        for value in (0.05, 0.5, 0.7, 3):
+            metrics.observe('duration', value, operation='search')
+        metrics.observe('duration', 0.2, operation='bind')
+        histograms = metrics.histograms('duration', operation='search')
+        self.assertEqual(histograms.keys(), [(('operation', 'search'),)])
+        histogram = histograms.values()[0]
+        self.assertEqual(histogram.counts, [1, 2, 1])
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.mean, 1.0625)
+        self.assertEqual(len(metrics.histograms('duration')), 2)
+        metrics.reset()
+        self.assertEqual(metrics.histograms('duration'), {})
+    
+    def test_percentiles(self):
+        histogram = Histogram((1, 2, 3))
+        self.assertEqual(histogram.percentile(50), None)
+        for value in (0.5, 1.5, 1.6, 2.5, 7):
+            histogram.observe(value)
+        self.assertEqual(histogram.percentile(50), 2)
+        self.assertEqual(histogram.percentile(80), 3)
+        self.assertEqual(histogram.percentile(100), 7)
+    
+    def test_callback(self):
+        reported = []
+        metrics = CallbackMetrics(lambda *args: reported.append(args))
+        metrics.increment('ops', operation='search')
+        metrics.observe('duration', 0.5)
+        self.assertEqual(reported, [('counter', 'ops', 1,
+                                     {'operation': 'search'}),
+                                    ('histogram', 'duration', 0.5, {})])
+
+
+class TestPluginMetrics(Base):
+    """Tests for the metrics reported by the plugins"""
+    
+    def setUp(self):
+        super(TestPluginMetrics, self).setUp()
+        self.metrics = Metrics()
+        self.plugin = ShibbolethSearchAuthenticatorPlugin(
+            LDAPConnectionPool(FakeCountingConnection), base_dn,
+            bind_dn='Manager', bind_pass='some password', dn_cache_ttl=60,
+            metrics=self.metrics)
+    
+    def _authenticate(self, password):
+        identity = {'login': fakeuser['uid'], 'password': password}
+        return self.plugin.authenticate(self._makeEnviron(), identity)
+    
+    def test_operations(self):
+        self._authenticate(fakeuser['password'])
+        self._authenticate('wrong password')
+        counter = self.metrics.counter
+        self.assertEqual(counter('ldap.operations', operation='service_bind',
+                                 outcome='success'), 1)
+        self.assertEqual(counter('ldap.operations', operation='search',
+                                 server='FakeCountingConnection'), 1)
+        self.assertEqual(counter('ldap.operations', operation='bind',
+                                 outcome='success'), 1)
+        self.assertEqual(counter('ldap.operations', operation='bind',
+                                 outcome='invalid_credentials'), 1)
+        self.assertEqual(len(self.metrics.histograms('ldap.duration')), 4)
+        histograms = self.metrics.histograms('plugin.duration',
+                                             call='authenticate')
+        self.assertEqual(histograms.values()[0].count, 2)
+    
+    def test_cache_lookups(self):
+        self._authenticate(fakeuser['password'])
+        self._authenticate(fakeuser['password'])
+        self.assertEqual(self.metrics.counter('cache.lookups', cache='dn',
+                                              outcome='miss'), 1)
+        self.assertEqual(self.metrics.counter('cache.lookups', cache='dn',
+                                              outcome='hit'), 1)
+    
+    def test_attributes(self):
+        plugin = ShibbolethAttributesPlugin(FakeCountingConnection(), 'mail',
+                                            cache_ttl=60,
+                                            metrics=self.metrics)
+        for i in range(2):
+            plugin.add_metadata(self._makeEnviron(), {'repoze.who.userid':
+                                                      fakeuser['dn']})
+        self.assertEqual(self.metrics.counter('ldap.operations',
+                                              operation='search'), 1)
+        self.assertEqual(self.metrics.counter('cache.lookups',
+                                              cache='attributes'), 2)
+        self.assertEqual(self.metrics.counter('cache.lookups',
+                                              cache='attributes',
+                                              outcome='hit'), 1)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """Tests for L{CircuitBreaker}"""
+    
+    def test_invalid_arguments(self):
+        self.assertRaises(ValueError, CircuitBreaker, threshold=0)
+        self.assertRaises(ValueError, CircuitBreaker, reset_timeout=-1)
+    
+    def test_opens_after_threshold(self):
+        breaker = CircuitBreaker(threshold='2', reset_timeout=60)
+        breaker.record(ldap.SERVER_DOWN())
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
+        breaker.record(ldap.TIMEOUT())
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+    
+    def test_answers_are_successes(self):
+        breaker = CircuitBreaker(threshold=2)
+        breaker.record(ldap.SERVER_DOWN())
+        breaker.record(ldap.INVALID_CREDENTIALS())
+        breaker.record(ldap.SERVER_DOWN())
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+    
+    def test_single_probe_when_half_open(self):
+        breaker = CircuitBreaker(threshold=1, reset_timeout=0)
+        breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
+    
+    def test_failed_probe_reopens(self):
+        breaker = CircuitBreaker(threshold=3, reset_timeout=60)
+        for i in range(3):
+            breaker.failure()
+        breaker.reset_timeout = 0
+        self.assertTrue(breaker.allow())
+        breaker.reset_timeout = 60
+        breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+    
+    def test_guard(self):
+        breaker = CircuitBreaker(threshold=1, reset_timeout=60)
+        def use(error):
+            with breaker.guard():
+                raise error
+        self.assertRaises(ldap.NO_SUCH_OBJECT, use, ldap.NO_SUCH_OBJECT())
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertRaises(ldap.SERVER_DOWN, use, ldap.SERVER_DOWN())
+        self.assertRaises(CircuitOpen, use, ValueError())
+
+
+class TestTimeouts(unittest.TestCase):
+    """Tests for the network and operation timeouts"""
+    
+    def test_pool_sets_timeouts(self):
+        pool = LDAPConnectionPool(fakeldap.FakeLDAPConnection,
+                                  network_timeout='2', operation_timeout=5)
+        conn = pool.get()
+        self.assertEqual(conn.options[ldap.OPT_NETWORK_TIMEOUT], 2.0)
+        self.assertEqual(conn.options[ldap.OPT_TIMEOUT], 5.0)
+        self.assertEqual(conn.timeout, 5.0)
+    
+    def test_copies_keep_timeouts(self):
+        pool = LDAPConnectionPool(fakeldap.FakeLDAPConnection,
+                                  operation_timeout=5)
+        self.assertEqual(pool.copy().operation_timeout, 5)
+    
+    def test_no_timeouts_by_default(self):
+        pool = LDAPConnectionPool(fakeldap.FakeLDAPConnection)
+        self.assertEqual(pool.get().options, {})
+    
+    def test_timed_out_connection_is_discarded(self):
+        pool = LDAPConnectionPool(FakeClosableConnection)
+        def use():
+            with pool.connection() as conn:
+                raise ldap.TIMEOUT()
+        self.assertRaises(ldap.TIMEOUT, use)
+        self.assertEqual(pool._size, 0)
+
+
+class TestBenchmark(unittest.TestCase):
+    """Tests for the benchmarks"""
+    
+    users = 3
+    
+    def setUp(self):
+        benchmark.populate(self.users)
+        self.factory = partial(benchmark.LatencyConnection, 0, 0)
+    
+    def tearDown(self):
+        conn = fakeldap.FakeLDAPConnection()
+        for number in range(self.users):
+            conn.delete_s('uid=user%d,%s' % (number, benchmark.BASE_DN))
+    
+    def test_latency(self):
+        conn = benchmark.LatencyConnection(0.01, 0.02, 0)
+        started_at = time.time()
+        conn.simple_bind_s('uid=user1,' + benchmark.BASE_DN, 'secret1')
+        conn.search_s(benchmark.BASE_DN, ldap.SCOPE_ONELEVEL, '(uid=user1)')
+        self.assertTrue(time.time() - started_at >= 0.03)
+    
+    def test_one_operation_at_a_time(self):
+        conn = benchmark.LatencyConnection(0.05, 0, 0)
+        binding = threading.Thread(target=conn.simple_bind_s,
+                                   args=('uid=user1,' + benchmark.BASE_DN,
+                                         'secret1'))
+        binding.start()
+        time.sleep(0.01)
+        started_at = time.time()
+        # The search waits for the bind of the other thread:
+        conn.search_s(benchmark.BASE_DN, ldap.SCOPE_ONELEVEL, '(uid=user1)')
+        self.assertTrue(time.time() - started_at >= 0.02)
+        binding.join()
+    
+    def test_plugins(self):
+        for name in benchmark.PLUGINS:
+            for config in benchmark.CONFIGS:
+                plugin = benchmark.make_plugin(name, config, self.factory, 2)
+                result = benchmark.benchmark(plugin, threads=2, requests=3,
+                                             users=self.users)
+                self.assertEqual(result.errors, 0, (name, config))
+                self.assertEqual(len(result.latencies), 6)
+                self.assertTrue(result.percentile(50) <=
+                                result.percentile(99))
+    
+    def test_percentiles(self):
+        result = benchmark.Result([0.3, 0.1, 0.2, 0.4], 0, 2)
+        self.assertEqual(result.throughput, 2)
+        self.assertEqual(result.percentile(50), 0.2)
+        self.assertEqual(result.percentile(99), 0.4)
+        self.assertEqual(benchmark.Result([], 0, 0).percentile(50), None)
+    
+    def test_main(self):
+        output = StringIO()
+        sys.stdout, stdout = output, sys.stdout
+        try:
+            benchmark.main(['--plugins', 'search', '--configs', 'cached',
+                            '--threads', '1,2', '--requests', '2',
+                            '--users', str(self.users), '--bind-latency',
+                            '0', '--search-latency', '0'])
+        finally:
+            sys.stdout = stdout
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].startswith('plugin'))
+        self.assertEqual(lines[2].split()[:3], ['search', 'cached', '2'])
+
+
+class TestCircuitBreakerPlugins(Base):
+    """Tests for the plugins using a circuit breaker"""
+    
+    def setUp(self):
+        super(TestCircuitBreakerPlugins, self).setUp()
+        self.connection = FakeUnavailableConnection()
+        self.plugin = ShibbolethSearchAuthenticatorPlugin(
+            self.connection, base_dn, breaker_threshold=2,
+            breaker_reset_timeout=60)
+        self.identity = {'login': fakeuser['uid'],
+                         'password': fakeuser['password']}
+    
+    def test_fails_fast(self):
+        for i in range(4):
+            self.assertEqual(self.plugin.authenticate(self.env, self.identity),
+                             None)
+        self.assertEqual(self.connection.searches, 2)
+        self.assertEqual(self.plugin.circuit_breaker.state,
+                         CircuitBreaker.OPEN)
+    
+    def test_metadata_are_skipped(self):
+        metadata = ShibbolethAttributesPlugin(
+            self.connection, circuit_breaker=self.plugin.circuit_breaker)
+        for i in range(2):
+            self.plugin.authenticate(self.env, self.identity)
+        identity = {'repoze.who.userid': fakeuser['dn']}
+        metadata.add_metadata(self.env, identity)
+        self.assertEqual(identity, {'repoze.who.userid': fakeuser['dn']})
+        self.assertEqual(self.connection.searches, 2)
+    
+    def test_recovers(self):
+        for i in range(2):
+            self.plugin.authenticate(self.env, self.identity)
+        self.plugin.circuit_breaker.reset_timeout = 0
+        self.connection.available = True
+        self.assertEqual(self.plugin.authenticate(self.env, self.identity),
+                         fakeuser['dn'])
+        self.assertEqual(self.plugin.circuit_breaker.state,
+                         CircuitBreaker.CLOSED)
 
 
 # Test cases for the fakeldap connection itself
@@ -440,8 +2756,8 @@ fakeuser = {
 }
 
 
-class CustomLDAPAuthenticatorPlugin(LDAPAuthenticatorPlugin):
-    """Fake class to test that L{LDAPAuthenticatorPlugin._get_dn} can be
+class CustomShibbolethAuthenticatorPlugin(ShibbolethAuthenticatorPlugin):
+    """Fake class to test that L{ShibbolethAuthenticatorPlugin._get_dn} can be
     overriden with no problems"""
     
     def _get_dn(self, environ, identity):
@@ -453,6 +2769,266 @@ class CustomLDAPAuthenticatorPlugin(LDAPAuthenticatorPlugin):
                                'environment')
 
 
+class FakeClosableConnection(fakeldap.FakeLDAPConnection):
+    """Fake connection which records whether it was unbound"""
+    
+    closed = False
+    
+    def unbind_s(self):
+        self.closed = True
+
+
+class FakeCountingConnection(fakeldap.FakeLDAPConnection):
+    """Fake connection which counts the binds performed"""
+    
+    binds = 0
+    searches = 0
+    
+    def simple_bind_s(self, who, cred):
+        self.binds += 1
+        return fakeldap.FakeLDAPConnection.simple_bind_s(self, who, cred)
+    
+    def search_s(self, *args, **kwargs):
+        self.searches += 1
+        return fakeldap.FakeLDAPConnection.search_s(self, *args, **kwargs)
+    
+    def search_ext_s(self, base, scope, filterstr='(objectClass=*)',
+                     attrlist=None, attrsonly=0, serverctrls=None,
+                     clientctrls=None, timeout=-1, sizelimit=0):
+        self.last_search = (attrlist, sizelimit)
+        results = self.search_s(base, scope, filterstr, attrlist)
+        if sizelimit and len(results) > sizelimit:
+            raise ldap.SIZELIMIT_EXCEEDED()
+        return results
+
+
+class FakePagedConnection(FakeCountingConnection):
+    """
+    Fake connection which returns the search results page after page; the
+    unpaged searches of the subclasses fail past C{sizelimit} entries
+    
+    """
+    
+    pages = 0
+    sizelimit = None
+    _paging = False
+    
+    def search_ext(self, base, scope, filterstr='(objectClass=*)',
+                   attrlist=None, attrsonly=0, serverctrls=None, **kwargs):
+        self._paging = True
+        try:
+            results = sorted(self.search_s(base, scope, filterstr, attrlist))
+        finally:
+            self._paging = False
+        control = serverctrls[0]
+        start = int(control.cookie or 0)
+        self._page = (results[start:start + control.size],
+                      start + control.size < len(results) and
+                      str(start + control.size) or '')
+        return 1
+    
+    def result3(self, msgid, all=1, timeout=None):
+        self.pages += 1
+        results, cookie = self._page
+        control = SimplePagedResultsControl(size=0, cookie=cookie)
+        return (ldap.RES_SEARCH_RESULT, results, msgid, [control])
+    
+    def _limit(self, results):
+        if (not self._paging and self.sizelimit is not None and
+            len(results) > self.sizelimit):
+            raise ldap.SIZELIMIT_EXCEEDED()
+        return results
+
+
+class FakeInterleavedConnection(FakePagedConnection):
+    """
+    Fake connection which calls C{between_pages} before returning each page,
+    and records who searched the pages in C{searched_as}
+    
+    """
+    
+    between_pages = None
+    searched_as = []
+    bound_as = None
+    
+    def simple_bind_s(self, who, cred):
+        result = FakePagedConnection.simple_bind_s(self, who, cred)
+        self.bound_as = who
+        return result
+    
+    def search_ext(self, *args, **kwargs):
+        self.searched_as.append(self.bound_as)
+        return FakePagedConnection.search_ext(self, *args, **kwargs)
+    
+    def result3(self, msgid, all=1, timeout=None):
+        if self.between_pages is not None:
+            self.between_pages()
+        return FakePagedConnection.result3(self, msgid, all, timeout)
+
+
+class FakeCaseIgnoreConnection(FakeCountingConnection):
+    """
+    Fake connection matching the C{uid} of the C{people} like a server does
+    (ignoring the case of all the letters and the extra spaces), and which
+    returns it as C{userid}
+    
+    """
+    
+    def __init__(self, people=(), *args, **kwargs):
+        FakeCountingConnection.__init__(self, *args, **kwargs)
+        self.people = list(people)
+    
+    def _fold(self, value):
+        if isinstance(value, str):
+            value = value.decode('utf-8')
+        return u' '.join(value.lower().split())
+    
+    def search_s(self, base, scope=ldap.SCOPE_SUBTREE,
+                 filterstr='(objectClass=*)', attrlist=None, *args):
+        self.searches += 1
+        wanted = set([self._fold(value) for value
+                      in re.findall(r'\(uid=([^()]*)\)', filterstr)])
+        return [('uid=%s,%s' % (uid, base_dn), {'userid': [uid]})
+                for uid in self.people if self._fold(uid) in wanted]
+
+
+class FakeChangesConnection(FakePagedConnection):
+    """Fake connection which returns the C{changes} to the change feeds"""
+    
+    def __init__(self, *args, **kwargs):
+        FakeCountingConnection.__init__(self, *args, **kwargs)
+        self.changes = []
+    
+    def search_s(self, base, scope=ldap.SCOPE_SUBTREE,
+                 filterstr='(objectClass=*)', attrlist=None, *args):
+        if '>=' not in filterstr:
+            return FakeCountingConnection.search_s(self, base, scope,
+                                                   filterstr, attrlist)
+        self.last_search = (filterstr, set(attrlist))
+        watermark = filterstr.split('>=')[1][:-1]
+        return self._limit([(dn, entry) for (dn, entry) in self.changes
+                            if entry['modifyTimestamp'][0] >= watermark])
+
+
+class FakeGroupsConnection(FakePagedConnection):
+    """Fake connection which returns the C{groups} to the group graphs"""
+    
+    down = False
+    
+    def __init__(self, groups=(), *args, **kwargs):
+        FakeCountingConnection.__init__(self, *args, **kwargs)
+        self.groups = list(groups)
+    
+    def search_s(self, base, scope=ldap.SCOPE_SUBTREE,
+                 filterstr='(objectClass=*)', attrlist=None, *args):
+        if 'objectClass=group' not in filterstr:
+            return FakeCountingConnection.search_s(self, base, scope,
+                                                   filterstr, attrlist)
+        self.searches += 1
+        if self.down:
+            raise ldap.SERVER_DOWN()
+        self.last_search = (base, filterstr, attrlist)
+        return self._limit(list(self.groups))
+
+
+class FakeLogger(object):
+    """Fake repoze.who logger which records the warnings"""
+    
+    def __init__(self):
+        self.warnings = []
+    
+    def warn(self, message):
+        self.warnings.append(message)
+
+
+def FakeDownConnection():
+    """Fake connection factory for a server which can't be reached"""
+    raise ldap.SERVER_DOWN()
+
+
+class FakeUnavailableConnection(FakeCountingConnection):
+    """Fake connection to a server which is down until it's C{available}"""
+    
+    available = False
+    
+    def simple_bind_s(self, who, cred):
+        if not self.available:
+            self.binds += 1
+            raise ldap.SERVER_DOWN()
+        return FakeCountingConnection.simple_bind_s(self, who, cred)
+    
+    def search_s(self, *args, **kwargs):
+        if not self.available:
+            self.searches += 1
+            raise ldap.SERVER_DOWN()
+        return FakeCountingConnection.search_s(self, *args, **kwargs)
+
+
+class FakeAsyncConnection(FakeCountingConnection):
+    """
+    Fake connection implementing the asynchronous API, whose results become
+    available on the second poll
+    
+    """
+    
+    def _start(self, operation):
+        if not hasattr(self, '_results'):
+            self._results = {}
+            self._msgid = 0
+        self._msgid += 1
+        try:
+            result = (None, operation())
+        except ldap.LDAPError, e:
+            result = (e, None)
+        self._results[self._msgid] = [False, result]
+        return self._msgid
+    
+    def simple_bind(self, who, cred):
+        def operation():
+            self.simple_bind_s(who, cred)
+            return (ldap.RES_BIND, [])
+        return self._start(operation)
+    
+    def search_ext(self, base, scope, filterstr='(objectClass=*)',
+                   attrlist=None, attrsonly=0, serverctrls=None,
+                   clientctrls=None, timeout=-1, sizelimit=0):
+        def operation():
+            return (ldap.RES_SEARCH_RESULT,
+                    self.search_ext_s(base, scope, filterstr, attrlist,
+                                      sizelimit=sizelimit))
+        return self._start(operation)
+    
+    def abandon(self, msgid):
+        self.abandoned = getattr(self, 'abandoned', []) + [msgid]
+        del self._results[msgid]
+    
+    def result(self, msgid, all=1, timeout=None):
+        pending = self._results[msgid]
+        if not pending[0]:
+            pending[0] = True
+            return (None, None)
+        del self._results[msgid]
+        error, result = pending[1]
+        if error is not None:
+            raise error
+        return result
+
+
+class FakeOverlapConnection(FakeAsyncConnection):
+    """
+    Fake asynchronous connection which records how many operations were
+    outstanding at once at most
+    
+    """
+    
+    max_outstanding = 0
+    
+    def _start(self, operation):
+        msgid = FakeAsyncConnection._start(self, operation)
+        self.max_outstanding = max(self.max_outstanding, len(self._results))
+        return msgid
+
+
 #}
 
 
@@ -466,17 +3042,58 @@ def suite():
     """
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TestLDAPConnection, "test"))
-    suite.addTest(unittest.makeSuite(TestMakeLDAPAuthenticatorPlugin, "test"))
-    suite.addTest(unittest.makeSuite(TestLDAPAuthenticatorPlugin, "test"))
-    suite.addTest(unittest.makeSuite(TestMakeLDAPAttributesPlugin, "test"))
-    suite.addTest(unittest.makeSuite(TestLDAPAttributesPlugin, "test"))
+    suite.addTest(unittest.makeSuite(TestMakeShibbolethAuthenticatorPlugin, "test"))
+    suite.addTest(unittest.makeSuite(TestShibbolethAuthenticatorPlugin, "test"))
+    suite.addTest(unittest.makeSuite(TestMakeShibbolethAttributesPlugin, "test"))
+    suite.addTest(unittest.makeSuite(TestShibbolethAttributesPlugin, "test"))
     suite.addTest(unittest.makeSuite(TestLDAPConnectionFactory, "test"))
-    suite.addTest(unittest.makeSuite(TestLDAPSearchAuthenticatorPluginNaming,
+    suite.addTest(unittest.makeSuite(TestLDAPConnectionPool, "test"))
+    suite.addTest(unittest.makeSuite(TestShibbolethAuthenticatorPluginPooled,
+                                     "test"))
+    suite.addTest(unittest.makeSuite(
+        TestShibbolethAuthenticatorPluginBindConnection, "test"))
+    suite.addTest(unittest.makeSuite(TestBindTracking, "test"))
+    suite.addTest(unittest.makeSuite(TestTTLCache, "test"))
+    suite.addTest(unittest.makeSuite(TestSQLiteCache, "test"))
+    suite.addTest(unittest.makeSuite(TestSharedCaches, "test"))
+    suite.addTest(unittest.makeSuite(
+        TestShibbolethSearchAuthenticatorPluginDNCache, "test"))
+    suite.addTest(unittest.makeSuite(TestShibbolethAttributesPluginCache,
+                                     "test"))
+    suite.addTest(unittest.makeSuite(
+        TestShibbolethSearchAuthenticatorPluginNegativeCache, "test"))
+    suite.addTest(unittest.makeSuite(TestCredentialsCache, "test"))
+    suite.addTest(unittest.makeSuite(
+        TestShibbolethSearchAuthenticatorPluginDNSearch, "test"))
+    suite.addTest(unittest.makeSuite(TestPrefetchedAttributes, "test"))
+    suite.addTest(unittest.makeSuite(TestRequestMemo, "test"))
+    suite.addTest(unittest.makeSuite(TestLazyAttributes, "test"))
+    suite.addTest(unittest.makeSuite(TestUserdataCodec, "test"))
+    suite.addTest(unittest.makeSuite(TestUserdataSnapshot, "test"))
+    suite.addTest(unittest.makeSuite(TestDirectoryMirror, "test"))
+    suite.addTest(unittest.makeSuite(TestChangeFeed, "test"))
+    suite.addTest(unittest.makeSuite(TestBatchAuthentication, "test"))
+    suite.addTest(unittest.makeSuite(TestReleasedAttributes, "test"))
+    suite.addTest(unittest.makeSuite(TestGroups, "test"))
+    suite.addTest(unittest.makeSuite(TestShibbolethSPPlugin, "test"))
+    suite.addTest(unittest.makeSuite(TestLDAPEventLoop, "test"))
+    suite.addTest(unittest.makeSuite(TestAsyncPlugins, "test"))
+    suite.addTest(unittest.makeSuite(TestCircuitBreaker, "test"))
+    suite.addTest(unittest.makeSuite(TestLDAPServerGroup, "test"))
+    suite.addTest(unittest.makeSuite(TestReadWriteSplit, "test"))
+    suite.addTest(unittest.makeSuite(TestMetrics, "test"))
+    suite.addTest(unittest.makeSuite(TestPluginMetrics, "test"))
+    suite.addTest(unittest.makeSuite(TestTimeouts, "test"))
+    suite.addTest(unittest.makeSuite(TestCircuitBreakerPlugins, "test"))
+    suite.addTest(unittest.makeSuite(TestBenchmark, "test"))
+    suite.addTest(unittest.makeSuite(
+        TestShibbolethAuthenticatorPluginCredentialsCache, "test"))
+    suite.addTest(unittest.makeSuite(TestShibbolethSearchAuthenticatorPluginNaming,
                                      "test"))
-    suite.addTest(unittest.makeSuite(TestLDAPAuthenticatorReturnLogin, "test"))
-    suite.addTest(unittest.makeSuite(TestLDAPSearchAuthenticatorReturnLogin,
+    suite.addTest(unittest.makeSuite(TestShibbolethAuthenticatorReturnLogin, "test"))
+    suite.addTest(unittest.makeSuite(TestShibbolethSearchAuthenticatorReturnLogin,
                                      "test"))
-    suite.addTest(unittest.makeSuite(TestLDAPAuthenticatorPluginStartTls,
+    suite.addTest(unittest.makeSuite(TestShibbolethAuthenticatorPluginStartTls,
                                      "test"))
     return suite
 
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+#
+# repoze.who.plugins.shibboleth, Shibboleth authentication for WSGI applications.
+# Copyright (C) 2010 by Ralph Bean <http://threebean.wordpress.com/>
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE.
+"""
+What the plugins store in the C{userdata} of the identities.
+
+The C{userdata} is kept by the identifiers between requests (e.g., in the
+C{auth_tkt} cookie). The authenticators store the DN of the user there, as
+C{<dn:base64 DN>} (version 0 of the format), so that the metadata providers
+don't have to find it again.
+
+Version 1, C{<shib1:payload.signature>}, is written when a secret is
+configured: Its payload is the compressed DN, issue time and, optionally, a
+snapshot of the attributes of the user, signed with an HMAC so that they
+can be trusted until the snapshot gets too old.
+
+@attention: The payload is signed, not encrypted: Whoever gets hold of the
+    C{userdata} (the user, or anyone who sees the cookie) can read the
+    attributes in it. Only C{userPassword} is always left out; the other
+    sensitive attributes must be excluded with the C{excluded_attributes}
+    of L{UserdataCodec}.
+
+"""
+
+__all__ = ['UserdataCodec', 'Userdata', 'decode_dn']
+
+import hashlib
+import hmac
+import json
+import re
+import time
+import zlib
+
+from base64 import b64decode, urlsafe_b64encode, urlsafe_b64decode
+
+
+#: The version 0 token: C{<dn:base64 DN>}.
+LEGACY_TOKEN = re.compile('<dn:(?P<b64dn>[A-Za-z0-9+/]+=*)>')
+
+#: The version 1 token: C{<shib1:payload.signature>}.
+TOKEN = re.compile('<shib1:(?P<payload>[A-Za-z0-9_-]+)\.'
+                   '(?P<signature>[A-Za-z0-9_-]+)>')
+
+#: The attributes never put in the snapshots (lowercased).
+EXCLUDED_ATTRIBUTES = frozenset(['userpassword'])
+
+# The length of the signatures, in bytes:
+SIGNATURE_SIZE = 16
+
+
+class Userdata(object):
+    """What was decoded from the C{userdata} of an identity."""
+
+    def __init__(self, dn, attributes=None, names=None, issued_at=None):
+        """
+        @param dn: The DN of the user.
+        @param attributes: The snapshot of their attributes, if any, as
+            {name: values}.
+        @type attributes: C{dict}
+        @param names: The lowercased names of the attributes requested when
+            the snapshot was taken, or C{('*',)} if they all were.
+        @type names: C{tuple}
+        @param issued_at: When the snapshot was taken, in seconds since the
+            epoch.
+        @type issued_at: C{int}
+
+        """
+        self.dn = dn
+        self.attributes = attributes
+        self.names = names
+        self.issued_at = issued_at
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.dn)
+
+
+class UserdataCodec(object):
+    """
+    Encodes and decodes the C{userdata} tokens, and tells whether the
+    attribute snapshots they carry may be used.
+
+    """
+
+    def __init__(self, secret, max_age=300, max_size=1024,
+                 excluded_attributes=()):
+        """
+        @param secret: The key of the signatures.
+        @type secret: C{str}
+        @param max_age: How many seconds a snapshot is used for.
+        @type max_age: C{float}
+        @param max_size: How long a token may be, in bytes: The snapshot is
+            left out of the tokens which would be longer (the cookies are
+            limited to 4KB by the browsers).
+        @type max_size: C{int}
+        @param excluded_attributes: The attributes which must not be
+            readable in the C{userdata}: No snapshot is taken of the
+            attributes including one of them, so they are searched every
+            time.
+        @type excluded_attributes: C{iterable}
+        @raise ValueError: If C{secret} is empty.
+
+        """
+        if not secret:
+            raise ValueError('The userdata need a secret to be signed')
+        if isinstance(secret, unicode):
+            secret = secret.encode('utf-8')
+        self.secret = secret
+        self.max_age = float(max_age)
+        self.max_size = int(max_size)
+        self.excluded_attributes = frozenset([
+            name.strip().lower() for name in excluded_attributes
+            if name.strip()])
+
+    def _sign(self, payload):
+        return hmac.new(self.secret, 'shib1:' + payload,
+                        hashlib.sha256).digest()[:SIGNATURE_SIZE]
+
+    def encode(self, dn, attributes=None, names=None, issued_at=None):
+        """
+        Return the token of C{dn}, with a snapshot of its C{attributes} if
+        given and small enough.
+
+        The attributes whose values aren't text (e.g., photos) can't be in a
+        snapshot; there's no snapshot at all if some were requested, nor if
+        one of the C{excluded_attributes} is among them. The
+        L{EXCLUDED_ATTRIBUTES} are left out.
+
+        @param names: See L{Userdata.__init__}.
+        @param issued_at: See L{Userdata.__init__}; now by default.
+        @rtype: C{str}
+
+        """
+        if issued_at is None:
+            issued_at = time.time()
+        data = {'d': _text(dn), 't': int(issued_at)}
+        if attributes is not None and [
+                name for name in attributes
+                if name.lower() in self.excluded_attributes]:
+            attributes = None
+        if attributes is not None:
+            try:
+                data['a'] = dict([(_text(name), _texts(values))
+                                  for (name, values) in attributes.items()
+                                  if name.lower() not in EXCLUDED_ATTRIBUTES])
+            except UnicodeDecodeError:
+                pass
+            else:
+                data['n'] = list(names or ('*',))
+        token = self._token(data)
+        if len(token) > self.max_size and 'a' in data:
+            del data['a'], data['n']
+            token = self._token(data)
+        return token
+
+    def _token(self, data):
+        payload = _b64encode(zlib.compress(json.dumps(data,
+                                                      separators=(',', ':'))))
+        return '<shib1:%s.%s>' % (payload, _b64encode(self._sign(payload)))
+
+    def decode(self, userdata):
+        """
+        Return what the token in C{userdata} holds, or C{None} if there's no
+        valid token.
+
+        The version 0 tokens are decoded too, if there's no version 1 token.
+
+        @rtype: L{Userdata}
+
+        """
+        match = TOKEN.search(userdata or '')
+        if match is not None:
+            payload = match.group('payload')
+            try:
+                signature = _b64decode(match.group('signature'))
+                if not hmac.compare_digest(self._sign(payload), signature):
+                    return None
+                data = json.loads(zlib.decompress(_b64decode(payload)))
+            except (TypeError, ValueError, zlib.error):
+                return None
+            attributes = data.get('a')
+            if attributes is not None:
+                attributes = dict([(_bytes(name), _values(values))
+                                   for (name, values) in attributes.items()])
+                names = tuple([_bytes(name) for name in data['n']])
+            else:
+                names = None
+            return Userdata(_bytes(data['d']), attributes, names, data['t'])
+        dn = decode_dn(userdata)
+        if dn is None:
+            return None
+        return Userdata(dn)
+
+    def fresh(self, userdata, names):
+        """
+        Tell whether the snapshot in C{userdata} may be used instead of
+        searching the attributes C{names}.
+
+        @param userdata: What L{decode} returned.
+        @param names: See L{Userdata.__init__}.
+        @rtype: C{bool}
+
+        """
+        return (userdata.attributes is not None and
+                tuple(userdata.names) == tuple(names) and
+                time.time() - userdata.issued_at < self.max_age)
+
+    def replace(self, userdata, token):
+        """
+        Return C{userdata} with its DN tokens, of either version, replaced by
+        C{token}; the rest of it is kept.
+
+        """
+        userdata = LEGACY_TOKEN.sub('', TOKEN.sub('', userdata or ''))
+        return userdata + token
+
+
+def decode_dn(userdata):
+    """
+    Return the DN in the version 0 token of C{userdata}, if any.
+
+    """
+    match = LEGACY_TOKEN.search(userdata or '')
+    if match is None:
+        return None
+    return b64decode(match.group('b64dn'))
+
+
+#{ Encoding helpers
+
+
+def _b64encode(data):
+    return urlsafe_b64encode(data).rstrip('=')
+
+
+def _b64decode(data):
+    return urlsafe_b64decode(str(data) + '=' * (-len(data) % 4))
+
+
+def _text(value):
+    if isinstance(value, unicode):
+        return value
+    return value.decode('utf-8')
+
+
+def _texts(values):
+    if isinstance(values, basestring):
+        return _text(values)
+    return [_text(value) for value in values]
+
+
+def _bytes(value):
+    return value.encode('utf-8')
+
+
+def _values(values):
+    if isinstance(values, basestring):
+        return _bytes(values)
+    return [_bytes(value) for value in values]
+
+
+#}
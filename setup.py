@@ -51,7 +51,7 @@ setup(
     tests_require = ['dataflake.ldapconnection < 1.1dev'],
     install_requires=[
         'repoze.who >= 1.0.6, < 2.0dev',
-        'python-ldap>=2.3.5',
+        'python-ldap>=2.4',
         'setuptools',
         'zope.interface'
         ],